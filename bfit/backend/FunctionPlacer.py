@@ -9,9 +9,6 @@ import numpy as np
 from bfit.fitting.functions import lorentzian # freq, peak, fwhm, amp
 from bfit.fitting.functions import gaussian # freq, peak, fwhm, amp
 from bfit.fitting.functions import bilorentzian # freq, peak, fwhm, amp
-from bfit.fitting.functions import quadlorentzian # freq, nu_0, nu_q, eta, theta,
-                                                  # phi, amp0, amp1, amp2, amp3,
-                                                  #  fwhm0, fwhm1, fwhm2, fwhm3, I
 from bfit.fitting.functions import pulsed_exp # time, lambda_s, amp
 from bfit.fitting.functions import pulsed_strexp # time, lambda_s, beta, amp
 from bfit.fitting.functions import qp_nu # nu_0, nu_q, eta, theta, phi, I, m
@@ -129,15 +126,15 @@ class FunctionPlacer(object):
         elif self.fname == 'QuadLorentz':
 
             # if points are not saved they are garbage collected
-            self.list_points = {'peak0':[], 'peak1':[], 'peak2':[], 'peak3':[], 'fwhm':[], }
+            npeaks = int(2*self.spin)
+            self.list_points = {'peak%d'%j:[] for j in range(npeaks)}
+            self.list_points['fwhm'] = []
 
             # make points
             for i, (p, line) in enumerate(zip(self.p0, self.lines)):
-                ppt0, ppt1, ppt2, ppt3, widthpt = self.run_1f_quad_single(p, line, 'C%d'%(i+1))
-                self.list_points['peak0'].append(ppt0)
-                self.list_points['peak1'].append(ppt1)
-                self.list_points['peak2'].append(ppt2)
-                self.list_points['peak3'].append(ppt3)
+                *peakpts, widthpt = self.run_1f_quad_single(p, line, 'C%d'%(i+1))
+                for j, ppt in enumerate(peakpts):
+                    self.list_points['peak%d'%j].append(ppt)
                 self.list_points['fwhm'].append(widthpt)
             self.list_points['base'] = self.run_1f_quad_base(self.p0[0], self.list_points['fwhm'], 'C0')
 
@@ -289,7 +286,8 @@ class FunctionPlacer(object):
             widths: list of points for widths, need to update y values
         """
         peak0 = qp_nu(p0['nu_0'], p0['nu_q'], p0['eta'], p0['theta'], p0['phi'], \
-                          self.spin, -1)
+                          self.spin, 1-self.spin)
+        npeaks = int(2*self.spin)
 
         def update_base(x, y):
 
@@ -298,10 +296,8 @@ class FunctionPlacer(object):
             self.base = y
 
             for i in range(len(self.p0)):
-                self.p0[i]['amp0'] -= oldbase-y
-                self.p0[i]['amp1'] -= oldbase-y
-                self.p0[i]['amp2'] -= oldbase-y
-                self.p0[i]['amp3'] -= oldbase-y
+                for j in range(npeaks):
+                    self.p0[i]['amp%d'%j] -= oldbase-y
 
             # update width points
             for p0, wpoint, line in zip(self.p0, widths, self.lines):
@@ -327,11 +323,13 @@ class FunctionPlacer(object):
     # ======================================================================= #
     def run_1f_quad_single(self, p0, line, color):
         """
-            p0 keys: 'amp0', 'amp1', 'amp2', 'amp3', 'eta', 'phi', 'theta', 'fwhm', 'nu_0', 'nu_q'
+            p0 keys: 'amp0', 'amp1', ..., 'eta', 'phi', 'theta', 'fwhm', 'nu_0', 'nu_q'
+                     with one amplitude for each of the 2I peaks
         """
 
         # lorentzian fn: lorentzian # freq, peak, width, amp
         s = self.spin
+        npeaks = int(2*s)
 
         # peak locations from right to left
         peak = lambda i: qp_nu(p0['nu_0'], p0['nu_q'], p0['eta'], p0['theta'], \
@@ -344,17 +342,17 @@ class FunctionPlacer(object):
 
         # set peak and amplitudes
         peakpts = []
-        for n in range(2*s):
-            x = p0['nu_0'] + peak(n) - (peak(s+1-n)+peak(n))/2
+        for n in range(npeaks):
+            x = p0['nu_0'] + peak(n) - (peak(npeaks-1-n)+peak(n))/2
 
             y = self.base - \
                 p0['amp%d'%n] + \
                 sum([lorentzian(peak(n),
-                                peak(i%(2*s)),
+                                peak(i%npeaks),
                                 p0['fwhm'],
-                                p0['amp%d'%(i%(2*s))]) for i in range(n+1, 2*s+n)])
+                                p0['amp%d'%(i%npeaks)]) for i in range(n+1, npeaks+n)])
 
-            if n in (0, 2*s-1):
+            if n in (0, npeaks-1):
                 peakpts.append(DraggablePoint(self, None, x, y, color=color, marker='s'))
             else:
                 peakpts.append(DraggablePoint(self, None, x, y, color=color, marker='^', setx=False))
@@ -369,7 +367,7 @@ class FunctionPlacer(object):
             line.set_ydata(self.fn(self.x, **p0))
 
             # update peak heights
-            for i in range(2*s):
+            for i in range(npeaks):
                 peakpts[i].point.set_ydata((self.fn(peak(i), **p0),))
 
             # update width y
@@ -385,17 +383,17 @@ class FunctionPlacer(object):
             # peak point
             p0['amp%d'%n] = self.base - y + \
                         sum([lorentzian(peak(n),
-                                        peak(i%(2*s)),
+                                        peak(i%npeaks),
                                         p0['fwhm'],
-                                        p0['amp%d'%(i%(2*s))]) for i in range(n+1, 2*s+n)])
+                                        p0['amp%d'%(i%npeaks)]) for i in range(n+1, npeaks+n)])
 
             # width point
             x2 = peak(0)+p0['fwhm']/2
             widthpt.point.set_ydata((self.fn(x2, **p0),))
 
             # update the other peak points
-            for i in range(n+1, 2*s+n):
-                peakpts[i%(2*s)].point.set_ydata((self.fn(peak(i%(2*s)), **p0),))
+            for i in range(n+1, npeaks+n):
+                peakpts[i%npeaks].point.set_ydata((self.fn(peak(i%npeaks), **p0),))
 
             # update line
             line.set_ydata(self.fn(self.x, **p0))
@@ -410,12 +408,12 @@ class FunctionPlacer(object):
             # amplitude
             p0['amp%d'%n] = self.base - y + \
                         sum([lorentzian(peak(n),
-                                        peak(i%(2*s)),
+                                        peak(i%npeaks),
                                         p0['fwhm'],
-                                        p0['amp%d'%(i%(2*s))]) for i in range(n+1, 2*s+n)])
+                                        p0['amp%d'%(i%npeaks)]) for i in range(n+1, npeaks+n)])
 
             # get x and n of the other edge peak position
-            other_n = 2*s-n-1
+            other_n = npeaks-n-1
             other_x = float(peakpts[other_n].point.get_xdata()[0])
 
             # set nu_0
@@ -436,7 +434,7 @@ class FunctionPlacer(object):
             widthpt.point.set_ydata((self.fn(x2, **p0),))
 
             # update the other peak points
-            for i in range(1, 2*s-1):
+            for i in range(1, npeaks-1):
                 peakpts[i].point.set_xdata((peak(i),))
                 peakpts[i].point.set_ydata((self.fn(peak(i), **p0),))
             peakpts[other_n].point.set_ydata((self.fn(other_x, **p0),))
@@ -450,8 +448,8 @@ class FunctionPlacer(object):
 
         widthpt.updatefn = update_width
         peakpts[0].updatefn = partial(update_peak_edge, n=0)
-        peakpts[2*s-1].updatefn = partial(update_peak_edge, n=2*s-1)
-        for i in range(1, 2*s-1):
+        peakpts[npeaks-1].updatefn = partial(update_peak_edge, n=npeaks-1)
+        for i in range(1, npeaks-1):
             peakpts[i].updatefn = partial(update_peak_center, n=i)
 
         return (*peakpts, widthpt)
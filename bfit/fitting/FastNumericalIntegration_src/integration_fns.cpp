@@ -36,6 +36,40 @@ class StrExpClss
         }
 };
 
+/// ======================================================================= ///
+/// Derivative of the stretched exponential integrand with respect to lambda
+class StrExpDLambdaClss : public StrExpClss
+{
+    public:
+        StrExpDLambdaClss(double t1,double lambda1,double beta1,double probelife)
+            : StrExpClss(t1,lambda1,beta1,probelife) {}
+    
+        // Calculator
+        double operator()(double tprime) const
+        {
+            double x = t-tprime;
+            if (x <= 0) return 0;
+            return -beta*pow(lambda,beta-1)*pow(x,beta)*StrExpClss::operator()(tprime);
+        }
+};
+
+/// ======================================================================= ///
+/// Derivative of the stretched exponential integrand with respect to beta
+class StrExpDBetaClss : public StrExpClss
+{
+    public:
+        StrExpDBetaClss(double t1,double lambda1,double beta1,double probelife)
+            : StrExpClss(t1,lambda1,beta1,probelife) {}
+    
+        // Calculator
+        double operator()(double tprime) const
+        {
+            double x = (t-tprime)*lambda;
+            if (x <= 0) return 0;
+            return -pow(x,beta)*log(x)*StrExpClss::operator()(tprime);
+        }
+};
+
 /// ======================================================================= ///
 /// Integrator Class Methods ///
 
@@ -43,13 +77,30 @@ class StrExpClss
 Integrator::Integrator(double lifetime)
 {
     this->lifetime = lifetime;
+    this->tolerance = 1e-6;
 }
 
 // Integrate StrExp -----------------------------------------------------------
 double Integrator::StrExp(double t, double tprime, double lamb, double beta)
 {
     return DEIntegrator<StrExpClss>::Integrate(StrExpClss(t,lamb,beta,lifetime),
-                                               0,tprime,1e-6);
+                                               0,tprime,tolerance);
+}
+
+// Integrate derivative of StrExp with respect to lambda ----------------------
+double Integrator::StrExpDLambda(double t, double tprime, double lamb, double beta)
+{
+    return DEIntegrator<StrExpDLambdaClss>::Integrate(
+                                StrExpDLambdaClss(t,lamb,beta,lifetime),
+                                0,tprime,tolerance);
+}
+
+// Integrate derivative of StrExp with respect to beta ------------------------
+double Integrator::StrExpDBeta(double t, double tprime, double lamb, double beta)
+{
+    return DEIntegrator<StrExpDBetaClss>::Integrate(
+                                StrExpDBetaClss(t,lamb,beta,lifetime),
+                                0,tprime,tolerance);
 }
 
 #endif // INTEGRATION_FNS_CPP
@@ -6,16 +6,20 @@
 #define INTEGRATION_FNS_H
 
 /// ======================================================================= ///
-/// Integral of stretched exponential from 0 to x
+/// Integral of stretched exponential from 0 to x, and its derivatives with 
+/// respect to the parameters
 class Integrator
 {
     public:
         // Variables
         double lifetime;
+        double tolerance;   // target absolute error of the integrals
     
         // Methods
         Integrator(double lifetime);
         double StrExp(double t, double tprime, double lamb, double beta);
+        double StrExpDLambda(double t, double tprime, double lamb, double beta);
+        double StrExpDBeta(double t, double tprime, double lamb, double beta);
 };
 
 #endif // INTEGRATION_FNS_H //
@@ -1,4 +1,5 @@
 __all__=['functions', 
+         'functions_jax', 
          'global_fitter', 
          'global_bdata_fitter', 
          'PulsedFns', 
@@ -70,8 +70,18 @@ e_30Al = Q_30Al / Q_max
 e_30Si = 0.0
 
 # FUNCTIONS ==================================================================
-def s_31Mg(time, beam_rate, n_31Mg_0):
-  return    ((n_31Mg_0 * lambda_31Mg - beam_rate) * np.exp(-time * lambda_31Mg)\
+def _exp(time, lam, exps=None):
+    """
+        exp(-time*lam), taken from exps if precomputed
+        
+        exps: dict {decay constant: np.exp(-time*lam)} or None
+    """
+    if exps is None:
+        return np.exp(-time*lam)
+    return exps[lam]
+
+def s_31Mg(time, beam_rate, n_31Mg_0, exps=None):
+  return    ((n_31Mg_0 * lambda_31Mg - beam_rate) * _exp(time, lambda_31Mg, exps)\
             ) / lambda_31Mg + beam_rate / lambda_31Mg
 
 # number 31Mg atoms
@@ -97,15 +107,15 @@ def n_31Mg(time, beam_pulse, beam_rate):
 def a_31Mg(time, beam_pulse, beam_rate):
     return e_31Mg * lambda_31Mg * n_31Mg(time, beam_pulse, beam_rate)
 
-def s_31Al(time, beam_rate, n_31Mg_0, n_31Al_0):
+def s_31Al(time, beam_rate, n_31Mg_0, n_31Al_0, exps=None):
     
     nb_31Mg = n_31Mg_0 * b_31Mg
     rb_31Mg = beam_rate * b_31Mg
     
-    term1 = -(nb_31Mg * lambda_31Mg - rb_31Mg) * np.exp(-time * lambda_31Mg) \
+    term1 = -(nb_31Mg * lambda_31Mg - rb_31Mg) * _exp(time, lambda_31Mg, exps) \
              / (lambda_31Mg - lambda_31Al)
                
-    term2 = np.exp(-time * lambda_31Al) * \
+    term2 = _exp(time, lambda_31Al, exps) * \
             (((nb_31Mg + n_31Al_0) * lambda_31Al - rb_31Mg) * \
                lambda_31Mg - n_31Al_0 * lambda_31Al**2)
                
@@ -136,7 +146,7 @@ def n_31Al(time, beam_pulse, beam_rate):
 def a_31Al(time, beam_pulse, beam_rate):
   return e_31Al * lambda_31Al * n_31Al(time, beam_pulse, beam_rate)
 
-def s_31Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_31Si_0):
+def s_31Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_31Si_0, exps=None):
     
     r_bAlbMg = beam_rate * b_31Al * b_31Mg
     lam_prod = lambda_31Al * lambda_31Mg
@@ -151,14 +161,14 @@ def s_31Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_31Si_0):
            ((-n_31Al_0 * b_31Al - n_31Si_0) * lambda_31Al -\
             n_31Si_0 * lambda_31Mg) * lambda_31Si**2 + (prod1 + n_31Si_0) * prod2-\
            r_bAlbMg * lam_prod) *\
-          np.exp(-time * lambda_31Si)) /\
+          _exp(time, lambda_31Si, exps)) /\
              (lambda_31Si**3 +\
               (-lambda_31Mg - lambda_31Al) * lambda_31Si**2 + prod2) -\
          ((n_31Mg_0 * b_31Al * b_31Mg * lam_prod -\
            r_bAlbMg * lambda_31Al) *\
-          np.exp(-time * lambda_31Mg)) / (delta_lam * lambda_31Si -\
+          _exp(time, lambda_31Mg, exps)) / (delta_lam * lambda_31Si -\
               lambda_31Mg**2 + lam_prod) +\
-         (np.exp(-time * lambda_31Al) *\
+         (_exp(time, lambda_31Al, exps) *\
           ((prod1 * lambda_31Al - r_bAlbMg) * lambda_31Mg -\
            n_31Al_0 * b_31Al * (lambda_31Al**2))) /\
              (delta_lam * lambda_31Si -\
@@ -189,7 +199,7 @@ def n_31Si(time, beam_pulse, beam_rate):
 def a_31Si(time, beam_pulse, beam_rate):
   return e_31Si * lambda_31Si * n_31Si(time, beam_pulse, beam_rate)
 
-def s_31P(time, beam_rate, n_31Mg_0, n_31Al_0, n_31Si_0, n_31P_0):
+def s_31P(time, beam_rate, n_31Mg_0, n_31Al_0, n_31Si_0, n_31P_0, exps=None):
     
     bb = b_31Al * b_31Mg
     rbb = beam_rate * bb
@@ -204,14 +214,14 @@ def s_31P(time, beam_rate, n_31Mg_0, n_31Al_0, n_31Si_0, n_31P_0):
                 (n_31Mg_0 * bb + n_31Al_0 * b_31Al + n_31Si_0) *\
                 lamlam * lambda_31Si -\
                 r_bblamAl * lambda_31Mg) *\
-            np.exp(-time * lambda_31Si)) /\
+            _exp(time, lambda_31Si, exps)) /\
             (lambda_31Si**3 + (-lambda_31Mg - lambda_31Al) * lambda_31Si**2 +\
                 lamlam * lambda_31Si) +\
             ((n_31Mg_0 * bblamAl * lambda_31Mg - r_bblamAl) *\
-                np.exp(-time * lambda_31Mg) * lambda_31Si) /\
+                _exp(time, lambda_31Mg, exps) * lambda_31Si) /\
             ((lambda_31Mg**2 - lamlam) *\
             lambda_31Si - lambda_31Mg**3 + lambda_31Al * lambda_31Mg**2) -\
-            (np.exp(-time * lambda_31Al) *\
+            (_exp(time, lambda_31Al, exps) *\
                 (((n_31Mg_0 * bb + n_31Al_0 * b_31Al) * lambda_31Al -rbb) *\
                     lambda_31Mg -n_31Al_0 * b_31Al * lambda_31Al**2) *\
                 lambda_31Si) /\
@@ -238,7 +248,7 @@ def n_31P(time, beam_pulse, beam_rate):
     n_31Mg_0 = s_31Mg(beam_pulse, beam_rate, 0)
     n_31Al_0 = s_31Al(beam_pulse, beam_rate, 0, 0)
     n_31Si_0 = s_31Si(beam_pulse, beam_rate, 0, 0, 0)
-    n_31P_0 = s_31P(time[~idx], beam_rate, 0, 0, 0, 0)
+    n_31P_0 = s_31P(beam_pulse, beam_rate, 0, 0, 0, 0)
     out[~idx] = s_31P(delta, 0, n_31Mg_0, n_31Al_0, n_31Si_0, n_31P_0)
     
     # negative times
@@ -248,12 +258,12 @@ def n_31P(time, beam_pulse, beam_rate):
 def a_31P(time, beam_pulse, beam_rate): 
     return e_31P * lambda_31P * n_31P(time, beam_pulse, beam_rate)
 
-def s_30Al( time,  beam_rate,  n_31Mg_0,  n_30Al_0): 
+def s_30Al( time,  beam_rate,  n_31Mg_0,  n_30Al_0, exps=None): 
     return  (((n_31Mg_0 * b_31Mg - n_31Mg_0) * \
             lambda_31Mg - beam_rate * b_31Mg +beam_rate) *\
-            np.exp(-time * lambda_31Mg)) /\
+            _exp(time, lambda_31Mg, exps)) /\
             (lambda_31Mg - lambda_30Al) -\
-            (np.exp(-time * lambda_30Al) *\
+            (_exp(time, lambda_30Al, exps) *\
             (((n_31Mg_0 * b_31Mg - n_31Mg_0 - n_30Al_0) * lambda_30Al -\
             beam_rate * b_31Mg + beam_rate) *\
             lambda_31Mg + n_30Al_0 * lambda_30Al**2)) /\
@@ -283,7 +293,7 @@ def n_30Al(time, beam_pulse, beam_rate):
 def a_30Al(time, beam_pulse, beam_rate): 
   return e_30Al * lambda_30Al * n_30Al(time, beam_pulse, beam_rate)
 
-def s_30Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_30Al_0, n_30Si_0):
+def s_30Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_30Al_0, n_30Si_0, exps=None):
     return -((((n_31Mg_0 * b_31Al - n_31Mg_0) * b_31Mg * lambda_31Al +\
             (n_31Mg_0 * b_31Mg - n_31Mg_0) * lambda_30Al) *\
             lambda_31Mg**2 +\
@@ -294,7 +304,7 @@ def s_30Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_30Al_0, n_30Si_0):
             lambda_31Mg +\
             (beam_rate * b_31Al * b_31Mg - beam_rate) * lambda_30Al *\
             lambda_31Al) *\
-            np.exp(-time * lambda_31Mg)) /\
+            _exp(time, lambda_31Mg, exps)) /\
             (lambda_31Mg**3 +\
             (-lambda_31Al - lambda_30Al) * lambda_31Mg**2 +\
             lambda_30Al * lambda_31Al * lambda_31Mg) -\
@@ -308,7 +318,7 @@ def s_30Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_30Al_0, n_30Si_0):
             (beam_rate - beam_rate * b_31Al * b_31Mg) * lambda_30Al *\
             lambda_31Al) /\
             (lambda_30Al * lambda_31Al * lambda_31Mg) +\
-            (np.exp(-time * lambda_31Al) *\
+            (_exp(time, lambda_31Al, exps) *\
             ((((n_31Mg_0 * b_31Al - n_31Mg_0) * b_31Mg + n_31Al_0 * b_31Al -\
             n_31Al_0) *\
             lambda_31Al +\
@@ -316,7 +326,7 @@ def s_30Si(time, beam_rate, n_31Mg_0, n_31Al_0, n_30Al_0, n_30Si_0):
             lambda_31Mg +\
             (n_31Al_0 - n_31Al_0 * b_31Al) * lambda_31Al**2)) /\
             (lambda_31Al * lambda_31Mg - lambda_31Al**2) +\
-            (np.exp(-time * lambda_30Al) *\
+            (_exp(time, lambda_30Al, exps) *\
             (((n_31Mg_0 * b_31Mg - n_31Mg_0 - n_30Al_0) * lambda_30Al -\
             beam_rate * b_31Mg + beam_rate) *\
             lambda_31Mg +\
@@ -349,70 +359,118 @@ def n_30Si(time, beam_pulse, beam_rate):
 def a_30Si(time, beam_pulse, beam_rate): 
     return e_30Si * lambda_30Si * n_30Si(time, beam_pulse, beam_rate)
 
+# all isotopes in one pass
+isotopes = ('31Mg', '31Al', '31Si', '31P', '30Al', '30Si')
+
+def decay_chain(time, beam_pulse, beam_rate=1e6):
+    """
+        Number of atoms and activity of every isotope in the decay chain, 
+        evaluated in one pass. The beam on/off masks, the populations at 
+        beam-off and the exponentials are computed once and shared by all 
+        isotopes. 
+        
+        time: array of times (s)
+        beam_pulse: beam on duration (s)
+        beam_rate: implantation rate of 31Mg (1/s)
+        
+        Returns a numpy structured array with the same shape as time and 
+        fields n_<isotope>, a_<isotope> for each of the isotopes, n_total, 
+        and a_total. Ex: out['a_31Mg']
+    """
+    
+    time = np.asarray(time, dtype=float)
+    
+    fields = ['n_'+i for i in isotopes] + ['a_'+i for i in isotopes]
+    out = np.zeros(time.shape, dtype=[(f, float) for f in fields+['n_total', 'a_total']])
+    
+    # populations at beam off
+    n_31Mg_0 = s_31Mg(beam_pulse, beam_rate, 0)
+    n_31Al_0 = s_31Al(beam_pulse, beam_rate, 0, 0)
+    n_31Si_0 = s_31Si(beam_pulse, beam_rate, 0, 0, 0)
+    n_31P_0 = s_31P(beam_pulse, beam_rate, 0, 0, 0, 0)
+    n_30Al_0 = s_30Al(beam_pulse, beam_rate, 0, 0)
+    n_30Si_0 = s_30Si(beam_pulse, beam_rate, 0, 0, 0, 0)
+    
+    # beam on: start from nothing, beam off: start from beam-off populations
+    # negative times are left as zero
+    idx_on = (0 <= time) & (time <= beam_pulse)
+    idx_off = time > beam_pulse
+    
+    for idx, t, rate, n0 in ((idx_on, time[idx_on], beam_rate, (0, )*6), 
+                             (idx_off, time[idx_off]-beam_pulse, 0, 
+                                (n_31Mg_0, n_31Al_0, n_31Si_0, n_31P_0, 
+                                 n_30Al_0, n_30Si_0))):
+        
+        Mg0, Al0, Si0, P0, Al30_0, Si30_0 = n0
+        exps = {lam: np.exp(-t*lam) for lam in (lambda_31Mg, lambda_31Al, 
+                                                lambda_31Si, lambda_30Al)}
+        
+        out['n_31Mg'][idx] = s_31Mg(t, rate, Mg0, exps=exps)
+        out['n_31Al'][idx] = s_31Al(t, rate, Mg0, Al0, exps=exps)
+        out['n_31Si'][idx] = s_31Si(t, rate, Mg0, Al0, Si0, exps=exps)
+        out['n_31P'][idx]  = s_31P(t, rate, Mg0, Al0, Si0, P0, exps=exps)
+        out['n_30Al'][idx] = s_30Al(t, rate, Mg0, Al30_0, exps=exps)
+        out['n_30Si'][idx] = s_30Si(t, rate, Mg0, Al0, Al30_0, Si30_0, exps=exps)
+    
+    # activities
+    for i in isotopes:
+        eff = globals()['e_'+i]
+        lam = globals()['lambda_'+i]
+        out['a_'+i] = eff*lam*out['n_'+i] if eff*lam else 0
+    
+    # totals
+    for i in isotopes:
+        out['n_total'] += out['n_'+i]
+        out['a_total'] += out['a_'+i]
+    
+    return out
+
 # total atoms
 def n_total(time, beam_pulse, beam_rate=1e6):
-    return  n_31Mg(time, beam_pulse, beam_rate) + \
-            n_31Al(time, beam_pulse, beam_rate) + \
-            n_31Si(time, beam_pulse, beam_rate) + \
-            n_31P (time, beam_pulse, beam_rate) + \
-            n_30Al(time, beam_pulse, beam_rate) + \
-            n_30Si(time, beam_pulse, beam_rate);
+    return decay_chain(time, beam_pulse, beam_rate)['n_total']
 
 # fractions of total atoms
+def _fraction(field, time, beam_pulse, beam_rate):
+    chain = decay_chain(time, beam_pulse, beam_rate)
+    return chain[field] / chain[field[0]+'_total']
+
 def fn_31Mg(time, beam_pulse, beam_rate=1e6): 
-    return  n_31Mg(time, beam_pulse, beam_rate) / \
-            n_total(time, beam_pulse, beam_rate)
+    return _fraction('n_31Mg', time, beam_pulse, beam_rate)
 
 def fn_31Al(time, beam_pulse, beam_rate=1e6):
-    return n_31Al(time, beam_pulse, beam_rate) / \
-            n_total(time, beam_pulse, beam_rate)
+    return _fraction('n_31Al', time, beam_pulse, beam_rate)
 
 def fn_31Si(time, beam_pulse, beam_rate=1e6):
-  return n_31Si(time, beam_pulse, beam_rate) / \
-         n_total(time, beam_pulse, beam_rate)
+    return _fraction('n_31Si', time, beam_pulse, beam_rate)
 
 def fn_31P(time, beam_pulse, beam_rate=1e6):
-  return n_31P(time, beam_pulse, beam_rate) / \
-         n_total(time, beam_pulse, beam_rate)
+    return _fraction('n_31P', time, beam_pulse, beam_rate)
 
 def fn_30Al(time, beam_pulse, beam_rate=1e6):
-  return n_30Al(time, beam_pulse, beam_rate) / \
-         n_total(time, beam_pulse, beam_rate)
+    return _fraction('n_30Al', time, beam_pulse, beam_rate)
 
 def fn_30Si(time, beam_pulse, beam_rate=1e6):
-  return n_30Si(time, beam_pulse, beam_rate) / \
-         n_total(time, beam_pulse, beam_rate)
+    return _fraction('n_30Si', time, beam_pulse, beam_rate)
 
 # total activity
 def a_total(time, beam_pulse, beam_rate=1e6):
-  return a_31Mg(time, beam_pulse, beam_rate) + \
-         a_31Al(time, beam_pulse, beam_rate) + \
-         a_31Si(time, beam_pulse, beam_rate) + \
-         a_31P (time, beam_pulse, beam_rate) + \
-         a_30Al(time, beam_pulse, beam_rate) + \
-         a_30Si(time, beam_pulse, beam_rate)
+    return decay_chain(time, beam_pulse, beam_rate)['a_total']
 
 # fractional activities
 def fa_31Mg(time, beam_pulse, beam_rate=1e6):
-  return a_31Mg(time, beam_pulse, beam_rate) / \
-         a_total(time, beam_pulse, beam_rate)
+    return _fraction('a_31Mg', time, beam_pulse, beam_rate)
 
 def fa_31Al(time, beam_pulse, beam_rate=1e6):
-  return a_31Al(time, beam_pulse, beam_rate) / \
-         a_total(time, beam_pulse, beam_rate)
+    return _fraction('a_31Al', time, beam_pulse, beam_rate)
 
 def fa_31Si(time, beam_pulse, beam_rate=1e6):
-  return a_31Si(time, beam_pulse, beam_rate) / \
-         a_total(time, beam_pulse, beam_rate)
+    return _fraction('a_31Si', time, beam_pulse, beam_rate)
 
 def fa_31P(time, beam_pulse, beam_rate=1e6):
-  return a_31P(time, beam_pulse, beam_rate) / \
-         a_total(time, beam_pulse, beam_rate)
+    return _fraction('a_31P', time, beam_pulse, beam_rate)
 
 def fa_30Al(time, beam_pulse, beam_rate=1e6):
-  return a_30Al(time, beam_pulse, beam_rate) / \
-         a_total(time, beam_pulse, beam_rate)
+    return _fraction('a_30Al', time, beam_pulse, beam_rate)
 
 def fa_30Si(time, beam_pulse, beam_rate=1e6):
-  return a_30Si(time, beam_pulse, beam_rate) / \
-         a_total(time, beam_pulse, beam_rate)
+    return _fraction('a_30Si', time, beam_pulse, beam_rate)
@@ -9,11 +9,13 @@ from scipy.optimize import curve_fit
 from tqdm import tqdm
 from bfit.fitting.global_bdata_fitter import global_bdata_fitter
 from bfit.fitting.minuit import minuit
+from bfit.fitting.functions import integration_tol
 import inspect
 
 # ========================================================================== #
 def fit_bdata(data, fn, omit=None, rebin=None, slr_bkgd_corr=None, shared=None, hist_select='',
-              xlims=None, asym_mode='c', fixed=None, minimizer='migrad', **kwargs):
+              xlims=None, asym_mode='c', fixed=None, minimizer='migrad', 
+              coarse_tol=None, nthreads=1, linear=None, **kwargs):
     """
         Fit combined asymetry from bdata.
 
@@ -57,7 +59,24 @@ def fit_bdata(data, fn, omit=None, rebin=None, slr_bkgd_corr=None, shared=None,
                         parameters omitted. Can be a list of lists with one list
                         for each run.
 
-        minimizer       string. One of "migrad", "minos", "trf", "dogbox"
+        minimizer       string. One of "migrad", "minos", "trf", "dogbox", "lm". 
+                        "lm" uses a Levenberg-Marquardt solver on the 
+                        residuals, then migrad and hesse for the errors. 
+
+        coarse_tol:     if not None, minimize first with the integration 
+                        tolerance of any pulsed stretched exponentials set to 
+                        this value, then polish the minimum and get errors at 
+                        full precision. Only used by migrad, minos, and lm. 
+
+        nthreads:       number of threads used to evaluate the data sets in 
+                        shared parameter fitting. 
+
+        linear:         list of booleans indicating if the function is linear 
+                        in the parameter (ex: amplitudes, baselines). If not 
+                        None, minimize first over the nonlinear parameters, 
+                        solving for the linear ones by weighted least squares 
+                        (variable projection). Only used by migrad, minos, 
+                        and lm. 
 
         kwargs:         keyword arguments for curve_fit/minuit.
                         See curve_fit/iminuit docs.
@@ -132,10 +151,11 @@ def fit_bdata(data, fn, omit=None, rebin=None, slr_bkgd_corr=None, shared=None,
                                 asym_mode = asym_mode,
                                 rebin = rebin,
                                 fixed = fixed,
-                                slr_bkgd_corr=slr_bkgd_corr
+                                slr_bkgd_corr=slr_bkgd_corr,
+                                nthreads=nthreads,
                                 )
 
-        g.fit(minimizer=minimizer, **kwargs)
+        g.fit(minimizer=minimizer, coarse_tol=coarse_tol, linear=linear, **kwargs)
         gchi, chis = g.get_chi() # returns global chi, individual chi squared
         pars, stds_l, stds_h, covs = g.get_par()
 
@@ -228,6 +248,8 @@ def fit_bdata(data, fn, omit=None, rebin=None, slr_bkgd_corr=None, shared=None,
                                                 fixed=fix,
                                                 slr_bkgd_corr=bkgd,
                                                 minimizer=minimizer,
+                                                coarse_tol=coarse_tol,
+                                                linear=linear,
                                                 **kwargs)
 
                 # check minuit validity
@@ -298,7 +320,8 @@ def fit_bdata(data, fn, omit=None, rebin=None, slr_bkgd_corr=None, shared=None,
 
 # =========================================================================== #
 def _fit_single(data, fn, omit='', rebin=1, slr_bkgd_corr=True, hist_select='', xlim=None, asym_mode='c',
-               fixed=None, minimizer='migrad', **kwargs):
+               fixed=None, minimizer='migrad', coarse_tol=None, linear=None, 
+               **kwargs):
     """
         Fit combined asymetry from bdata.
 
@@ -331,7 +354,16 @@ def _fit_single(data, fn, omit='', rebin=1, slr_bkgd_corr=True, hist_select='',
                         parameters in order presented, with the fixed
                         parameters omitted.
 
-        minimizer       string. One of "migrad", "minos", "trf", "dogbox"
+        minimizer       string. One of "migrad", "minos", "trf", "dogbox", "lm". 
+                        "lm" uses a Levenberg-Marquardt solver on the 
+                        residuals, then migrad and hesse for the errors. 
+
+        coarse_tol:     if not None, integration tolerance used for a first, 
+                        fast, minimization with migrad or minos
+
+        linear:         if not None, list of booleans, true if the function is 
+                        linear in the parameter. Minimize first with variable 
+                        projection of the linear parameters. 
 
         kwargs:         keyword arguments for curve_fit. See curve_fit docs.
 
@@ -366,21 +398,35 @@ def _fit_single(data, fn, omit='', rebin=1, slr_bkgd_corr=True, hist_select='',
         kwargs['p0'] = np.ones(nargs)
 
     # Fit the function
-    if minimizer in ("migrad", "minos"):
+    if minimizer in ("migrad", "minos", "lm"):
         par, cov, stdl, stdh, chi, m = _fit_single_minuit(fn, x, y, dy, fixed,
                                                           'minos' in minimizer,
+                                                          coarse_tol,
+                                                          do_lm=minimizer == 'lm',
+                                                          linear=linear,
                                                           **kwargs)
     elif minimizer in ('trf', 'dogbox'):
         par, cov, stdl, stdh, chi = _fit_single_curve_fit(fn, x, y, dy, fixed,
                                                           minimizer, **kwargs)
         m = None
+    else:
+        raise RuntimeError("Unrecognized minimizer input '%s'" % minimizer)
 
     return (par, cov, stdl, stdh, chi, m)
 
 # =========================================================================== #
-def _fit_single_minuit(fn, x, y, dy, fixed, do_minos=True, **kwargs):
+def _fit_single_minuit(fn, x, y, dy, fixed, do_minos=True, coarse_tol=None, 
+                       do_lm=False, linear=None, **kwargs):
     """
         Fit data with minuit minimizer
+        
+        coarse_tol: if not None, run migrad with this integration tolerance 
+                    before polishing at full precision
+        do_lm:      if true, minimize the residuals with Levenberg-Marquardt 
+                    first, then polish with migrad
+        linear:     if not None, list of booleans, true if linear parameter. 
+                    Minimize first with variable projection, then polish 
+                    with migrad
     """
 
     # set up minuit inputs
@@ -401,7 +447,30 @@ def _fit_single_minuit(fn, x, y, dy, fixed, do_minos=True, **kwargs):
         kwargs_minuit['name'] = name
 
     m = minuit(fn, x, y, dy, **kwargs_minuit)
-    m.migrad()
+
+    # fast approach to the minimum
+    if linear is not None:
+        with integration_tol(fn, coarse_tol):
+            m.project(linear)
+    
+    if do_lm:
+        with integration_tol(fn, coarse_tol):
+            m.least_squares()
+    
+    if do_lm or linear is not None:
+        
+        # already at the minimum: polish without the initial hessian
+        strategy = m.strategy.strategy
+        m.strategy = 0
+        m.migrad()
+        m.strategy = strategy
+    
+    else:
+        if coarse_tol is not None:
+            with integration_tol(fn, coarse_tol):
+                m.migrad()
+
+        m.migrad()
 
     # get errors
     if do_minos:
@@ -464,6 +533,10 @@ def _fit_single_curve_fit(fn, x, y, dy, fixed, minimizer, **kwargs):
         # modify fiting inputs
         if bounds is not None:  kwargs['bounds'] = bounds
 
+    # analytic jacobian
+    if hasattr(fn, 'jac') and 'jac' not in kwargs:
+        kwargs['jac'] = lambda x, *par: np.transpose(fn.jac(x, *par))
+
     # do the fit
     par, cov = curve_fit(fn, x, y, sigma=dy, absolute_sigma=True,
                         method=minimizer, **kwargs)
@@ -531,6 +604,15 @@ def _get_fixed_values(fixed, fn, p0, bounds=None):
         args_fixed[~fixed] = args
         return fn_orig(x, *args_fixed)
 
+    # jacobian of the free parameters
+    if hasattr(fn_orig, 'jac'):
+        def jac(x, *args):
+            args_fixed = np.zeros(npar_orig)
+            args_fixed[fixed] = p0_orig[fixed]
+            args_fixed[~fixed] = args
+            return fn_orig.jac(x, *args_fixed)[~fixed]
+        fn.jac = jac
+
     # make new p0
     p0 = np.asarray(p0_orig)[~fixed]
 
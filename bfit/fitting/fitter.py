@@ -3,6 +3,7 @@
 # Aug 2018
 
 import bfit.fitting.functions as fns
+import bfit.fitting.functions_jax as fns_jax
 from bfit.fitting.decay_31mg import fa_31Mg
 from bfit.fitting.gen_init_par import gen_init_par
 from functools import partial
@@ -20,6 +21,9 @@ class fitter(object):
     # needed to tell users what routine this is
     __name__ = 'base'
     
+    # function library: 'numpy' or 'jax' (jit-compiled, autodiff jacobians)
+    backend = 'numpy'
+    
     # Define possible fit functions for given run modes
     function_names = {  '20':('Exp', 'Bi Exp', 'Str Exp'), 
                         '2h':('Exp', 'Bi Exp', 'Str Exp'), 
@@ -314,6 +318,13 @@ class fitter(object):
         # get names
         names_orig = self.param_names[fn_name]
         
+        # one amplitude for each of the 2I quadrupole-split peaks
+        if fn_name == 'QuadLorentz':
+            npeaks = int(2*self.spin[self.probe_species])
+            names_orig = names_orig[:5] + \
+                         tuple('amp%d' % i for i in range(npeaks)) + \
+                         names_orig[-2:]
+        
         # special case of one component
         if ncomp == 1: 
             names = names_orig
@@ -344,10 +355,12 @@ class fitter(object):
         
     # ======================================================================= #
     def gen_init_par(self, fn_name, ncomp, bdataobj, asym_mode='combined'):
-        return gen_init_par(fn_name, ncomp, bdataobj, asym_mode)
+        return gen_init_par(fn_name, ncomp, bdataobj, asym_mode, 
+                            spin=self.spin[self.probe_species])
         
     # ======================================================================= #
-    def get_fn(self, fn_name, ncomp=1, pulse_len=-1, lifetime=-1, constr=None):
+    def get_fn(self, fn_name, ncomp=1, pulse_len=-1, lifetime=-1, constr=None, 
+               backend=None):
         """
             Get the fitting function used.
             
@@ -355,35 +368,46 @@ class fitter(object):
                 ncomp: number of components, ex if 2, then return exp+exp
                 pulse_len: duration of beam on in s
                 lifetime: lifetime of probe in s
+                backend: function library, 'numpy' or 'jax'. If None, use 
+                         self.backend
             
-            Returns python function(x, *pars)
+            Returns python function(x, *pars). Can be pickled if there 
+            are no constraints.
         """
         
+        # function library
+        if backend is None:
+            backend = self.backend
+        
+        if backend == 'numpy':
+            lib = fns
+        elif backend == 'jax':
+            lib = fns_jax
+        else:
+            raise RuntimeError('Function backend "%s" not found.' % backend)
+        
         # set fitting function
         if fn_name == 'Lorentzian':
-            fn =  fns.lorentzian
+            fn =  lib.lorentzian
             self.mode=1
         elif fn_name == 'BiLorentzian':
-            fn =  fns.bilorentzian
+            fn =  lib.bilorentzian
             self.mode=1
         elif fn_name == 'QuadLorentz':
-            fn =  lambda freq, nu_0, nu_q, eta, theta, phi, \
-            		amp0, amp1, amp2, amp3, fwhm: \
-                   	fns.quadlorentzian(freq, nu_0, nu_q, eta, theta, phi, \
-		            		amp0, amp1, amp2, amp3, \
-                		   	fwhm, fwhm, fwhm, fwhm, \
-                		   	I=self.spin[self.probe_species])
+            fn =  lib.quadlorentzian_fixed_spin(I=self.spin[self.probe_species])
             self.mode=1
         elif fn_name == 'Gaussian':
-            fn =  fns.gaussian
+            fn =  lib.gaussian
             self.mode=1
         elif fn_name == 'Exp':
-            fn =  fns.pulsed_exp(lifetime, pulse_len)
+            fn =  lib.pulsed_exp(lifetime, pulse_len)
             self.mode=2
         elif fn_name == 'Bi Exp':
-            fn =  fns.pulsed_biexp(lifetime, pulse_len)
+            fn =  lib.pulsed_biexp(lifetime, pulse_len)
             self.mode=2
         elif fn_name == 'Str Exp':
+            
+            # no jax version: numerical integration
             fn =  fns.pulsed_strexp(lifetime, pulse_len)
             self.mode=2
         else:
@@ -397,15 +421,15 @@ class fitter(object):
         fnlist = [fn]*ncomp
         
         if self.mode == 1:
-            fnlist.append(lambda x, b: b)
+            fnlist.append(lib.baseline)
             
-        fn = fns.get_fn_superpos(fnlist)
+        fn = lib.get_fn_superpos(fnlist)
 
         # set parameter constraints
         if constr and constr is not None:
             par_names_orig = self.gen_param_names(fn_name, ncomp)
             par_names_constr = self.gen_param_names(fn_name, ncomp, constr)
-            fn = fns.get_constrained_fn(fn, par_names_orig, par_names_constr, constr)
+            fn = lib.get_constrained_fn(fn, par_names_orig, par_names_constr, constr)
             
         return fn
         
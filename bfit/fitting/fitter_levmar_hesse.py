@@ -0,0 +1,27 @@
+# Fitter functions using Levenberg-Marquardt, then migrad and hesse for errors
+
+from bfit.fitting.fit_bdata import fit_bdata
+from bfit.fitting.fitter import fitter as fit_base
+
+class fitter(fit_base):
+    
+    __name__ = 'levmar (hesse)'
+    
+    def _do_fit(self, data, fn, omit=None, rebin=None, shared=None, slr_bkgd_corr=None, hist_select='', 
+                xlims=None, asym_mode='c', fixed=None, parnames=None, **kwargs):
+        """Inputs match fit_bdata"""
+        
+        return fit_bdata(data, 
+                         fn, 
+                         omit=omit, 
+                         rebin=rebin, 
+                         shared=shared, 
+                         slr_bkgd_corr=slr_bkgd_corr,
+                         hist_select=hist_select, 
+                         xlims=xlims, 
+                         asym_mode=asym_mode, 
+                         fixed=fixed, 
+                         minimizer='lm', 
+                         name=parnames, 
+                         **kwargs)
+            
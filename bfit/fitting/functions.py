@@ -2,7 +2,14 @@
 # Derek Fujimoto
 # June 2018
 from bfit.fitting.integrator import PulsedFns
+from contextlib import contextmanager
+from collections import OrderedDict
 import numpy as np
+import jax
+import jax.numpy as jnp
+
+jax.config.update('jax_platform_name', 'cpu')
+jax.config.update("jax_enable_x64", True)
 
 # =========================================================================== #
 class code_wrapper(object):
@@ -18,32 +25,78 @@ class code_wrapper(object):
         except KeyError:
             return getattr(self.obj, name)
 
+class code_names(object):
+    """Imitate a code object with the given input names"""
+    def __init__(self, names):
+        self.co_varnames = tuple(names)
+        self.co_argcount = len(self.co_varnames)
+
 # =========================================================================== #
 class decay_corrected_fn(object):
     """
         For applying the decay correction in the case of multiple daughters, 
         for example, Mg31
+        
+        The correction doesn't depend on the fit parameters, so it is cached 
+        for each (x, beam_pulse, beam_rate) input and only the polarization 
+        function is evaluated on repeated calls. 
     """
+    
+    # number of correction curves to cache (ex: one per run in a global fit)
+    cache_size = 64
+    
     def __init__(self, fn_decay, fn_polarization, beam_pulse, beam_rate=1e6):
         
         self.f1 = fn_decay
         self.f2 = fn_polarization
         self.beam_pulse = beam_pulse
         self.beam_rate = beam_rate
+        self._cache = OrderedDict()
         
     def __call__(self, x, *par):
-        return self.f1(x, beam_pulse=self.beam_pulse, beam_rate=self.beam_rate) \
-             * self.f2(x, *par)
+        return self.get_correction(x) * self.f2(x, *par)
         
     def __getattr__(self, name):
         if name == '__code__':
             return self.f2.__code__
+        elif name == 'jac' and hasattr(self.f2, 'jac'):
+            return self._jac
         else:
             try:
                 return self.__dict__[name]
             except KeyError as err:
                 raise AttributeError(err) from None
-
+    
+    def __getstate__(self):
+        """Don't pickle the cache contents"""
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+    
+    def _jac(self, x, *par):
+        return self.get_correction(x) * self.f2.jac(x, *par)
+    
+    def get_correction(self, x):
+        """
+            Get the decay correction f1(x, beam_pulse, beam_rate), from the 
+            cache if possible. Don't modify the output. 
+        """
+        
+        x = np.asarray(x, dtype=float)
+        key = (self.beam_pulse, self.beam_rate, x.shape, x.tobytes())
+        
+        try:
+            value = self._cache[key]
+        except KeyError:
+            value = self.f1(x, beam_pulse=self.beam_pulse, beam_rate=self.beam_rate)
+            self._cache[key] = value
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+            
+        return value
+            
 # =========================================================================== #
 def get_constrained_fn(fn, pname_orig, pname_constr, constr):
     """
@@ -54,42 +107,182 @@ def get_constrained_fn(fn, pname_orig, pname_constr, constr):
         pname_constr: list of str, parameter names after constraining
         constr: dict {defined (str): [fn (handle), pname (list of str)]}
     """
+    return constrained_fn(fn, pname_orig, pname_constr, constr)
+    
+class constrained_fn(object):
+    """
+        Function with some inputs defined by constraint equations of the new 
+        parameters. 
+        
+        The mapping from the new parameters to the inputs of the original 
+        function is precompiled as lists of (to, from) index pairs, so a call 
+        only copies the free parameters and calls the constraints directly. 
+        jax is only used for the jacobian of the constraints (with central 
+        differences if the constraints can't be traced by jax). 
+    """
     
-    # par input order is that of pname_constr
-    # reshuffle order to match panme_orig so it can be passed to fn
-    inpt = []
-    for pname in pname_orig:
-        if pname in pname_constr:
-            inpt.append(pname_constr.index(pname))
-        elif pname in constr.keys():
+    def __init__(self, fn, pname_orig, pname_constr, constr):
+        """
+            fn: function handle, inputs in the order of pname_orig
+            pname_orig: list of str, parameter names
+            pname_constr: list of str, parameter names after constraining
+            constr: dict {defined (str): [fn (handle), pname (list of str)]}
+        """
+        
+        self.fn = fn
+        self.npar = len(pname_orig)
+        
+        # par input order is that of pname_constr
+        # reshuffle order to match panme_orig so it can be passed to fn
+        free_to = []        # index in pname_orig
+        free_from = []      # index in pname_constr
+        constr_to = []      # index in pname_orig
+        self.constraints = []   # (fn, index in pname_constr)
+        
+        for i, pname in enumerate(pname_orig):
+            if pname in pname_constr:
+                free_to.append(i)
+                free_from.append(pname_constr.index(pname))
+            elif pname in constr.keys():
+                c_fn, c_par = constr[pname]
+                constr_to.append(i)
+                self.constraints.append((c_fn, tuple(pname_constr.index(c) for c in c_par)))
+            else:
+                raise RuntimeError('Parameter {param} not'.format(param=pname)+\
+                                   ' found in pname_constr or constr')
+        
+        self.free_to = np.array(free_to, dtype=int)
+        self.free_from = np.array(free_from, dtype=int)
+        self.constr_to = np.array(constr_to, dtype=int)
+        self._free_map = tuple(zip(free_to, free_from))
+        self._constr_map = tuple(zip(constr_to, self.constraints))
+        
+        # jacobian of the constraints
+        if self.constraints:
+            self._evaluate_jac = jax.jit(jax.jacfwd(self._evaluate_jax))
+        else:
+            self._evaluate_jac = None
+    
+    def __call__(self, x, *pars):
+        
+        inputs = [0.]*self.npar
+        
+        for i, j in self._free_map:
+            inputs[i] = pars[j]
+        
+        # float: keep jax.numpy constraint output from making fn run in jax
+        for i, (c_fn, idx) in self._constr_map:
+            inputs[i] = float(c_fn(*[pars[j] for j in idx]))
             
-            c_fn, c_par = constr[pname]
-            c_inpt = [pname_constr.index(c) for c in c_par]
-            inpt.append((c_fn, c_inpt))
+        return self.fn(x, *inputs)
+        
+    def __getattr__(self, name):
+        if name == '__code__':
+            return code_wrapper(self.__call__.__code__)
+        elif name == 'jac' and hasattr(self.fn, 'jac'):
+            return self._jac
+        else:
+            try:
+                return self.__dict__[name]
+            except KeyError as err:
+                raise AttributeError(err) from None
+    
+    def _jac(self, x, *pars):
+        """
+            Jacobian with respect to the new parameters from the chain rule: 
+            d fn/d par = d fn/d input * d input/d par
+        """
+        
+        pars = np.asarray(pars, dtype=float)
+        
+        inputs = np.empty(self.npar)
+        inputs[self.free_to] = pars[self.free_from]
+        
+        if self._evaluate_jac is None:
+            dconstr = None
         else:
-            raise RuntimeError('Parameter {param} not'.format(param=pname)+\
-                               ' found in pname_constr or constr')
+            inputs[self.constr_to] = self._evaluate_py(pars)
+            try:
+                dconstr = np.asarray(self._evaluate_jac(pars))
+            
+            # constraints are not jax-traceable: central differences
+            except TypeError:
+                self._evaluate_jac = self._evaluate_jac_py
+                dconstr = self._evaluate_jac(pars)
+        
+        jac_in = np.asarray(self.fn.jac(x, *inputs))
+        
+        jac = np.zeros((len(pars), ) + jac_in.shape[1:])
+        np.add.at(jac, self.free_from, jac_in[self.free_to])
+        
+        if dconstr is not None:
+            jac += np.tensordot(dconstr, jac_in[self.constr_to], axes=(0, 0))
+        
+        return jac
+    
+    def _evaluate_jax(self, pars):
+        """Evaluate all constraints, returns array with values in order of constr_to"""
+        return jnp.stack([jnp.asarray(c_fn(*[pars[i] for i in idx]), dtype=float) 
+                          for c_fn, idx in self.constraints])
+    
+    def _evaluate_py(self, pars):
+        """Evaluate all constraints without jax"""
+        return np.array([c_fn(*[pars[j] for j in idx]) for c_fn, idx in self.constraints], 
+                        dtype=float)
     
-    # new fit function with input order matching that of pname_constr
-    def new_fn(x, *pars):
-        pars = np.asarray(pars)
-        new_inpt = [i[0](*pars[i[1]]) if type(i) is tuple else pars[i] for i in inpt]
-        return fn(x, *new_inpt)
+    def _evaluate_jac_py(self, pars, step=1e-6):
+        """Jacobian of all constraints without jax, shape (nconstr, npar)"""
         
-    return new_fn
+        h = step*np.maximum(np.abs(pars), 1)
+        jac = np.empty((len(self.constraints), len(pars)))
+        for i in range(len(pars)):
+            dp = np.zeros(len(pars))
+            dp[i] = h[i]
+            jac[:, i] = (self._evaluate_py(pars+dp)-self._evaluate_py(pars-dp))/(2*h[i])
+        return jac
 
 # =========================================================================== #
 # TYPE 1 FUNCTIONS
 # =========================================================================== #
+# Analytic jacobians with respect to the parameters are set as the jac 
+# attribute of each function: fn.jac(freq, *par) has shape (npar, len(freq))
+
 def lorentzian(freq, peak, fwhm, amp):
     return -amp*np.square(0.5*fwhm)/(np.square(freq-peak)+np.square(0.5*fwhm))
 
+def lorentzian_jac(freq, peak, fwhm, amp):
+    hwhm2 = np.square(0.5*fwhm)
+    dx = freq-peak
+    den = np.square(dx)+hwhm2
+    shape = np.broadcast(freq, peak, fwhm, amp).shape
+    return np.array([np.broadcast_to(a, shape) for a in (
+                     -2*amp*hwhm2*dx/np.square(den), 
+                     -amp*fwhm*np.square(dx)/(2*np.square(den)), 
+                     -hwhm2/den)])
+lorentzian.jac = lorentzian_jac
+
 def bilorentzian(freq, peak, fwhmA, ampA, fwhmB, ampB):
     return lorentzian(freq, peak, fwhmA, ampA) + lorentzian(freq, peak, fwhmB, ampB)
     
+def bilorentzian_jac(freq, peak, fwhmA, ampA, fwhmB, ampB):
+    jA = lorentzian_jac(freq, peak, fwhmA, ampA)
+    jB = lorentzian_jac(freq, peak, fwhmB, ampB)
+    return np.array([jA[0]+jB[0], jA[1], jA[2], jB[1], jB[2]])
+bilorentzian.jac = bilorentzian_jac
+    
 def gaussian(freq, mean, sigma, amp):
     return -amp*np.exp(-np.square((freq-mean)/sigma)/2)
 
+def gaussian_jac(freq, mean, sigma, amp):
+    z = (freq-mean)/sigma
+    g = -np.exp(-np.square(z)/2)
+    shape = np.broadcast(freq, mean, sigma, amp).shape
+    return np.array([np.broadcast_to(a, shape) for a in (
+                     amp*g*z/sigma, 
+                     amp*g*np.square(z)/sigma, 
+                     g)])
+gaussian.jac = gaussian_jac
+
 def quadlorentzian(freq, nu_0, nu_q, eta, theta, phi, 
                    amp0, amp1, amp2, amp3, 
                    fwhm0, fwhm1, fwhm2, fwhm3, I):
@@ -102,31 +295,156 @@ def quadlorentzian(freq, nu_0, nu_q, eta, theta, phi,
     
         amp: amplitudes of each of the peaks
         fwhm: FWHM of each of the peaks
+        
+        Four peaks: I = 2. See quadlorentzian_peaks for any spin. 
     """
     
-    # get the peak locations
-    peaks = [qp_nu(nu_0, nu_q, eta, theta, phi, I, m) for m in np.arange(-(I-1), I+1, 1)]
+    return np.sum(quadlorentzian_peaks(freq, nu_0, nu_q, eta, theta, phi, 
+                                       [amp0, amp1, amp2, amp3], 
+                                       [fwhm0, fwhm1, fwhm2, fwhm3], I), axis=0)
+
+def quadlorentzian_jac(freq, nu_0, nu_q, eta, theta, phi, 
+                       amp0, amp1, amp2, amp3, 
+                       fwhm0, fwhm1, fwhm2, fwhm3, I):
+    """
+        Jacobian of quadlorentzian, the derivative with respect to I is zero. 
+    """
+    
+    j = quadlorentzian_peaks_jac(freq, nu_0, nu_q, eta, theta, phi, 
+                                 [amp0, amp1, amp2, amp3], 
+                                 [fwhm0, fwhm1, fwhm2, fwhm3], I)
+    return np.concatenate((j, np.zeros((1, )+j.shape[1:])))
+quadlorentzian.jac = quadlorentzian_jac
+
+def quadlorentzian_peaks(freq, nu_0, nu_q, eta, theta, phi, amp, fwhm, I):
+    """
+        Each of the 2I quadrupole-split lorentzians, computed together. 
+        
+        amp: amplitudes of each of the peaks, len 2I
+        fwhm: FWHM of each of the peaks, len 2I or scalar
+        I: spin quantum number
+        
+        other inputs as in quadlorentzian
+        
+        returns array of shape (2I, len(freq))
+    """
     
-    # get each lorentzian
-    lor0 = lorentzian(freq, peaks[0], fwhm0, amp0)
-    lor1 = lorentzian(freq, peaks[1], fwhm1, amp1)
-    lor2 = lorentzian(freq, peaks[2], fwhm2, amp2)
-    lor3 = lorentzian(freq, peaks[3], fwhm3, amp3)   
+    freq = np.asarray(freq)
+    m = _qp_m(I)
+    shape = (len(m), ) + (1, )*freq.ndim
     
-    return lor0+lor1+lor2+lor3
+    amp = _qp_per_peak(amp, m, 'amp')
+    fwhm = _qp_per_peak(fwhm, m, 'fwhm')
+    
+    peaks = qp_nu(nu_0, nu_q, eta, theta, phi, I, m)
+    return lorentzian(freq, peaks.reshape(shape), fwhm.reshape(shape), 
+                      amp.reshape(shape))
+
+def quadlorentzian_peaks_jac(freq, nu_0, nu_q, eta, theta, phi, amp, fwhm, I):
+    """
+        Jacobian of the sum of quadlorentzian_peaks with respect to 
+        (nu_0, nu_q, eta, theta, phi, *amp, *fwhm). 
+        
+        returns array of shape (5+4I, len(freq))
+    """
+    
+    freq = np.asarray(freq)
+    m = _qp_m(I)
+    shape = (len(m), ) + (1, )*freq.ndim
+    
+    amp = _qp_per_peak(amp, m, 'amp')
+    fwhm = _qp_per_peak(fwhm, m, 'fwhm')
+    
+    # peak locations and their derivatives (5, npeaks)
+    peaks = qp_nu(nu_0, nu_q, eta, theta, phi, I, m)
+    dpeaks = qp_nu_jac(nu_0, nu_q, eta, theta, phi, I, m)
+    
+    # each lorentzian: (3, npeaks, len(freq))
+    jlor = lorentzian_jac(freq, peaks.reshape(shape), fwhm.reshape(shape), 
+                          amp.reshape(shape))
+    
+    # chain rule for the peak locations
+    jpeaks = np.sum(dpeaks.reshape(dpeaks.shape + (1, )*freq.ndim)*jlor[0], axis=1)
+    
+    return np.concatenate((jpeaks, jlor[2], jlor[1]))
+    
+def _qp_m(I):
+    """Magnetic sublevels m for each of the 2I m -> m - 1 transitions"""
+    return np.arange(-(I-1), I+1, 1)
+    
+def _qp_per_peak(value, m, name):
+    """Broadcast value to one per peak, with a useful error"""
+    try:
+        return np.broadcast_to(np.asarray(value, dtype=float), m.shape)
+    except ValueError:
+        raise RuntimeError('Need one %s for each of the %d peaks' % (name, len(m))) from None
+    
+class quadlorentzian_fixed_spin(object):
+    """
+        quadlorentzian for a fixed spin I, with the same FWHM for all peaks. 
+        
+        Parameters: (nu_0, nu_q, eta, theta, phi, amp0, amp1, ..., fwhm), with 
+        one amplitude for each of the 2I peaks.
+    """
+    
+    def __init__(self, I):
+        """
+            I: spin quantum number
+        """
+        self.I = I
+        self.npeaks = len(_qp_m(I))
+        
+    def __call__(self, freq, nu_0, nu_q, eta, theta, phi, *amp_fwhm):
+        return np.sum(quadlorentzian_peaks(freq, nu_0, nu_q, eta, theta, phi, 
+                                           amp_fwhm[:-1], amp_fwhm[-1], self.I), 
+                      axis=0)
+    
+    def jac(self, freq, nu_0, nu_q, eta, theta, phi, *amp_fwhm):
+        """Jacobian with respect to the parameters, shape (npar, len(freq))"""
+        j = quadlorentzian_peaks_jac(freq, nu_0, nu_q, eta, theta, phi, 
+                                     amp_fwhm[:-1], amp_fwhm[-1], self.I)
+        n = 5+self.npeaks
+        return np.concatenate((j[:n], np.sum(j[n:], axis=0, keepdims=True)))
+    
+    def __getattr__(self, name):
+        if name == '__code__':
+            return code_names(('freq', 'nu_0', 'nu_q', 'eta', 'theta', 'phi') + \
+                              tuple('amp%d' % i for i in range(self.npeaks)) + \
+                              ('fwhm', ))
+        else:
+            try:
+                return self.__dict__[name]
+            except KeyError as err:
+                raise AttributeError(err) from None
+
+def baseline(freq, b):
+    return b
+
+def baseline_jac(freq, b):
+    return np.ones((1, )+np.shape(freq))
+baseline.jac = baseline_jac
     
 # =========================================================================== #
 # TYPE 2 PULSED FUNCTIONS 
 # =========================================================================== #
 class pulsed(object):
-    """Pulsed function base class"""
+    """
+        Pulsed function base class
+        
+        Optionally keeps a least-recently-used cache of the pulsed integrals, 
+        keyed by the nonlinear parameters and the contents of the time array. 
+        Repeated evaluation on identical inputs (ex: HESSE, MINOS, drawing) 
+        then returns without integrating. 
+    """
     
-    def __init__(self, lifetime, pulse_len):
+    def __init__(self, lifetime, pulse_len, cache_size=0):
         """
             lifetime: probe lifetime in s
             pulse_len: length of pulse in s
+            cache_size: maximum number of results to cache. If 0, don't cache.
         """
         self.pulser = PulsedFns(lifetime, pulse_len)
+        self._init_cache(cache_size)
     
     def __call__(self):pass
     
@@ -138,19 +456,197 @@ class pulsed(object):
                 return self.__dict__[name]
             except KeyError as err:
                 raise AttributeError(err) from None
+    
+    def __getstate__(self):
+        """Don't pickle the cache contents"""
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+    
+    def _init_cache(self, cache_size):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    def cache_clear(self):
+        """Empty the cache and reset the hit/miss counters"""
+        self._init_cache(self.cache_size)
+    
+    def _pulse(self, name, time, *par):
+        """
+            Evaluate pulser method name (ex: "exp", "str_exp"), using the cache 
+            if enabled. Returned arrays are shared with the cache: don't modify. 
+        """
+        
+        if not self.cache_size:
+            return getattr(self.pulser, name)(time, *par)
+        
+        time = np.asarray(time, dtype=float)
+        key = (name, par, self.pulser.integration_tol, self.pulser.table_tol, 
+               time.shape, time.tobytes())
+        
+        try:
+            value = self._cache[key]
+        except KeyError:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return value
+        
+        value = getattr(self.pulser, name)(time, *par)
+        self._cache[key] = value
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        
+        return value
             
 class pulsed_exp(pulsed):
     def __call__(self, time, lambda_s, amp):
-        return amp*self.pulser.exp(time, lambda_s)
-
+        return amp*self._pulse('exp', time, lambda_s)
+    
+    def jac(self, time, lambda_s, amp):
+        """Jacobian with respect to the parameters, shape (npar, len(time))"""
+        f, df = self.pulser.exp_grad(time, lambda_s)
+        return np.array([amp*df, f])
+        
 class pulsed_biexp(pulsed):
     def __call__(self, time, lambda_s, lambdab_s, fracb, amp):
-        return amp*((1-fracb)*  self.pulser.exp(time, lambda_s) + \
-                    fracb*      self.pulser.exp(time, lambdab_s))
+        return amp*((1-fracb)*  self._pulse('exp', time, lambda_s) + \
+                    fracb*      self._pulse('exp', time, lambdab_s))
+    
+    def jac(self, time, lambda_s, lambdab_s, fracb, amp):
+        """Jacobian with respect to the parameters, shape (npar, len(time))"""
+        fa, dfa = self.pulser.exp_grad(time, lambda_s)
+        fb, dfb = self.pulser.exp_grad(time, lambdab_s)
+        return np.array([amp*(1-fracb)*dfa, 
+                         amp*fracb*dfb, 
+                         amp*(fb-fa), 
+                         (1-fracb)*fa + fracb*fb])
         
 class pulsed_strexp(pulsed):
+    
+    def __init__(self, lifetime, pulse_len, table_tol=0, integration_tol=1e-6, 
+                 cache_size=0):
+        """
+            lifetime: probe lifetime in s
+            pulse_len: length of pulse in s
+            table_tol: if > 0, interpolate the integral from a table built once 
+                       per (lambda_s, beta), with this absolute error 
+                       tolerance. Else integrate each time bin exactly. 
+            integration_tol: absolute error tolerance of the numerical 
+                       integration
+            cache_size: maximum number of results to cache. If 0, don't cache.
+        """
+        self.pulser = PulsedFns(lifetime, pulse_len, table_tol, 
+                                integration_tol=integration_tol)
+        self._init_cache(cache_size)
+        
     def __call__(self, time, lambda_s, beta, amp):
-        return amp*self.pulser.str_exp(time, lambda_s, beta)
+        return amp*self._pulse('str_exp', time, lambda_s, beta)
+    
+    def jac(self, time, lambda_s, beta, amp):
+        """Jacobian with respect to the parameters, shape (npar, len(time))"""
+        f, dlambda, dbeta = self.pulser.str_exp_grad(time, lambda_s, beta)
+        return np.array([amp*dlambda, amp*dbeta, f])
+
+class pulsed_conv(object):
+    """
+        Pulsed version of an arbitrary relaxation function, f(t, *par). 
+        
+        The beam-on/beam-off convolution is the difference of the cumulative 
+        integral G(u) = int_0^u exp(-u'/lifetime) f(u') du' at t and 
+        max(t-pulse_len, 0). G is calculated in O(npts) by summing a 
+        3-point Gauss-Legendre quadrature over each interval of a grid up to 
+        max(t), then interpolated with cubic Hermite polynomials using the 
+        exact integrand as the slope. The grid is graded as u ~ k^3 so that 
+        fast relaxation and non-analytic behaviour at t = 0 (ex: stretched 
+        exponentials) are resolved. Before the beam is delivered (t <= 0) 
+        the output is the t -> 0 limit, f(0).
+    """
+    
+    # Gauss-Legendre nodes and weights on [0, 1]
+    _gl_nodes = 0.5 + 0.5*np.array([-np.sqrt(0.6), 0, np.sqrt(0.6)])
+    _gl_weights = np.array([5, 8, 5])/18
+    
+    def __init__(self, fn, lifetime, pulse_len, npts=2000):
+        """
+            fn: relaxation function handle, f(t, *par), vectorized in t
+            lifetime: probe lifetime in s
+            pulse_len: length of pulse in s
+            npts: number of grid points used in the integration
+        """
+        self.fn = fn
+        self.lifetime = lifetime
+        self.pulse_len = pulse_len
+        self.npts = max(int(npts), 2)
+        
+    def __call__(self, time, *par):
+        
+        time = np.asarray(time, dtype=float)
+        life = self.lifetime
+        pulse_len = self.pulse_len
+        
+        # no beam delivered yet at t <= 0 (norm = 0): use the t -> 0 limit, f(0)
+        out = np.empty(time.shape)
+        pos = time > 0
+        if not np.all(pos):
+            out[~pos] = np.broadcast_to(self.fn(np.zeros(1), *par), (1, ))
+            time = time[pos]
+        
+        if time.size == 0:
+            return out[()]
+        
+        # integration grid
+        u = np.max(time) * np.linspace(0, 1, self.npts)**3
+        h = np.diff(u)
+        
+        # integrand on grid and at quadrature points
+        x = np.concatenate((u, (u[:-1, None] + h[:, None]*self._gl_nodes).ravel()))
+        g = np.exp(-x/life)*np.broadcast_to(self.fn(x, *par), x.shape)
+        
+        g_quad = g[self.npts:].reshape(-1, 3)
+        g = g[:self.npts]
+        
+        # cumulative integral
+        G = np.zeros(self.npts)
+        np.cumsum(h*(g_quad @ self._gl_weights), out=G[1:])
+        
+        # normalization of the beam-on integral over implantation times
+        t_start = np.clip(time-pulse_len, 0, None)
+        norm = life*np.exp(-t_start/life)*-np.expm1(-(time-t_start)/life)
+        
+        out[pos] = (self._interp(time, u, G, g) - self._interp(t_start, u, G, g)) / norm
+        return out[()]
+        
+    def __getattr__(self, name):
+        if name == '__code__':
+            return self.fn.__code__
+        else:
+            try:
+                return self.__dict__[name]
+            except KeyError as err:
+                raise AttributeError(err) from None
+    
+    @staticmethod
+    def _interp(x, xp, yp, dyp):
+        """
+            Cubic Hermite interpolation
+            
+            x: points at which to interpolate
+            xp: grid, sorted ascending
+            yp: values on grid
+            dyp: derivative of yp on grid
+        """
+        
+        i = np.clip(np.searchsorted(xp, x, side='right')-1, 0, len(xp)-2)
+        h = xp[i+1]-xp[i]
+        s = (x-xp[i])/h
+        s1 = 1-s
+        
+        return  (1+2*s)*s1*s1*yp[i] + s*s1*s1*h*dyp[i] + \
+                s*s*(3-2*s)*yp[i+1] - s*s*s1*h*dyp[i+1]
 
 # =========================================================================== #
 # HELPER FUNCTIONS
@@ -168,12 +664,154 @@ def get_fn_superpos(fn_handles):
         return fn_handle
     """
     
-    npars = np.cumsum([0]+[len(f.__code__.co_varnames)-1 for f in fn_handles])
+    return fn_superpos(fn_handles)
 
-    # make function
-    def fn(x, *pars):
-        return sum(f(x, *pars[l:h]) for f, l, h in zip(fn_handles, npars[:-1], npars[1:]))
-    return fn
+class fn_superpos(object):
+    """
+        Superposition of a number of functions. Unlike a closure, this can be 
+        pickled if the component functions can.
+        
+        Consecutive copies of the same function are evaluated together in a 
+        single call if the function broadcasts over its parameters (see 
+        broadcastable), with the parameters as arrays of shape (ncomp, 1). 
+    """
+    
+    def __init__(self, fn_handles):
+        """
+            fn_handles: list of function handles that should be superimposed
+        """
+        self.fn_handles = fn_handles
+        self.npars = np.cumsum([0]+[len(f.__code__.co_varnames)-1 for f in fn_handles])
+        
+        # group consecutive copies of the same function: (fn, low, high, ncomp)
+        self.groups = []
+        for i, f in enumerate(fn_handles):
+            
+            lo, hi = self.npars[i], self.npars[i+1]
+            
+            if self.groups and self.groups[-1][0] is f and self.broadcastable(f):
+                g = self.groups[-1]
+                self.groups[-1] = (f, g[1], hi, g[3]+1)
+            else:
+                self.groups.append((f, lo, hi, 1))
+        
+    def __call__(self, x, *pars):
+        
+        out = 0
+        for f, lo, hi, ncomp in self.groups:
+            
+            # single function
+            if ncomp == 1:
+                out = out + f(x, *pars[lo:hi])
+                
+            # fused components
+            else:
+                p = np.array(pars[lo:hi], dtype=float).reshape((ncomp, -1) + (1, )*np.ndim(x))
+                out = out + f(x, *p.swapaxes(0, 1)).sum(axis=0)
+        
+        return out
+    
+    def __getattr__(self, name):
+        if name == '__code__':
+            return code_wrapper(self.__call__.__code__)
+        elif name == 'jac' and all(hasattr(f, 'jac') for f in self.fn_handles):
+            return self._jac
+        else:
+            try:
+                return self.__dict__[name]
+            except KeyError as err:
+                raise AttributeError(err) from None
+    
+    def _jac(self, x, *pars):
+        """
+            Jacobian with respect to the parameters, shape (npar, len(x)). 
+            Only available as jac if all the functions have a jac. 
+        """
+        
+        shape = np.shape(x)
+        out = []
+        for f, lo, hi, ncomp in self.groups:
+            
+            # single function
+            if ncomp == 1:
+                out.append(np.broadcast_to(f.jac(x, *pars[lo:hi]), (hi-lo, )+shape))
+                
+            # fused components: (npar, ncomp, len(x)) -> (ncomp*npar, len(x))
+            else:
+                p = np.array(pars[lo:hi], dtype=float).reshape((ncomp, -1) + (1, )*len(shape))
+                j = f.jac(x, *p.swapaxes(0, 1)).swapaxes(0, 1)
+                out.append(j.reshape((hi-lo, )+shape))
+                
+        return np.concatenate(out)
+    
+    @staticmethod
+    def broadcastable(fn):
+        """
+            True if fn(x, *par) broadcasts over array-valued parameters
+        """
+        return fn in (lorentzian, bilorentzian, gaussian)
+
+# ----------------------------------------------------------------------------
+# integration tolerance of pulsed functions
+def get_pulsers(fn):
+    """
+        Find the PulsedFns objects used by a fitting function, searching 
+        through superpositions, constraints, decay corrections, etc. 
+        
+        fn: function handle or list of function handles
+        
+        return list of PulsedFns
+    """
+    
+    pulsers = []
+    seen = set()
+    stack = [fn]
+    
+    while stack:
+        f = stack.pop()
+        
+        if id(f) in seen:
+            continue
+        seen.add(id(f))
+        
+        if isinstance(f, PulsedFns):
+            pulsers.append(f)
+        elif isinstance(f, (list, tuple)):
+            stack.extend(f)
+        elif callable(f) and not isinstance(f, type):
+            stack.extend(getattr(f, '__dict__', {}).values())
+            for cell in getattr(f, '__closure__', None) or ():
+                try:
+                    stack.append(cell.cell_contents)
+                except ValueError:  # empty cell
+                    pass
+            
+    return pulsers
+
+@contextmanager
+def integration_tol(fn, tol):
+    """
+        Temporarily set the numerical integration tolerance of all pulsed 
+        functions used by fn. Useful to minimize quickly with a coarse 
+        tolerance before polishing at full precision. 
+        
+        fn: function handle or list of function handles
+        tol: absolute error tolerance of the integration. If None, do nothing.
+        
+        with integration_tol(fn, 1e-3):
+            m.migrad()
+    """
+    
+    pulsers = get_pulsers(fn) if tol is not None else []
+    tol_orig = [p.integration_tol for p in pulsers]
+    
+    try:
+        for p in pulsers:
+            p.integration_tol = tol
+        yield
+    finally:
+        for p, t in zip(pulsers, tol_orig):
+            p.integration_tol = t
 
 # ----------------------------------------------------------------------------
 # quadrupole perturbations to NMR frequency
@@ -265,3 +903,65 @@ def qp_nu(nu_0, nu_q, eta, theta, phi, I, m):
     # Equation (26)
     return nu_0 + qp_1st_order(nu_q, eta, theta, phi, m) + \
            qp_2nd_order(nu_0, nu_q, eta, theta, phi, I, m)
+
+def qp_nu_jac(nu_0, nu_q, eta, theta, phi, I, m):
+    """
+        Derivatives of qp_nu with respect to (nu_0, nu_q, eta, theta, phi). 
+        
+        Returns array with shape (5, ) + shape of m
+    """
+    
+    m = np.asarray(m, dtype=float)
+    shape = m.shape
+    m = m.ravel()
+    
+    e = eta
+    c = np.cos(2*phi)
+    C = np.cos(theta)
+    dc = -2*np.sin(2*phi)       # dc/dphi
+    dC = -np.sin(theta)         # dC/dtheta
+    
+    # 1st order: nu_q * k1 * (1 - 2m) * V_0
+    k1 = np.sqrt(6) / 3 * np.sqrt(1.5) * 0.5 * (1 - 2 * m)
+    V_0 = 3 * C**2 - 1 + e * (1 - C**2) * c
+    dV_0 = np.array([(1 - C**2) * c,                # eta
+                     (6 * C - 2 * e * C * c) * dC,  # theta
+                     e * (1 - C**2) * dc])          # phi
+    
+    # 2nd order: k2 * (V_m1V_1 * a + 0.5 * V_m2V_2 * b)
+    k2 = (-2/nu_0) * np.square(nu_q / 3.0)
+    a = 24.0 * m * (m - 1.0) - 4.0 * I * (I + 1.0) + 9.0
+    b = 12.0 * m * (m - 1.0) - 4.0 * I * (I + 1.0) + 6.0
+    
+    V_m1V_1 = -1.5 * ((-1/3 * e**2 * c**2 + 2 * e * c) * C**4 + \
+              (2/3 * e**2 * c**2 - 2 * e * c - e**2 / 3 + 3) * C**2 + \
+              (e**2 / 3) * (1 - c**2))
+    V_m2V_2 = 1.5 * ((e**2 * c**2 / 24 - 0.25 * e * c + 3/8) * C**4 + \
+              (-c**2 / 12 + e**2 / 6 - 0.75) * C**2 + \
+              e**2 * c**2 / 24 + 0.25 * e * c + 3/8)
+    
+    # partial derivatives with respect to e, c, C
+    dV1_de = -1.5 * ((-2/3 * e * c**2 + 2 * c) * C**4 + \
+             (4/3 * e * c**2 - 2 * c - 2/3 * e) * C**2 + (2/3 * e) * (1 - c**2))
+    dV1_dc = -1.5 * ((-2/3 * e**2 * c + 2 * e) * C**4 + \
+             (4/3 * e**2 * c - 2 * e) * C**2 - (2/3 * e**2) * c)
+    dV1_dC = -1.5 * (4 * (-1/3 * e**2 * c**2 + 2 * e * c) * C**3 + \
+             2 * (2/3 * e**2 * c**2 - 2 * e * c - e**2 / 3 + 3) * C)
+    dV2_de = 1.5 * ((e * c**2 / 12 - 0.25 * c) * C**4 + e / 3 * C**2 + \
+             e * c**2 / 12 + 0.25 * c)
+    dV2_dc = 1.5 * ((e**2 * c / 12 - 0.25 * e) * C**4 - c / 6 * C**2 + \
+             e**2 * c / 12 + 0.25 * e)
+    dV2_dC = 1.5 * (4 * (e**2 * c**2 / 24 - 0.25 * e * c + 3/8) * C**3 + \
+             2 * (-c**2 / 12 + e**2 / 6 - 0.75) * C)
+    
+    dV1 = np.array([dV1_de, dV1_dC * dC, dV1_dc * dc])
+    dV2 = np.array([dV2_de, dV2_dC * dC, dV2_dc * dc])
+    
+    # second order sum
+    S = V_m1V_1 * a + 0.5 * V_m2V_2 * b
+    
+    out = np.empty((5, len(m)))
+    out[0] = 1 - k2 * S / nu_0
+    out[1] = k1 * V_0 + 2 * k2 * S / nu_q
+    out[2:] = nu_q * k1 * dV_0[:, None] + k2 * (dV1[:, None]*a + 0.5*dV2[:, None]*b)
+    return out.reshape((5, ) + shape)
@@ -0,0 +1,279 @@
+# JAX versions of the base functions used in fitting bnmr data. Functions are
+# jit-compiled and have exact jacobians from automatic differentiation, which
+# are used by the minimizers via the jac attribute.
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from bfit.fitting import functions as fns
+from bfit.fitting.functions import code_names
+
+jax.config.update('jax_platform_name', 'cpu')
+jax.config.update("jax_enable_x64", True)
+
+# =========================================================================== #
+class jax_fn(object):
+    """
+        Jit-compiled function fn(x, *par) and its jacobian with respect to the
+        parameters. Inputs and outputs are numpy arrays.
+    """
+
+    def __init__(self, fn, names=None):
+        """
+            fn: function handle fn(x, *par), written with jax.numpy
+            names: input names, including x. Default: from fn.__code__
+        """
+
+        if names is None:
+            names = fn.__code__.co_varnames[:fn.__code__.co_argcount]
+
+        self.fn = fn
+        self.names = tuple(names)
+        self._eval = jax.jit(self._vec)
+        self._jac = jax.jit(jax.jacfwd(self._vec, argnums=1))
+        self._prime = jax.jit(self._vec_prime)
+
+    def __call__(self, x, *par):
+        return np.asarray(self._eval(jnp.asarray(x, dtype=float),
+                                     jnp.asarray(par, dtype=float)))
+
+    def jac(self, x, *par):
+        """Jacobian with respect to the parameters, shape (npar, len(x))"""
+        jac = self._jac(jnp.asarray(x, dtype=float), jnp.asarray(par, dtype=float))
+        return np.moveaxis(np.asarray(jac), -1, 0)
+
+    def prime(self, x, *par):
+        """Derivative with respect to x"""
+        return np.asarray(self._prime(jnp.asarray(x, dtype=float), 
+                                      jnp.asarray(par, dtype=float)))
+
+    def __getattr__(self, name):
+        if name == '__code__':
+            return code_names(self.names)
+        else:
+            try:
+                return self.__dict__[name]
+            except KeyError as err:
+                raise AttributeError(err) from None
+
+    def __reduce__(self):
+        """Pickle support: recompile on load"""
+        return (jax_fn, (self.fn, self.names))
+
+    def __deepcopy__(self, memo):
+        """Stateless and thread-safe: share, rather than recompile"""
+        return self
+
+    def _vec(self, x, par):
+        return jnp.broadcast_to(self.fn(x, *par), jnp.shape(x))
+
+    def _vec_prime(self, x, par):
+        # functions are elementwise in x: jvp with unit tangents is the derivative
+        return jax.jvp(lambda t: self._vec(t, par), (x, ), (jnp.ones_like(x), ))[1]
+
+# =========================================================================== #
+# TYPE 1 FUNCTIONS
+# =========================================================================== #
+def _lorentzian(freq, peak, fwhm, amp):
+    return -amp*jnp.square(0.5*fwhm)/(jnp.square(freq-peak)+jnp.square(0.5*fwhm))
+
+def _bilorentzian(freq, peak, fwhmA, ampA, fwhmB, ampB):
+    return _lorentzian(freq, peak, fwhmA, ampA) + _lorentzian(freq, peak, fwhmB, ampB)
+
+def _gaussian(freq, mean, sigma, amp):
+    return -amp*jnp.exp(-jnp.square((freq-mean)/sigma)/2)
+
+def _baseline(freq, b):
+    return b
+
+lorentzian = jax_fn(_lorentzian)
+bilorentzian = jax_fn(_bilorentzian)
+gaussian = jax_fn(_gaussian)
+baseline = jax_fn(_baseline)
+
+def _qp_nu(nu_0, nu_q, eta, theta, phi, I, m):
+    """
+        Quadrupole perturbed NMR frequencies for the m -> m - 1 transitions.
+        See functions.qp_nu, qp_1st_order, qp_2nd_order
+    """
+
+    c = jnp.cos(2*phi)
+    C = jnp.cos(theta)
+
+    # 1st order
+    V_0 = jnp.sqrt(1.5) * 0.5 * (3 * C**2 - 1 + eta * jnp.sin(theta)**2 * c)
+    nu_1 = nu_q * (jnp.sqrt(6) / 3) * (1 - 2 * m) * V_0
+
+    # 2nd order
+    V_m1V_1 = -1.5 * ((-1/3 * jnp.square(eta * c) + 2 * eta * c) * C**4 + \
+              (2/3 * jnp.square(eta * c) - 2 * eta * c - (eta * eta / 3) + 3) * C**2 + \
+              (eta * eta / 3) * (1 - c**2))
+
+    V_m2V_2 = 1.5 * (((1.0 / 24.0) * jnp.square(eta * c) - 0.25 * eta * c + 3/8) * C**4 + \
+              ((-1.0 / 12.0) * c * c + (eta * eta / 6.0) - 0.75) * C**2 + \
+              (1.0 / 24.0) * jnp.square(eta * c) + 0.25 * eta * c + 3/8)
+
+    nu_2 = (-2/nu_0) * jnp.square(nu_q / 3.0) * \
+           (1.0 * V_m1V_1 * (24.0 * m * (m - 1.0) - 4.0 * I * (I + 1.0) + 9.0) + \
+            0.5 * V_m2V_2 * (12.0 * m * (m - 1.0) - 4.0 * I * (I + 1.0) + 6.0))
+
+    return nu_0 + nu_1 + nu_2
+
+class _quadlorentzian_fixed_spin(object):
+    """See functions.quadlorentzian_fixed_spin"""
+
+    def __init__(self, I):
+        self.I = I
+        self.m = np.arange(-(I-1), I+1, 1)
+
+    def __call__(self, freq, nu_0, nu_q, eta, theta, phi, *amp_fwhm):
+        peaks = _qp_nu(nu_0, nu_q, eta, theta, phi, self.I, self.m)
+        amp = jnp.stack(amp_fwhm[:-1])
+        # peaks along a new last axis, so freq can have any shape
+        freq = jnp.asarray(freq)[..., None]
+        return jnp.sum(_lorentzian(freq, peaks, amp_fwhm[-1], amp), axis=-1)
+
+def quadlorentzian_fixed_spin(I):
+    """quadlorentzian for a fixed spin I, with the same FWHM for all peaks."""
+    names = fns.quadlorentzian_fixed_spin(I).__code__.co_varnames
+    return jax_fn(_quadlorentzian_fixed_spin(I), names)
+
+# =========================================================================== #
+# TYPE 2 PULSED FUNCTIONS
+# =========================================================================== #
+class _pulsed_exp(object):
+    """Pulsed exponential, see integrator.PulsedFns.exp"""
+
+    def __init__(self, lifetime, pulse_len):
+        self.life = lifetime
+        self.pulse_len = pulse_len
+
+    def exp(self, time, Lambda):
+
+        life = self.life
+        pulse_len = self.pulse_len
+
+        lambda1 = Lambda+1./life
+        prefac = 1./(lambda1*life)
+        afterfactor = prefac*(1-jnp.exp(-lambda1*pulse_len))/(1-jnp.exp(-pulse_len/life))
+
+        # evaluate each branch only at times where it is used, so that the 
+        # unused branch doesn't give nan gradients. As in PulsedFns.exp, the 
+        # output at t = 0 is nan
+        t_on = jnp.where(time < pulse_len, time, pulse_len)
+        t_off = jnp.maximum(time, pulse_len)
+
+        during = prefac*(1-jnp.exp(-lambda1*t_on))/(1-jnp.exp(-t_on/life))
+        after = afterfactor*jnp.exp(-Lambda*(t_off-pulse_len))
+
+        return jnp.where(time < pulse_len, during, after)
+
+    def __call__(self, time, lambda_s, amp):
+        return amp*self.exp(time, lambda_s)
+
+class _pulsed_biexp(_pulsed_exp):
+    def __call__(self, time, lambda_s, lambdab_s, fracb, amp):
+        return amp*((1-fracb)*  self.exp(time, lambda_s) + \
+                    fracb*      self.exp(time, lambdab_s))
+
+def pulsed_exp(lifetime, pulse_len):
+    """
+        lifetime: probe lifetime in s
+        pulse_len: length of pulse in s
+    """
+    return jax_fn(_pulsed_exp(lifetime, pulse_len), ('time', 'lambda_s', 'amp'))
+
+def pulsed_biexp(lifetime, pulse_len):
+    """
+        lifetime: probe lifetime in s
+        pulse_len: length of pulse in s
+    """
+    return jax_fn(_pulsed_biexp(lifetime, pulse_len),
+                  ('time', 'lambda_s', 'lambdab_s', 'fracb', 'amp'))
+
+# =========================================================================== #
+# HELPER FUNCTIONS
+# =========================================================================== #
+class _superpos(object):
+    """Superposition of jax.numpy functions"""
+
+    def __init__(self, fn_handles, npars):
+        self.fn_handles = fn_handles
+        self.npars = npars
+
+    def __call__(self, x, *pars):
+        return sum(f(x, *pars[l:h]) for f, l, h in zip(self.fn_handles,
+                                                      self.npars[:-1],
+                                                      self.npars[1:]))
+
+def get_fn_superpos(fn_handles):
+    """
+        Return a function which takes the superposition of a number of
+        functions. If all are jax_fn, the superposition is compiled as a
+        whole, else see functions.get_fn_superpos
+
+        fn_handles: list of function handles that should be superimposed
+
+        return fn_handle
+    """
+
+    if not all(isinstance(f, jax_fn) for f in fn_handles):
+        return fns.get_fn_superpos(fn_handles)
+
+    # parameter names and indexes
+    names = ['x']
+    npars = [0]
+    for i, f in enumerate(fn_handles):
+        names.extend(['%s_%d' % (n, i) for n in f.names[1:]])
+        npars.append(npars[-1]+len(f.names)-1)
+
+    return jax_fn(_superpos([f.fn for f in fn_handles], npars), names)
+
+class _constrained(object):
+    """Function with inputs defined by constraint equations, see functions.constrained_fn"""
+
+    def __init__(self, fn, pname_orig, pname_constr, constr):
+
+        self.fn = fn
+        self.inputs = []
+        for pname in pname_orig:
+            if pname in pname_constr:
+                self.inputs.append(pname_constr.index(pname))
+            elif pname in constr.keys():
+                c_fn, c_par = constr[pname]
+                self.inputs.append((c_fn, [pname_constr.index(c) for c in c_par]))
+            else:
+                raise RuntimeError('Parameter {param} not'.format(param=pname)+\
+                                   ' found in pname_constr or constr')
+
+    def __call__(self, x, *pars):
+        inputs = [i[0](*[pars[j] for j in i[1]]) if type(i) is tuple else pars[i] \
+                  for i in self.inputs]
+        return self.fn(x, *inputs)
+
+def get_constrained_fn(fn, pname_orig, pname_constr, constr):
+    """
+        Return constrained function. If fn is a jax_fn and the constraints are
+        written with jax.numpy, the constrained function is compiled as a
+        whole, else see functions.get_constrained_fn
+
+        fn: function handle, inputs in the order of pname_orig
+        pname_orig: list of str, parameter names
+        pname_constr: list of str, parameter names after constraining
+        constr: dict {defined (str): [fn (handle), pname (list of str)]}
+    """
+
+    if isinstance(fn, jax_fn):
+
+        new_fn = jax_fn(_constrained(fn.fn, pname_orig, pname_constr, constr),
+                        ['x']+list(pname_constr))
+
+        # check that the constraints can be traced
+        try:
+            new_fn.jac(np.zeros(1), *np.ones(len(pname_constr)))
+        except TypeError:
+            pass
+        else:
+            return new_fn
+
+    return fns.get_constrained_fn(fn, pname_orig, pname_constr, constr)
@@ -6,13 +6,14 @@ import numpy as np
 import pandas as pd
 
 # ======================================================================= #
-def gen_init_par(fn_name, ncomp, bdataobj, asym_mode='combined'):
+def gen_init_par(fn_name, ncomp, bdataobj, asym_mode='combined', spin=2):
     """Generate initial parameters for a given function.
     
         fname: name of function. Should be the same as the param_names keys
         ncomp: number of components
         bdataobj: a bdata object representative of the fitting group. 
         asym_mode: what kind of asymmetry to fit
+        spin: nuclear spin of the probe, sets the number of quadrupole peaks
         
         Set and return pd.DataFrame of initial parameters. 
             col: p0, blo, bhi, fixed
@@ -145,13 +146,14 @@ def gen_init_par(fn_name, ncomp, bdataobj, asym_mode='combined'):
                           'efgAsym':(0, 0, 1, True), 
                           'efgTheta':(0, 0, 2*np.pi, True), 
                           'efgPhi':(0, 0, 2*np.pi, True), 
-                          'amp0':(height, height*0.1, np.inf, False), 
-                          'amp1':(height, height*0.1, np.inf, False), 
-                          'amp2':(height, height*0.1, np.inf, False), 
-                          'amp3':(height, height*0.1, np.inf, False), 
-                          'fwhm':(dx/10, 0, dx, False), 
-                          'baseline':(base, -np.inf, np.inf, False)
                          }
+            
+            # one amplitude for each of the 2I peaks
+            for i in range(int(2*spin)):
+                par_values['amp%d' % i] = (height, height*0.1, np.inf, False)
+                
+            par_values['fwhm'] = (dx/10, 0, dx, False)
+            par_values['baseline'] = (base, -np.inf, np.inf, False)
      
     else:
         raise RuntimeError('Bad function name: "{}".'.format(fn_name))
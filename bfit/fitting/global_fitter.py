@@ -11,7 +11,10 @@ import time
 from bfit.fitting.minuit import minuit
 from collections.abc import Iterable
 from bfit.fitting.leastsquares import LeastSquares
+from bfit.fitting.functions import integration_tol
+from concurrent.futures import ThreadPoolExecutor
 import warnings
+import copy
 
 __doc__=\
 """
@@ -107,7 +110,8 @@ class global_fitter(object):
     
     # ======================================================================= #
     def __init__(self, fn, x, y, dy=None, dx=None, dy_low=None, dx_low=None, 
-                shared=None, fixed=None, metadata=None, fprime_dx=1e-6):
+                shared=None, fixed=None, metadata=None, fprime_dx=1e-6, 
+                nthreads=1, numeric_jac=False):
         """
             fn:         function handle OR list of function handles. 
                         MUST specify inputs explicitly if list must have that 
@@ -142,10 +146,23 @@ class global_fitter(object):
             
             fprime_dx:  x spacing in calculating centered differences derivative
             
+            nthreads:   if > 1, evaluate the data sets in parallel with this 
+                        many threads. Only faster if the functions release 
+                        the GIL (ex: pulsed functions, jax functions). 
+                        Results are identical to serial evaluation. 
+            
+            numeric_jac: if True and the functions have no jac attribute, 
+                        pass a block-sparse centered differences jacobian to 
+                        the minimizer, with a fixed step. Only suitable for 
+                        functions without numerical integration error. If 
+                        False, the minimizer finds its own derivatives. 
+            
         """
         # ---------------------------------------------------------------------
         # Check and assign inputs
         self.fprime_dx = fprime_dx
+        self.nthreads = nthreads
+        self.numeric_jac = numeric_jac
     
         if (dy is None and dy_low is not None) or (dx is None and dx_low is not None): 
             raise RuntimeError("If specifying lower errors, must also specify dy or dx")
@@ -302,11 +319,14 @@ class global_fitter(object):
         else:                       self.dxcat_low = None
         
     # ======================================================================= #
-    def _do_curve_fit(self, master_fn, p0_first, **fitargs):
+    def _do_curve_fit(self, master_fn, p0_first, master_jac=None, **fitargs):
         """
             Run curve_fit minimmizer
         """
         
+        if master_jac is not None and 'jac' not in fitargs:
+            fitargs['jac'] = lambda x, *par: np.transpose(master_jac(x, *par))
+        
         dycat = self.dycat
         absolute_sigma = self.dycat is not None
             
@@ -325,7 +345,18 @@ class global_fitter(object):
         return (par, std, std, cov)
     
     # ======================================================================= #
-    def _do_migrad(self, master_fn, master_fnprime, do_minos, p0_first, **fitargs):
+    def _do_migrad(self, master_fn, master_fn_and_prime, do_minos, p0_first, 
+                   coarse_tol=None, master_jac=None, do_lm=False, linear=None, 
+                   **fitargs):
+        """
+            Run migrad minimizer, with hesse or minos errors
+            
+            do_lm: if true, minimize the residuals with Levenberg-Marquardt 
+                   first, then polish with migrad and get errors with hesse
+            linear: if not None, list of booleans for each free parameter, 
+                   true if linear. Minimize first with variable projection 
+                   of the linear parameters, then polish with migrad
+        """
                 
         # set args
         limit = fitargs.get('bounds', None)
@@ -343,15 +374,35 @@ class global_fitter(object):
                             dx = self.dxcat, 
                             dy_low = self.dycat_low, 
                             dx_low = self.dxcat_low, 
-                            fn_prime = master_fnprime,
+                            fn_and_prime = master_fn_and_prime,
+                            fn_jac = master_jac,
                             **kwargs_minuit)
 
         self.ls = m.ls
         self.minuit = m
         
-        # minimize
+        # minimize, quickly at first if requested
         try:
-            m.migrad()    
+            if linear is not None:
+                with integration_tol([self.fn, master_fn], coarse_tol):
+                    m.project(linear)
+                    
+            if do_lm:
+                with integration_tol([self.fn, master_fn], coarse_tol):
+                    m.least_squares()
+            
+            if do_lm or linear is not None:
+                
+                # already at the minimum: polish without the initial hessian
+                strategy = m.strategy.strategy
+                m.strategy = 0
+                m.migrad()
+                m.strategy = strategy
+            else:
+                if coarse_tol is not None:
+                    with integration_tol([self.fn, master_fn], coarse_tol):
+                        m.migrad()
+                m.migrad()    
         except UnicodeEncodeError:  # can't print on older machines
             pass
         
@@ -484,7 +535,7 @@ class global_fitter(object):
         return fig_list
         
     # ======================================================================= #
-    def fit(self, minimizer='migrad', **fitargs):
+    def fit(self, minimizer='migrad', coarse_tol=None, linear=None, **fitargs):
         """
             fitargs: parameters to pass to fitter (scipy.optimize.curve_fit) 
             
@@ -511,11 +562,29 @@ class global_fitter(object):
                             
                             bounds.shape = (2, npars)
                             
-            minimizer:      string. One of "trf", "dogbox", or "migrad" indicating 
-                            which code to use to minimize the function
+            minimizer:      string. One of "trf", "dogbox", "migrad", "minos", 
+                            or "lm" indicating which code to use to minimize 
+                            the function. "lm" minimizes the residuals with 
+                            Levenberg-Marquardt (or a bounded trust region 
+                            Gauss-Newton method), then polishes with migrad 
+                            and gets errors with hesse. 
             
             do_minos:       if true, and if minimizer==migrad, then run minos errors
             
+            coarse_tol:     if not None, and if minimizer is migrad, minos, or lm, 
+                            minimize first with the integration tolerance of 
+                            any pulsed stretched exponentials set to this 
+                            value, then polish and get errors at full precision
+            
+            linear:         if not None, list of booleans, one for each 
+                            parameter, true if the functions are linear in 
+                            that parameter (ex: amplitudes, baselines). If 
+                            minimizer is migrad, minos, or lm, minimize first 
+                            over the nonlinear parameters only, solving for 
+                            the linear parameters by weighted least squares 
+                            (variable projection), then polish and get errors 
+                            and the full covariance for all parameters. 
+            
             returns (parameters, lower errors, upper errors, covariance matrix)
         """
         
@@ -624,44 +693,65 @@ class global_fitter(object):
             bounds = (lo, hi)
             fitargs['bounds'] = bounds
     
-        # make the master function 
-        x = self.x
-        rng = range(self.nsets)
-        metadata = self.metadata
-        fprime_dx = self.fprime_dx
-          
-        def master_fn(x_unused, *par):
-            inputs = np.take(np.hstack((par, p0_flat_inv)), sharing_links)
-            return np.concatenate([fn[i](x[i], *inputs[i], *metadata[i]) for i in rng])
+        # make the master function and its derivative
+        master_fn = master_function(fn, self.x, self.metadata, sharing_links, 
+                                    p0_flat_inv, len(p0_first), self.fprime_dx, 
+                                    nthreads=self.nthreads)
+        master_fn_and_prime = master_fn.fn_and_prime
         
         self.master_fn = master_fn
+        self.master_fnprime = master_fn.fnprime
+        self.master_fn_and_prime = master_fn_and_prime
+        
+        # make jacobian of master function: analytic if all functions have a 
+        # jacobian, else block-sparse centered differences if requested, else 
+        # the minimizer finds the derivatives itself
+        if hasattr(master_fn, 'jac'):
+            master_jac = master_fn.jac
+        elif self.numeric_jac:
+            master_jac = master_fn.jac_numeric
+        else:
+            master_jac = None
             
-        # make derivative of master function
-        def master_fnprime(x_unused, *par):
-            inputs = np.take(np.hstack((par, p0_flat_inv)), sharing_links)
-            xhi = np.concatenate([fn[i](x[i]+fprime_dx/2, *inputs[i], *metadata[i]) for i in rng])
-            xlo = np.concatenate([fn[i](x[i]-fprime_dx/2, *inputs[i], *metadata[i]) for i in rng])
-            return (xhi-xlo)/fprime_dx
-            
-        self.master_fnprime = master_fnprime
+        self.master_jac = master_jac
       
-        # do curve_fit
-        if minimizer in ('trf', 'dogbox'):
-            fitargs['method'] = minimizer
-            par, std_l, std_u, cov = self._do_curve_fit(master_fn, p0_first, **fitargs)
-        
-        # do migrad
-        elif minimizer in ('migrad', 'minos'):
-            fprime_dx = self.fprime_dx
-            self.master_fn = master_fn
+        # shut down the thread pool when done, the master function is 
+        # evaluated serially afterwards
+        try:
+            # do curve_fit
+            if minimizer in ('trf', 'dogbox'):
+                fitargs['method'] = minimizer
+                par, std_l, std_u, cov = self._do_curve_fit(master_fn, p0_first, 
+                                                            master_jac=master_jac, 
+                                                            **fitargs)
+        
+            # do migrad
+            elif minimizer in ('migrad', 'minos', 'lm'):
+                fprime_dx = self.fprime_dx
+                self.master_fn = master_fn
+            
+                # linear free parameters
+                if linear is not None:
+                    linear_flat = np.zeros(len(p0_first), dtype=bool)
+                    for lnk in sharing_links:
+                        free = lnk >= 0
+                        linear_flat[lnk[free]] = np.asarray(linear, dtype=bool)[free]
+                else:
+                    linear_flat = None
                     
-            par, std_l, std_u, cov = self._do_migrad(master_fn, 
-                                                     master_fnprime, 
-                                                     minimizer == 'minos', 
-                                                     p0_first, 
-                                                     **fitargs)
-        else:
-            raise RuntimeError("Unrecognized minimizer input '%s'" % minimizer)
+                par, std_l, std_u, cov = self._do_migrad(master_fn, 
+                                                         master_fn_and_prime, 
+                                                         minimizer == 'minos', 
+                                                         p0_first, 
+                                                         coarse_tol=coarse_tol,
+                                                         master_jac=master_jac,
+                                                         do_lm=minimizer == 'lm',
+                                                         linear=linear_flat,
+                                                         **fitargs)
+            else:
+                raise RuntimeError("Unrecognized minimizer input '%s'" % minimizer)
+        finally:
+            master_fn.close()
         
         # to array
         par = np.asarray(par)
@@ -676,25 +766,15 @@ class global_fitter(object):
         std_l_out = np.hstack((std_l, zero))[sharing_links]
         std_u_out = np.hstack((std_u, zero))[sharing_links]
         
-        # inflate covariance matrix
-        cov_out = []
-        for lnk in sharing_links:
-            
-            # init
-            cov_run = np.zeros((self.npar, self.npar))
-            
-            # assign
-            for i in range(self.npar):
-                for j in range(self.npar):
-                    
-                    # fixed values
-                    if lnk[j] < 0 or lnk[i] < 0: 
-                        cov_run[i, j] = np.nan
-                    
-                    # cov
-                    else:
-                        cov_run[i, j] = cov[lnk[i], lnk[j]]
-            cov_out.append(cov_run)
+        # inflate covariance matrix: gather for each run, NaN for fixed values
+        is_fixed = sharing_links < 0
+        if cov.size:
+            lnk = np.where(is_fixed, 0, sharing_links)
+            cov_out = cov[lnk[:, :, None], lnk[:, None, :]]
+        else:
+            cov_out = np.empty((self.nsets, self.npar, self.npar))
+        cov_out[is_fixed[:, :, None] | is_fixed[:, None, :]] = np.nan
+        cov_out = list(cov_out)
                     
         # return
         self.par = par
@@ -728,7 +808,7 @@ class global_fitter(object):
         if dof <= 0:
             raise DivisionByZero("Zero degrees of freedom")
         
-        if self.minimizer == 'migrad':
+        if self.minimizer in ('migrad', 'lm'):
             self.chi_glbl = self.minuit.fval/dof
         else:
             
@@ -737,7 +817,7 @@ class global_fitter(object):
                             dx = self.dxcat, 
                             dy_low = self.dycat_low, 
                             dx_low = self.dxcat_low, 
-                            fn_prime = self.master_fnprime)
+                            fn_and_prime = self.master_fn_and_prime)
             
             self.chi_glbl = ls(*self.par) / dof
         return self.chi_glbl
@@ -850,6 +930,220 @@ class global_fitter(object):
             arr2.extend(arr[i][(~fixed[i])*(~shared)])
         return np.array(arr2)
 
+# =========================================================================== #
+class master_function(object):
+    """
+        Evaluate all fit functions with the flattened free parameters and 
+        concatenate the output. 
+        
+        Parameters are expanded to the inputs of each data set with a gather 
+        index into a persistent parameter buffer, and each function writes 
+        into a view of a preallocated output buffer. The returned arrays are 
+        overwritten by the next call: copy them if they need to be kept. 
+        
+        Jacobians are block-sparse: each data set only contributes to the 
+        rows of its own free parameters. 
+        
+        Data sets can be evaluated in parallel by a persistent thread pool, 
+        which is shut down by close(). Each data set writes to its own section 
+        of the outputs, so the results don't depend on the execution order. 
+    """
+    
+    def __init__(self, fn, x, metadata, sharing_links, p0_flat_inv, nfree, 
+                 fprime_dx=1e-6, nthreads=1):
+        """
+            fn:             list of function handles, one per data set
+            x:              list of x arrays, one per data set
+            metadata:       list of additional inputs to each fn
+            sharing_links:  2D array of indexes into (par, p0_flat_inv), shape 
+                            (nsets, npar). Negative values index fixed values.
+            p0_flat_inv:    reversed flattened initial parameters, the source 
+                            of fixed values
+            nfree:          number of free parameters
+            fprime_dx:      x spacing in calculating centered differences derivative
+            nthreads:       number of threads used to evaluate the data sets
+        """
+        
+        # parallel evaluation: each data set gets its own copy of stateful 
+        # functions (caches, integrators) which are used more than once. If 
+        # the copy fails, that data set is evaluated serially after the others.
+        # Stateless functions (jax_fn) return themselves when copied, keeping 
+        # their compiled code
+        self._serial = []
+        if nthreads > 1:
+            self._pool = ThreadPoolExecutor(max_workers=nthreads)
+            
+            fn = list(fn)
+            seen = set()
+            for i, f in enumerate(fn):
+                if id(f) in seen:
+                    try:
+                        fn[i] = copy.deepcopy(f)
+                    except Exception as err:
+                        warnings.warn('Function of data set %d could not be '%i+\
+                                      'copied for parallel evaluation, '+\
+                                      'evaluating serially (%s)' % err)
+                        self._serial.append(i)
+                seen.add(id(f))
+        else:
+            self._pool = None
+        
+        self._parallel = [i for i in range(len(fn)) if i not in self._serial]
+        
+        self.fn = fn
+        self.x = x
+        self.metadata = metadata
+        self.fprime_dx = fprime_dx
+        
+        # parameter buffer: free parameters then fixed values
+        nfixed = len(p0_flat_inv)
+        self.nfree = nfree
+        self._par = np.empty(nfree+nfixed)
+        self._par[nfree:] = p0_flat_inv
+        
+        # gather index: wrap negative indexes
+        self._links = np.asarray(sharing_links) % len(self._par)
+        self._inputs = np.empty(self._links.shape)
+        
+        # output buffers and views into them for each data set
+        idx = np.cumsum([0]+[len(xi) for xi in x])
+        self._out = np.empty(idx[-1])
+        self._prime = np.empty(idx[-1])
+        self._jac = np.empty((nfree, idx[-1]))
+        self._slices = [slice(lo, hi) for lo, hi in zip(idx[:-1], idx[1:])]
+        
+        # free parameters of each data set: (index in inputs, index in par)
+        self._free = [(np.where(lnk >= 0)[0], lnk[lnk >= 0]) 
+                      for lnk in np.asarray(sharing_links)]
+        self._out_views = [self._out[lo:hi] for lo, hi in zip(idx[:-1], idx[1:])]
+        self._prime_views = [self._prime[lo:hi] for lo, hi in zip(idx[:-1], idx[1:])]
+        
+        # inputs for centered differences
+        self.x3 = [np.concatenate((xi-fprime_dx/2, xi, xi+fprime_dx/2)) for xi in x]
+        
+    def __call__(self, x_unused, *par):
+        inputs = self.expand(par)
+        self._map(self._eval_set, inputs)
+        return self._out
+    
+    def _map(self, fn, inputs):
+        """Run fn(i, inputs[i]) for each data set, in parallel if enabled"""
+        
+        if self._pool is None:
+            for i in range(len(self.fn)):
+                fn(i, inputs[i])
+        else:
+            
+            # list to wait for completion and raise errors
+            list(self._pool.map(fn, self._parallel, inputs[self._parallel]))
+            
+            # functions shared with the parallel data sets
+            for i in self._serial:
+                fn(i, inputs[i])
+    
+    def close(self):
+        """Shut down the thread pool, later calls are evaluated serially"""
+        
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+    
+    def _eval_set(self, i, inputs):
+        self._out_views[i][:] = self.fn[i](self.x[i], *inputs, *self.metadata[i])
+    
+    def expand(self, par):
+        """Get inputs for each data set from the free parameters"""
+        self._par[:self.nfree] = par
+        return np.take(self._par, self._links, out=self._inputs)
+    
+    def fn_and_prime(self, x_unused, *par):
+        """
+            Function and derivative in x: use fn.prime if it exists, else 
+            evaluate (x-h, x, x+h) in a single call
+        """
+        
+        inputs = self.expand(par)
+        self._map(self._eval_set_prime, inputs)
+        return (self._out, self._prime)
+    
+    def _eval_set_prime(self, i, inputs):
+        
+        f = self.fn[i]
+        args = (*inputs, *self.metadata[i])
+        
+        if hasattr(f, 'prime'):
+            self._out_views[i][:] = f(self.x[i], *args)
+            self._prime_views[i][:] = f.prime(self.x[i], *args)
+        else:
+            x3 = self.x3[i]
+            f3 = np.broadcast_to(f(x3, *args), x3.shape).reshape(3, -1)
+            self._out_views[i][:] = f3[1]
+            np.subtract(f3[2], f3[0], out=self._prime_views[i])
+            self._prime_views[i] /= self.fprime_dx
+    
+    def fnprime(self, x_unused, *par):
+        return self.fn_and_prime(x_unused, *par)[1]
+    
+    def __getattr__(self, name):
+        if name == 'jac' and all(hasattr(f, 'jac') for f in self.fn):
+            return self._jac_analytic
+        else:
+            try:
+                return self.__dict__[name]
+            except KeyError as err:
+                raise AttributeError(err) from None
+    
+    def _jac_analytic(self, x_unused, *par):
+        """
+            Jacobian with respect to the free parameters from the jacobians of 
+            each function. Shape (nfree, len(xcat)). Available as jac if all 
+            functions have a jac attribute. 
+        """
+        
+        inputs = self.expand(par)
+        self._jac.fill(0)
+        self._map(self._jac_set, inputs)
+        return self._jac
+    
+    def _jac_set(self, i, inputs):
+        j_in, j_par = self._free[i]
+        jac = np.asarray(self.fn[i].jac(self.x[i], *inputs, *self.metadata[i]))
+        np.add.at(self._jac[:, self._slices[i]], j_par, jac[j_in])
+    
+    def jac_numeric(self, x_unused, *par, step=1e-6):
+        """
+            Jacobian with respect to the free parameters from centered 
+            differences. Each data set is evaluated only for its own free 
+            parameters and the rows of shared parameters are the sum of the 
+            contributions from each data set. Shape (nfree, len(xcat)). 
+        """
+        
+        inputs = self.expand(par)
+        self._jac.fill(0)
+        self._map(lambda i, inpt: self._jac_numeric_set(i, inpt, step), inputs)
+        return self._jac
+    
+    def _jac_numeric_set(self, i, inputs, step):
+        
+        f = self.fn[i]
+        j_in, j_par = self._free[i]
+        inpt = inputs.copy()
+        xi = self.x[i]
+        meta = self.metadata[i]
+        view = self._jac[:, self._slices[i]]
+        
+        for ji, jp in zip(j_in, j_par):
+            p = inpt[ji]
+            h = step*max(abs(p), 1)
+            
+            inpt[ji] = p+h
+            hi = f(xi, *inpt, *meta)
+            inpt[ji] = p-h
+            lo = f(xi, *inpt, *meta)
+            inpt[ji] = p
+            
+            view[jp] += (hi-lo)/(2*h)
+        
 # =========================================================================== #
 def get_depth(lst, _n=0):
     """
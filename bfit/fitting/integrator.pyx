@@ -7,34 +7,378 @@
 # Note: to see slow lines write 'cython integrator.pyx -a --cplus'
 
 cimport cython
+from cython.parallel cimport prange
+import os
+from collections import OrderedDict
 import numpy as np
 cimport numpy as np
-from libc.math cimport exp, pow
+from libc.math cimport exp, pow, fabs, isfinite
+from libcpp.vector cimport vector
+from libcpp.algorithm cimport upper_bound
+
+# maximum number of bisections of a str_exp table segment
+cdef int TABLE_MAX_DEPTH = 60
+
+# number of segments in the initial str_exp table grid
+cdef int TABLE_NSEG = 16
 
 # ========================================================================== #
 # Integration functions import
 cdef extern from 'integration_fns.h':
     cdef cppclass Integrator:
         double lifetime;
+        double tolerance;
         Integrator(double);
-        double StrExp(double, double, double, double) except +;
+        double StrExp(double, double, double, double) nogil;
+        double StrExpDLambda(double, double, double, double) nogil;
+        double StrExpDBeta(double, double, double, double) nogil;
+
+# =========================================================================== #
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)     # keep IEEE nan/inf behaviour without the GIL
+cdef void _exp_kernel(double[:] time, double Lambda, double life,
+                      double pulse_len, double[:] out) noexcept nogil:
+    """
+        Pulsed exponential kernel, writes result to out
+
+        time: array of times
+        Lambda: 1/T1 in s^-1
+        life: probe lifetime in s
+        pulse_len: beam on pulse length in s
+        out: output array, same length as time
+    """
+
+    # Variable definitions
+    cdef Py_ssize_t n = time.shape[0]
+    cdef Py_ssize_t i
+    cdef double t
+    cdef double prefac
+    cdef double lambda1
+    cdef double afterfactor
+
+    # precalculations
+    lambda1 = Lambda+1./life
+    prefac = 1./(lambda1*life)
+    afterfactor = prefac*(1-exp(-lambda1*pulse_len))/(1-exp(-pulse_len/life))
+
+    for i in range(n):
+
+        # get some useful values: time, normalization
+        t = time[i]
+
+        # during pulse
+        if t<pulse_len:
+            out[i] = prefac*(1-exp(-lambda1*t))/(1-exp(-t/life))
+
+        # after pulse
+        else:
+            out[i] = afterfactor*exp(-Lambda*(t-pulse_len))
+
+# =========================================================================== #
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _exp_grad_kernel(double[:] time, double Lambda, double life,
+                           double pulse_len, double[:, :] out) noexcept nogil:
+    """
+        Pulsed exponential and its derivative with respect to Lambda, writes
+        result to out[0] and out[1], respectively.
+    """
+
+    # Variable definitions
+    cdef Py_ssize_t n = time.shape[0]
+    cdef Py_ssize_t i
+    cdef double t, e
+    cdef double lambda1
+    cdef double norm
+    cdef double after, dafter
+
+    # precalculations
+    lambda1 = Lambda+1./life
+    e = exp(-lambda1*pulse_len)
+    norm = 1./(life*(1-exp(-pulse_len/life)))
+    after = norm*(1-e)/lambda1
+    dafter = norm*(pulse_len*e*lambda1 - (1-e))/(lambda1*lambda1)
+
+    for i in range(n):
+
+        t = time[i]
+
+        # during pulse
+        if t<pulse_len:
+            e = exp(-lambda1*t)
+            norm = 1./(life*(1-exp(-t/life)))
+            out[0, i] = norm*(1-e)/lambda1
+            out[1, i] = norm*(t*e*lambda1 - (1-e))/(lambda1*lambda1)
+
+        # after pulse
+        else:
+            e = exp(-Lambda*(t-pulse_len))
+            out[0, i] = after*e
+            out[1, i] = (dafter - after*(t-pulse_len))*e
+
+# =========================================================================== #
+@cython.cdivision(True)
+cdef inline double _str_exp_point(Integrator* intr, double t, double Lambda,
+                                  double Beta, double life, double pulse_len,
+                                  double prefac_post) noexcept nogil:
+    """
+        Pulsed stretched exponential at a single time t
+
+        intr: integrator
+        prefac_post: normalization after the pulse, life*(1-exp(-pulse_len/life))
+    """
+
+    # during pulse
+    if t<pulse_len:
+        return intr.StrExp(t, t, Lambda, Beta)/(life*(1.-exp(-t/life)))
+
+    # after pulse
+    else:
+        return intr.StrExp(t, pulse_len, Lambda, Beta) * \
+               exp((t-pulse_len)/life)/prefac_post
+
+# =========================================================================== #
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _str_exp_kernel(Integrator* intr, double[:] time, double Lambda,
+                          double Beta, double life, double pulse_len,
+                          double[:] out, int num_threads) noexcept nogil:
+    """
+        Pulsed stretched exponential kernel, writes result to out. Time bins
+        are integrated in parallel.
+
+        intr: integrator
+        time: array of times
+        Lambda: 1/T1 in s^-1
+        Beta: stretching factor
+        life: probe lifetime in s
+        pulse_len: beam on pulse length in s
+        out: output array, same length as time
+        num_threads: number of threads to use
+    """
+
+    cdef Py_ssize_t n = time.shape[0]
+    cdef Py_ssize_t i
+    cdef double prefac_post = life*(1.-exp(-pulse_len/life))
+
+    # integration cost varies with time: balance dynamically
+    for i in prange(n, num_threads=num_threads, schedule='guided'):
+        out[i] = _str_exp_point(intr, time[i], Lambda, Beta, life, pulse_len,
+                                prefac_post)
+
+# =========================================================================== #
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _str_exp_grad_kernel(Integrator* intr, double[:] time, double Lambda,
+                               double Beta, double life, double pulse_len,
+                               double[:, :] out, int num_threads) noexcept nogil:
+    """
+        Pulsed stretched exponential and its derivatives with respect to
+        Lambda and Beta, writes result to out[0], out[1], and out[2].
+        Derivatives are calculated by differentiating under the integral.
+    """
+
+    cdef Py_ssize_t n = time.shape[0]
+    cdef Py_ssize_t i
+    cdef double t, tprime, norm
+    cdef double prefac_post = life*(1.-exp(-pulse_len/life))
+
+    for i in prange(n, num_threads=num_threads, schedule='guided'):
+
+        t = time[i]
+
+        # during pulse
+        if t<pulse_len:
+            tprime = t
+            norm = 1./(life*(1.-exp(-t/life)))
+
+        # after pulse
+        else:
+            tprime = pulse_len
+            norm = exp((t-pulse_len)/life)/prefac_post
+
+        out[0, i] = intr.StrExp(t, tprime, Lambda, Beta)*norm
+        out[1, i] = intr.StrExpDLambda(t, tprime, Lambda, Beta)*norm
+        out[2, i] = intr.StrExpDBeta(t, tprime, Lambda, Beta)*norm
+
+# =========================================================================== #
+cdef inline double _str_exp_integrand(double u, double Lambda, double Beta,
+                                      double life) noexcept nogil:
+    """
+        Integrand of the pulsed stretched exponential as a function of the
+        time since implantation, u = t-t'
+    """
+    return exp(-u/life-pow(u*Lambda, Beta))
+
+# =========================================================================== #
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double _table_interp(vector[double]& u, vector[double]& G,
+                          vector[double]& g, double x) noexcept nogil:
+    """
+        Cubic Hermite interpolation of the tabulated integral G, using the
+        exact integrand g as the slope at each node.
+
+        u: table nodes, sorted ascending
+        G: integral from 0 to u
+        g: integrand at u
+        x: value at which to interpolate
+    """
+
+    cdef Py_ssize_t n = u.size()
+    cdef Py_ssize_t i
+    cdef double h, s, s1
+
+    # find segment
+    i = upper_bound(u.begin(), u.end(), x) - u.begin() - 1
+    if i < 0:       i = 0
+    elif i > n-2:   i = n-2
+
+    h = u[i+1]-u[i]
+    s = (x-u[i])/h
+    s1 = 1.-s
+
+    return  (1.+2.*s)*s1*s1*G[i] + s*s1*s1*h*g[i] + \
+            s*s*(3.-2.*s)*G[i+1] - s*s*s1*h*g[i+1]
+
+# =========================================================================== #
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _str_exp_table_kernel(Integrator* intr, vector[double]& u,
+                                vector[double]& G, vector[double]& g,
+                                double[:] time, double Lambda, double Beta,
+                                double life, double pulse_len, double[:] out,
+                                int num_threads) noexcept nogil:
+    """
+        Pulsed stretched exponential interpolated from a table of the
+        integral (see _table_interp). Negative times fall back to exact
+        integration.
+    """
+
+    cdef Py_ssize_t n = time.shape[0]
+    cdef Py_ssize_t i
+    cdef double t
+    cdef double prefac_post = life*(1.-exp(-pulse_len/life))
+
+    for i in prange(n, num_threads=num_threads, schedule='static'):
+
+        t = time[i]
+
+        # outside of table
+        if t < 0:
+            out[i] = _str_exp_point(intr, t, Lambda, Beta, life, pulse_len,
+                                    prefac_post)
+
+        # during pulse
+        elif t<pulse_len:
+            out[i] = _table_interp(u, G, g, t) / (life*(1.-exp(-t/life)))
+
+        # after pulse
+        else:
+            out[i] = (_table_interp(u, G, g, t) - \
+                      _table_interp(u, G, g, t-pulse_len)) * \
+                     exp((t-pulse_len)/life)/prefac_post
+
+# =========================================================================== #
+cdef class _StrExpTable:
+    """
+        Table of the str_exp integral for one (Lambda, Beta). Tables are not
+        modified once built, so a reference held by the caller stays valid
+        while interpolating without the GIL.
+    """
+    cdef double Lambda              # Lambda used to build the table
+    cdef double Beta                # Beta used to build the table
+    cdef double tol                 # table_tol used to build the table
+    cdef double umax                # upper limit of the table
+    cdef vector[double] u           # table nodes: time since implantation
+    cdef vector[double] G           # integral of the integrand from 0 to u
+    cdef vector[double] g           # integrand at u
 
 # =========================================================================== #
 cdef class PulsedFns:
     cdef double life            # probe lifetime in s
     cdef double pulse_len       # length of beam on in s
     cdef Integrator* intr       # integrator
+    cdef int nthreads           # number of threads used by str_exp
+
+    # str_exp interpolation table
+    cdef public double table_tol    # if > 0, interpolate str_exp with this error
+    cdef public int table_cache_size    # max number of tables kept
+    cdef object tables              # OrderedDict: (Lambda, Beta) -> table
 
     # ======================================================================= #
-    def __init__(self, lifetime, pulse_len):
+    def __init__(self, lifetime, pulse_len, table_tol=0, num_threads=1,
+                 integration_tol=1e-6, table_cache_size=16):
         """
             Inputs:
                 lifetime: probe lifetime in s
                 pulse_len: beam on pulse length in s
+                table_tol: if > 0, str_exp is interpolated from a table built
+                           for each (Lambda, Beta) rather than integrated for
+                           each time bin. Target absolute error of the output.
+                           Tables depend on (Lambda, Beta) and the lifetime
+                           through Lambda*lifetime, so a single table
+                           normalized in Lambda cannot be shared between
+                           parameter sets. Instead, recent tables are kept
+                           and reused (see table_cache_size).
+                num_threads: number of threads used to evaluate str_exp.
+                             If <= 0 use all cores.
+                integration_tol: target absolute error of the numerical
+                                 integration in str_exp
+                table_cache_size: number of (Lambda, Beta) tables to keep,
+                                  least recently used are dropped first.
+                                  Fits sharing this object between data
+                                  sets (or taking finite differences) reuse
+                                  tables for parameters which don't change
         """
         self.life = lifetime
         self.pulse_len = pulse_len
         self.intr = new Integrator(lifetime)
+        self.table_tol = table_tol
+        self.table_cache_size = table_cache_size
+        self.tables = OrderedDict()
+        self.num_threads = num_threads
+        self.integration_tol = integration_tol
+
+    # ======================================================================= #
+    @property
+    def num_threads(self):
+        """Number of threads used to evaluate str_exp"""
+        return self.nthreads
+
+    @num_threads.setter
+    def num_threads(self, n):
+        if n <= 0:
+            n = os.cpu_count() or 1
+        self.nthreads = n
+
+    # ======================================================================= #
+    @property
+    def integration_tol(self):
+        """Target absolute error of the numerical integration in str_exp"""
+        return self.intr.tolerance
+
+    @integration_tol.setter
+    def integration_tol(self, tol):
+        if tol <= 0:
+            raise ValueError('integration_tol must be positive')
+        self.intr.tolerance = tol
+        self.tables.clear()     # tables were integrated at the old tolerance
+
+    # ======================================================================= #
+    def __reduce__(self):
+        """
+            Pickle support: rebuild the integrator from the inputs. The
+            str_exp table is not saved and is rebuilt on demand.
+        """
+        return (PulsedFns, (self.life, self.pulse_len, self.table_tol,
+                            self.nthreads, self.intr.tolerance,
+                            self.table_cache_size))
 
     # ======================================================================= #
     def __dealloc__(self):
@@ -45,54 +389,44 @@ cdef class PulsedFns:
 
     # ======================================================================= #
     @cython.boundscheck(False)  # some speed up in exchange for instability
-    cpdef exp(self, double[:] time, double Lambda):
+    @cython.wraparound(False)
+    cpdef exp(self, double[:] time, double Lambda, out=None):
         """
             Pulsed exponential for an array of times. Efficient c-speed looping
-            and indexing.
+            and indexing, evaluated without the GIL.
 
             Inputs:
                 time: array of times
                 Lambda: 1/T1 in s^-1
+                out: optional float64 array with the same length as time. If
+                     given, the result is written here and no new memory is
+                     allocated.
 
             Outputs:
-                np.array of values for the puslsed stretched exponential.
+                np.array of values for the puslsed exponential.
         """
 
-        # Variable definitions
-        cdef int n = time.shape[0]
-        cdef int i
-        cdef double t
-        cdef np.ndarray[double, ndim=1] out = np.zeros(n)
-        cdef double life = self.life
-        cdef double pulse_len = self.pulse_len
-        cdef double prefac
-        cdef double lambda1
-        cdef double afterfactor
+        cdef Py_ssize_t n = time.shape[0]
+        cdef double[:] out_view
 
-        # precalculations
-        lambda1 = Lambda+1./life
-        prefac = 1./(lambda1*life)
-        afterfactor = (1-np.exp(-lambda1*pulse_len))/(1-np.exp(-pulse_len/life))
+        # get output buffer
+        if out is None:
+            out = np.empty(n)
+        out_view = out
 
-        # Calculate pulsed exponential
-        for i in range(n):
+        if out_view.shape[0] != n:
+            raise ValueError('out must have the same length as time')
 
-            # get some useful values: time, normalization
-            t = time[i]
-
-            # during pulse
-            if t<pulse_len:
-                out[i] = prefac*(1-np.exp(-lambda1*t))/(1-np.exp(-t/life))
-
-            # after pulse
-            else:
-                out[i] = prefac*afterfactor*np.exp(-Lambda*(t-pulse_len))
+        # Calculate pulsed exponential
+        with nogil:
+            _exp_kernel(time, Lambda, self.life, self.pulse_len, out_view)
 
         return out
 
     # ======================================================================= #
     @cython.boundscheck(False)  # some speed up in exchange for instability
-    cpdef str_exp(self, double[:] time, double Lambda, double Beta):
+    @cython.wraparound(False)
+    cpdef str_exp(self, double[:] time, double Lambda, double Beta, out=None):
         """
             Pulsed stretched exponential for an array of times. Efficient
             c-speed looping and indexing.
@@ -101,43 +435,311 @@ cdef class PulsedFns:
                 time: array of times
                 Lambda: 1/T1 in s^-1
                 Beta: stretching factor
+                out: optional float64 array with the same length as time. If
+                     given, the result is written here and no new memory is
+                     allocated.
 
             Outputs:
                 np.array of values for the puslsed stretched exponential.
         """
 
-        # Variable definitions
-        cdef double out
-        cdef int n = time.shape[0]
-        cdef int i
-        cdef double t, x
-        cdef np.ndarray[double, ndim=1] out_arr = np.zeros(n)
-        cdef double prefac
-        cdef double prefac_post
-        cdef double life = self.life
-        cdef double pulse_len = self.pulse_len
-        cdef Integrator* intr = self.intr
+        cdef Py_ssize_t n = time.shape[0]
+        cdef double[:] out_view
 
-        prefac_post = life*(1.-exp(-pulse_len/life))
+        # get output buffer
+        if out is None:
+            out = np.empty(n)
+        out_view = out
+
+        if out_view.shape[0] != n:
+            raise ValueError('out must have the same length as time')
 
         # Calculate pulsed str. exponential
+        self._str_exp(time, Lambda, Beta, out_view)
+
+        return out
+
+    # ======================================================================= #
+    cpdef exp_grad(self, double[:] time, double Lambda, out=None):
+        """
+            Pulsed exponential and its derivative with respect to Lambda.
+
+            Inputs:
+                time: array of times, length n
+                Lambda: 1/T1 in s^-1
+                out: optional float64 array with shape (2, n). If given, the
+                     result is written here and no new memory is allocated.
+
+            Outputs:
+                2D np.array of shape (2, n): [value, d/dLambda]
+        """
+
+        cdef Py_ssize_t n = time.shape[0]
+        cdef double[:, :] out_view
+
+        # get output buffer
+        if out is None:
+            out = np.empty((2, n))
+        out_view = out
+
+        if out_view.shape[0] != 2 or out_view.shape[1] != n:
+            raise ValueError('out must have shape (2, len(time))')
+
+        with nogil:
+            _exp_grad_kernel(time, Lambda, self.life, self.pulse_len, out_view)
+
+        return out
+
+    # ======================================================================= #
+    cpdef str_exp_grad(self, double[:] time, double Lambda, double Beta,
+                       out=None):
+        """
+            Pulsed stretched exponential and its derivatives with respect to
+            Lambda and Beta. Always uses exact integration.
+
+            Inputs:
+                time: array of times, length n
+                Lambda: 1/T1 in s^-1
+                Beta: stretching factor
+                out: optional float64 array with shape (3, n). If given, the
+                     result is written here and no new memory is allocated.
+
+            Outputs:
+                2D np.array of shape (3, n): [value, d/dLambda, d/dBeta]
+        """
+
+        cdef Py_ssize_t n = time.shape[0]
+        cdef double[:, :] out_view
+
+        # get output buffer
+        if out is None:
+            out = np.empty((3, n))
+        out_view = out
+
+        if out_view.shape[0] != 3 or out_view.shape[1] != n:
+            raise ValueError('out must have shape (3, len(time))')
+
+        with nogil:
+            _str_exp_grad_kernel(self.intr, time, Lambda, Beta, self.life,
+                                 self.pulse_len, out_view, self.nthreads)
+
+        return out
+
+    # ======================================================================= #
+    @cython.boundscheck(False)  # some speed up in exchange for instability
+    @cython.wraparound(False)
+    cpdef exp_batch(self, double[:] time, double[:] Lambda, out=None):
+        """
+            Pulsed exponential for an array of times, evaluated for many
+            values of Lambda in a single call.
+
+            Inputs:
+                time: array of times, length n
+                Lambda: array of 1/T1 in s^-1, length m
+                out: optional float64 array with shape (m, n). If given, the
+                     result is written here and no new memory is allocated.
+
+            Outputs:
+                2D np.array of shape (m, n), row i is exp(time, Lambda[i])
+        """
+
+        cdef Py_ssize_t n = time.shape[0]
+        cdef Py_ssize_t m = Lambda.shape[0]
+        cdef Py_ssize_t i
+        cdef double[:, :] out_view
+
+        # get output buffer
+        if out is None:
+            out = np.empty((m, n))
+        out_view = out
+
+        if out_view.shape[0] != m or out_view.shape[1] != n:
+            raise ValueError('out must have shape (len(Lambda), len(time))')
+
+        # Calculate pulsed exponential for each parameter set
+        with nogil:
+            for i in range(m):
+                _exp_kernel(time, Lambda[i], self.life, self.pulse_len,
+                            out_view[i])
+
+        return out
+
+    # ======================================================================= #
+    @cython.boundscheck(False)  # some speed up in exchange for instability
+    @cython.wraparound(False)
+    cpdef str_exp_batch(self, double[:] time, double[:] Lambda, double[:] Beta,
+                        out=None):
+        """
+            Pulsed stretched exponential for an array of times, evaluated for
+            many (Lambda, Beta) pairs in a single call.
+
+            Inputs:
+                time: array of times, length n
+                Lambda: array of 1/T1 in s^-1, length m
+                Beta: array of stretching factors, length m
+                out: optional float64 array with shape (m, n). If given, the
+                     result is written here and no new memory is allocated.
+
+            Outputs:
+                2D np.array of shape (m, n), row i is
+                str_exp(time, Lambda[i], Beta[i])
+        """
+
+        cdef Py_ssize_t n = time.shape[0]
+        cdef Py_ssize_t m = Lambda.shape[0]
+        cdef Py_ssize_t i
+        cdef double[:, :] out_view
+
+        if Beta.shape[0] != m:
+            raise ValueError('Lambda and Beta must have the same length')
+
+        # get output buffer
+        if out is None:
+            out = np.empty((m, n))
+        out_view = out
+
+        if out_view.shape[0] != m or out_view.shape[1] != n:
+            raise ValueError('out must have shape (len(Lambda), len(time))')
+
+        # Calculate pulsed str. exponential for each parameter set
+        for i in range(m):
+            self._str_exp(time, Lambda[i], Beta[i], out_view[i])
+
+        return out
+
+    # ======================================================================= #
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _str_exp(self, double[:] time, double Lambda, double Beta,
+                      double[:] out) except -1:
+        """
+            Pulsed stretched exponential, writes result to out. Select between
+            exact integration and table interpolation. The GIL is released
+            while integrating or interpolating.
+        """
+
+        cdef Py_ssize_t n = time.shape[0]
+        cdef Py_ssize_t i
+        cdef double umax = 0
+        cdef _StrExpTable tab
+
+        # exact calculation
+        if self.table_tol <= 0 or not (isfinite(Lambda) and isfinite(Beta)):
+            with nogil:
+                _str_exp_kernel(self.intr, time, Lambda, Beta, self.life,
+                                self.pulse_len, out, self.nthreads)
+            return 0
+
+        # get table coverage
         for i in range(n):
+            if time[i] > umax:
+                umax = time[i]
+
+        # get table from cache or rebuild if needed. The cache is only
+        # modified under the GIL and the local reference keeps the table alive
+        # while interpolating, so concurrent calls cannot free it
+        key = (Lambda, Beta)
+        tab = self.tables.get(key)
+        if tab is None or not (self.table_tol == tab.tol and umax <= tab.umax):
+            tab = self._build_table(Lambda, Beta, umax)
+            self.tables[key] = tab
+        self.tables.move_to_end(key)
+        while len(self.tables) > max(self.table_cache_size, 1):
+            self.tables.popitem(last=False)
+
+        with nogil:
+            _str_exp_table_kernel(self.intr, tab.u, tab.G, tab.g, time,
+                                  Lambda, Beta, self.life, self.pulse_len, out,
+                                  self.nthreads)
+        return 0
+
+    # ======================================================================= #
+    cdef _StrExpTable _build_table(self, double Lambda, double Beta, double umax):
+        """
+            Tabulate the integral of the str_exp integrand from 0 to u for
+            0 <= u <= umax. Segments are bisected until cubic Hermite
+            interpolation at their midpoint matches the exact integral to
+            within the tolerance required for table_tol in the output.
+
+            returns a new table
+        """
+
+        cdef int i
+        cdef double a, b, Ga, I
+        cdef _StrExpTable tab = _StrExpTable()
+
+        # avoid degenerate table
+        if umax <= 0:
+            umax = self.life
+
+        # first node
+        tab.u.push_back(0)
+        tab.G.push_back(0)
+        tab.g.push_back(_str_exp_integrand(0, Lambda, Beta, self.life))
+
+        # refine each initial segment
+        a = 0
+        Ga = 0
+        for i in range(TABLE_NSEG):
+            b = umax*(i+1)/TABLE_NSEG
+            I = self.intr.StrExp(b, b-a, Lambda, Beta)
+            Ga += self._refine_table(tab, a, b, Ga, I, Lambda, Beta, 0)
+
+            tab.u.push_back(b)
+            tab.G.push_back(Ga)
+            tab.g.push_back(_str_exp_integrand(b, Lambda, Beta, self.life))
+            a = b
+
+        # save table parameters
+        tab.Lambda = Lambda
+        tab.Beta = Beta
+        tab.tol = self.table_tol
+        tab.umax = umax
+
+        return tab
+
+    # ======================================================================= #
+    cdef double _refine_table(self, _StrExpTable tab, double a, double b,
+                              double Ga, double I, double Lambda, double Beta,
+                              int depth) except? -1:
+        """
+            Add nodes within (a, b) to tab, in ascending order.
+
+            a, b: segment bounds
+            Ga: integral from 0 to a
+            I: integral from a to b
+            depth: number of bisections so far
+
+            returns the refined integral from a to b
+        """
+
+        cdef double life = self.life
+        cdef double m = 0.5*(a+b)
+        cdef double ga = _str_exp_integrand(a, Lambda, Beta, life)
+        cdef double gb = _str_exp_integrand(b, Lambda, Beta, life)
+        cdef double Ia, Ib, err, tol
+        cdef bint split
+
+        # integral over each half: compare to the integral over the full
+        # segment and to its cubic Hermite interpolation at the midpoint
+        Ia = self.intr.StrExp(m, m-a, Lambda, Beta)
+        Ib = self.intr.StrExp(b, b-m, Lambda, Beta)
+        err = max(fabs(Ia - (0.5*I + 0.125*(b-a)*(ga-gb))),
+                  fabs(Ia + Ib - I))
 
-            # get some useful values: time, normalization
-            t = time[i]
+        # output is normalized by the integral up to min(t, pulse_len) and
+        # scaled by exp(t/life) after the pulse
+        tol = self.table_tol*life*(1.-exp(-min(m, self.pulse_len)/life))*exp(-m/life)
+        split = err > tol and depth < TABLE_MAX_DEPTH
 
-            # during pulse
-            if t<pulse_len:
-                prefac = life*(1.-exp(-t/life))
-                x = intr.StrExp(t, t, Lambda, Beta)
-                out = x/prefac
+        if split:
+            Ia = self._refine_table(tab, a, m, Ga, Ia, Lambda, Beta, depth+1)
 
-            # after pulse
-            else:
-                x = intr.StrExp(t, pulse_len, Lambda, Beta)
-                out = x*exp((t-pulse_len)/life)/prefac_post
+        tab.u.push_back(m)
+        tab.G.push_back(Ga+Ia)
+        tab.g.push_back(_str_exp_integrand(m, Lambda, Beta, life))
 
-            # save result
-            out_arr[i] = out
+        if split:
+            Ib = self._refine_table(tab, m, b, Ga+Ia, Ib, Lambda, Beta, depth+1)
 
-        return out_arr
+        return Ia+Ib
@@ -2,14 +2,13 @@
 # Derek Fujimoto
 # Oct 2020
 
-from scipy.misc import derivative 
 import numpy as np
 
 
 class LeastSquares:
 
     def __init__(self, fn, x, y, dy=None, dx=None, dy_low=None, dx_low=None, 
-                 fn_prime=None, fn_prime_dx=1e-6):
+                 fn_prime=None, fn_prime_dx=1e-6, fn_jac=None, fn_and_prime=None):
         """
             fn: function handle. f(x, a, b, c, ...)
             x:              x data
@@ -19,7 +18,18 @@ class LeastSquares:
             dy_low:         used only if error in y is asymmetric. If not none, dy is upper error
             dx_low:         used only if error in y is asymmetric. If not none, dx is upper error
             fn_prime:       function handle for the first derivative of fn. f'(x, a, b, c, ...)
+                            Default: fn.prime, if it exists, else central 
+                            differences from f(x-h), f(x), f(x+h), evaluated 
+                            in a single call to fn
             fn_prime_dx:    spacing in x to calculate the derivative in the case of the default calculation
+            fn_jac:         function handle for the Jacobian of fn with respect 
+                            to the parameters. jac(x, a, b, c, ...) returns 
+                            array of shape (npar, len(x)). Default: fn.jac, if 
+                            it exists. Sets the grad method if there are no 
+                            errors in x.
+            fn_and_prime:   function handle returning (f, f') in one 
+                            evaluation. (f, f') = g(x, a, b, c, ...). 
+                            Overrides fn_prime. 
         """
         self.fn = fn
         self.x = np.asarray(x, dtype=np.float64)
@@ -28,11 +38,17 @@ class LeastSquares:
         
         # set derivative
         if fn_prime is None:
-            self.fn_prime = lambda x, *pars : derivative(func=self.fn, x0=x, 
-                                                         dx=fn_prime_dx, n=1, order=3, 
-                                                         args=pars)
+            fn_prime = getattr(fn, 'prime', None)
+        self.fn_prime = fn_prime
+        self.fn_prime_dx = fn_prime_dx
+        
+        if fn_and_prime is not None:
+            self.fn_and_prime = fn_and_prime
+        elif fn_prime is not None:
+            self.fn_and_prime = self._fn_and_prime_analytic
         else:
-            self.fn_prime = fn_prime
+            self.fn_and_prime = self._fn_and_prime_numeric
+            self._x3 = np.concatenate((self.x-fn_prime_dx, self.x, self.x+fn_prime_dx))
         
         # set errors
         has_dy = False
@@ -51,7 +67,7 @@ class LeastSquares:
             
             if dy is None:
                 has_dy = True
-                self.dy = dy_low
+                self.dy = np.asarray(dy_low)
             else:
                 has_dy_asym = True
                 self.dy_low = np.asarray(dy_low)
@@ -65,6 +81,25 @@ class LeastSquares:
                 has_dx_asym = True
                 self.dx_low = np.asarray(dx_low)
         
+        # precompute weights and squared errors
+        with np.errstate(divide='ignore'):
+            if has_dy:
+                self._dy2 = np.square(self.dy, dtype=np.float64)
+                self._wdy = 1/self._dy2
+            if has_dy_asym:
+                self._dy2_low = np.square(self.dy_low, dtype=np.float64)
+                self._wdy_low = 1/self._dy2_low
+        
+        if has_dx_asym:
+            self._dx2 = np.square(0.5*(self.dx+self.dx_low), dtype=np.float64)
+        elif has_dx:
+            self._dx2 = np.square(self.dx, dtype=np.float64)
+        
+        # work buffers, reused across calls
+        self._res = np.empty(self.n)
+        self._den = np.empty(self.n)
+        self._idx = np.empty(self.n, dtype=bool)
+        
         # set least squares function
         if not any((has_dy, has_dx)):
             self.__call__ = self.ls_no_errors
@@ -95,78 +130,180 @@ class LeastSquares:
         
         else:
             raise RuntimeError("Missing error assignment case")
+        
+        # set gradient of least squares function
+        if fn_jac is None:
+            fn_jac = getattr(fn, 'jac', None)
+        self.fn_jac = fn_jac
+        
+        if fn_jac is None or has_dx:
+            self.grad = None
+        elif has_dy_asym:
+            self.grad = self.grad_dya
+        elif has_dy:
+            self.grad = self.grad_dy
+        else:
+            self.grad = self.grad_no_errors
+        
+        # set jacobian of the residuals
+        self._has_dx = has_dx
+        self._has_dy = has_dy
+        self._has_dy_asym = has_dy_asym
+        
+        if fn_jac is None or has_dx:
+            self.residuals_jac = None
      
     def __call__(self, *pars):
         return self.__call__(*pars)
         
     def ls_no_errors(self, *pars):
-        return np.sum(np.square(self.y - self.fn(self.x, *pars)))
+        res = np.subtract(self.y, self.fn(self.x, *pars), out=self._res)
+        return np.dot(res, res)
             
     def ls_dy(self, *pars):
-        return np.sum(np.square((self.y -self.fn(self.x, *pars)) / self.dy))
+        res = np.square(self._residual(self.fn(self.x, *pars)), out=self._res)
+        return np.dot(res, self._wdy)
     
     def ls_dx(self, *pars):
-        fprime = self.fn_prime(self.x, *pars)
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(self.dx*fprime)
-        
-        return np.sum(num/den)        
+        f, fprime = self.fn_and_prime(self.x, *pars)
+        return self._sum_dx(self._residual(f), fprime, 0)
 
     def ls_dxdy(self, *pars):
-        fprime = self.fn_prime(self.x, *pars)
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(self.dx*fprime) + np.square(self.dy)
-        return np.sum(num/den)   
+        f, fprime = self.fn_and_prime(self.x, *pars)
+        return self._sum_dx(self._residual(f), fprime, self._dy2)
              
     def ls_dya(self, *pars):
+        res = self._residual(self.fn(self.x, *pars))
         
         # get errors on appropriate side of the function
-        idx = self.y > self.fn(self.x, *pars)
-        dy = np.array(self.dy)
-        dy[idx] = self.dy_low[idx]
+        den = self._dy2_asym(res)
         
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(dy)
-        return np.sum(num/den)        
+        res = np.square(res, out=res)
+        return np.sum(np.divide(res, den, out=den))
   
     def ls_dxa(self, *pars):
-        fprime = self.fn_prime(self.x, *pars)
-        dx = 0.5*(self.dx+self.dx_low)
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(dx*fprime)
-        return np.sum(num/den)        
+        f, fprime = self.fn_and_prime(self.x, *pars)
+        return self._sum_dx(self._residual(f), fprime, 0)
        
     def ls_dx_dya(self, *pars):
-        fprime = self.fn_prime(self.x, *pars)
+        f, fprime = self.fn_and_prime(self.x, *pars)
+        res = self._residual(f)
+        return self._sum_dx(res, fprime, self._dy2_asym(res))
+        
+    def ls_dxa_dy(self, *pars):
+        f, fprime = self.fn_and_prime(self.x, *pars)
+        return self._sum_dx(self._residual(f), fprime, self._dy2)
+        
+    def ls_dxa_dya(self, *pars):
+        f, fprime = self.fn_and_prime(self.x, *pars)
+        res = self._residual(f)
+        return self._sum_dx(res, fprime, self._dy2_asym(res))
+    
+    def _residual(self, f):
+        """y - f, written to the residual buffer"""
+        return np.subtract(self.y, f, out=self._res)
+    
+    def _dy2_asym(self, res):
+        """
+            Squared y errors on the appropriate side of the function, written 
+            to the denominator buffer. Uses dy_low where y > f.
+        """
+        idx = np.greater(res, 0, out=self._idx)
+        den = self._den
+        den[:] = self._dy2
+        np.copyto(den, self._dy2_low, where=idx)
+        return den
+    
+    def _sum_dx(self, res, fprime, dy2):
+        """
+            sum((y-f)^2 / (dx^2 f'^2 + dy^2)). Overwrites res. dy2 may be the 
+            denominator buffer.
+        """
+        dxfp = np.square(fprime)
+        dxfp *= self._dx2
+        den = np.add(dxfp, dy2, out=self._den)
+        res = np.square(res, out=res)
+        return np.sum(np.divide(res, den, out=den))
+        
+    def _fn_and_prime_analytic(self, x, *pars):
+        """Function and analytic derivative"""
+        return (self.fn(x, *pars), self.fn_prime(x, *pars))
+    
+    def _fn_and_prime_numeric(self, x, *pars):
+        """
+            Function and central difference derivative from a single call to 
+            fn with inputs (x-h, x, x+h). Inputs are precomputed for self.x
+        """
+        if x is self.x:
+            x3 = self._x3
+        else:
+            x = np.asarray(x, dtype=np.float64)
+            h = self.fn_prime_dx
+            x3 = np.concatenate((x-h, x, x+h))
+        
+        f = np.broadcast_to(self.fn(x3, *pars), x3.shape).reshape(3, -1)
+        return (f[1], (f[2]-f[0])/(2*self.fn_prime_dx))
+        
+    def grad_no_errors(self, *pars):
+        res = self._residual(self.fn(self.x, *pars))
+        return -2*np.dot(self.fn_jac(self.x, *pars), res)
+    
+    def grad_dy(self, *pars):
+        res = self._residual(self.fn(self.x, *pars))
+        res *= self._wdy
+        return -2*np.dot(self.fn_jac(self.x, *pars), res)
+    
+    def grad_dya(self, *pars):
+        res = self._residual(self.fn(self.x, *pars))
         
         # get errors on appropriate side of the function
-        idx = self.y > self.fn(self.x, *pars)
-        dy = np.array(self.dy)
-        dy[idx] = self.dy_low[idx]
+        res /= self._dy2_asym(res)
         
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(self.dx*fprime) + np.square(dy)
-        return np.sum(num/den)    
+        return -2*np.dot(self.fn_jac(self.x, *pars), res)
+    
+    def residuals(self, *pars):
+        """
+            Weighted residuals, r, such that sum(r^2) is the chisquared. 
+            Returns a new array. 
+        """
         
-    def ls_dxa_dy(self, *pars):
-        fprime = self.fn_prime(self.x, *pars)
+        if self._has_dx:
+            f, fprime = self.fn_and_prime(self.x, *pars)
+        else:
+            f = self.fn(self.x, *pars)
         
-        dx = 0.5*(self.dx+self.dx_low)
+        res = self.y - f
         
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(dx*fprime) + np.square(self.dy)
-        return np.sum(num/den)    
+        # squared uncertainties
+        if self._has_dy_asym:
+            den = self._dy2_asym(res)
+        elif self._has_dy:
+            den = self._dy2
+        else:
+            den = 0
+            
+        if self._has_dx:
+            den = np.square(fprime)*self._dx2 + den
         
-    def ls_dxa_dya(self, *pars):
-        fprime = self.fn_prime(self.x, *pars)
-        dx = 0.5*(self.dx+self.dx_low)
+        if self._has_dx or self._has_dy:
+            res /= np.sqrt(den)
         
-        # get errors on appropriate side of the function
-        idx = self.y > self.fn(self.x, *pars)
-        dy = np.array(self.dy)
-        dy[idx] = self.dy_low[idx]
+        return res
+    
+    def residuals_jac(self, *pars):
+        """
+            Jacobian of the weighted residuals with respect to the parameters, 
+            shape (npar, len(x)). None if there are errors in x or no fn_jac. 
+            In the case of asymmetric errors, the side of the function for 
+            each point is taken as fixed. 
+        """
         
-        num = np.square(self.y - self.fn(self.x, *pars))
-        den = np.square(dx*fprime) + np.square(dy)
-        return np.sum(num/den)    
+        jac = -np.asarray(self.fn_jac(self.x, *pars), dtype=np.float64)
         
+        if self._has_dy_asym:
+            res = self._residual(self.fn(self.x, *pars))
+            jac = jac / np.sqrt(self._dy2_asym(res))
+        elif self._has_dy:
+            jac = jac * np.sqrt(self._wdy)
+            
+        return jac
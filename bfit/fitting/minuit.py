@@ -5,6 +5,7 @@
 import inspect
 import numpy as np
 from iminuit import Minuit
+from scipy.optimize import least_squares
 from bfit.fitting.leastsquares import LeastSquares
 
 class minuit(Minuit):
@@ -14,7 +15,8 @@ class minuit(Minuit):
     
     # ====================================================================== #
     def __init__(self, fn, x, y, dy=None, dx=None, dy_low=None, dx_low=None, 
-                 fn_prime=None, fn_prime_dx=1e-6, name=None, start=None, 
+                 fn_prime=None, fn_prime_dx=1e-6, fn_jac=None, fn_and_prime=None, 
+                 name=None, start=None, 
                  error=None, limit=None, fix=None, print_level=1, **kwargs):
         """
             fn: function handle. f(x, a, b, c, ...)
@@ -26,6 +28,12 @@ class minuit(Minuit):
             dx_low:         Optional, if error in y is asymmetric. If not none, dx is upper error
             fn_prime:       Optional, function handle for the first derivative of fn. f'(x, a, b, c, ...)
             fn_prime_dx:    Spacing in x to calculate the derivative for default calculation
+            fn_jac:         Optional, function handle for the Jacobian of fn with respect to 
+                                the parameters. jac(x, a, b, c, ...), shape (npar, len(x)). 
+                                Default: fn.jac, if it exists. Used to pass the 
+                                analytic gradient of the chisquared to Minuit. 
+            fn_and_prime:   Optional, function handle returning (f, f') in one 
+                                evaluation. (f, f') = g(x, a, b, c, ...)
             name:           Optional sequence of strings. If set, use this for setting parameter names
             start:          Optional sequence of numbers. Required if the 
                                 function takes an array as input or if it has 
@@ -62,7 +70,9 @@ class minuit(Minuit):
                         dy_low = dy_low, 
                         dx_low = dx_low, 
                         fn_prime = fn_prime, 
-                        fn_prime_dx = fn_prime_dx)
+                        fn_prime_dx = fn_prime_dx, 
+                        fn_jac = fn_jac, 
+                        fn_and_prime = fn_and_prime)
         self.ls = ls
 
         # get number of data points
@@ -148,6 +158,7 @@ class minuit(Minuit):
                 
         # make minuit object
         super().__init__(ls, 
+                         grad = ls.grad, 
                          name = name, 
                          **kwargs)
         
@@ -209,6 +220,149 @@ class minuit(Minuit):
         else:
             return self.fval/dof
     
+    # ====================================================================== #
+    def least_squares(self, **kwargs):
+        """
+            Minimize the weighted residuals of the least squares object with 
+            a Gauss-Newton type solver (scipy.optimize.least_squares) from 
+            the current values. Uses Levenberg-Marquardt if there are no 
+            limits and the trust region reflective method otherwise. Fixed 
+            parameters are respected. Sets the values to the solution, 
+            follow with migrad and hesse for errors. 
+            
+            kwargs: passed to scipy.optimize.least_squares
+            
+            returns scipy.optimize.OptimizeResult
+        """
+        
+        ls = self.ls
+        values = np.array(self.values)
+        free = ~np.array(self.fixed)
+        
+        # limits of free parameters
+        limits = np.array([l for l, f in zip(self.limits, free) if f], 
+                          dtype=float).reshape(-1, 2)
+        lo = limits[:, 0]
+        hi = limits[:, 1]
+        
+        def fn(p):
+            values[free] = p
+            return ls.residuals(*values)
+        
+        if ls.residuals_jac is None:
+            jac = '2-point'
+        else:
+            def jac(p):
+                values[free] = p
+                return np.transpose(ls.residuals_jac(*values)[free])
+        
+        # set method
+        if np.all(np.isinf(limits)) and self.npts >= sum(free):
+            kwargs.setdefault('method', 'lm')
+        else:
+            kwargs.setdefault('method', 'trf')
+            kwargs['bounds'] = (lo, hi)
+        
+        p0 = np.clip(values[free], lo, hi)
+        result = least_squares(fn, p0, jac=jac, **kwargs)
+        
+        values[free] = result.x
+        self.values = values
+        
+        return result
+    
+    # ====================================================================== #
+    def project(self, linear, **kwargs):
+        """
+            Variable projection: minimize the chisquared over the nonlinear 
+            parameters only, solving for the parameters which enter the 
+            function linearly by weighted linear least squares at each 
+            evaluation. Starts from the current values and sets the values to 
+            the solution, follow with migrad and hesse (or minos) for the 
+            errors and the full covariance matrix. 
+            
+            Fixed parameters are respected. Limits of the linear parameters 
+            are not used in the projection: the solution is clipped to them. 
+            Requires symmetric errors in y and no errors in x. 
+            
+            linear: list of booleans, true if fn is linear in the parameter
+            kwargs: passed to the Minuit object of the nonlinear parameters
+            
+            returns iminuit.Minuit of the nonlinear parameters, None if all 
+                free parameters are linear
+        """
+        
+        ls = self.ls
+        
+        if ls._has_dx or ls._has_dy_asym:
+            raise RuntimeError('Variable projection requires symmetric y '+\
+                               'errors and no x errors')
+        
+        values = np.array(self.values)
+        free = ~np.array(self.fixed)
+        lin = np.asarray(linear, dtype=bool) & free
+        nonlin = free & ~lin
+        nlin = np.sum(lin)
+        
+        if ls._has_dy:  sqrtw = np.sqrt(ls._wdy)
+        else:           sqrtw = np.ones(ls.n)
+        
+        def basis(par):
+            """Get f(par with linear parameters zero) and d f/d linear"""
+            
+            if ls.fn_jac is not None:
+                f = ls.fn(ls.x, *par)
+                G = np.asarray(ls.fn_jac(ls.x, *par))[lin]
+                f0 = f - np.dot(par[lin], G)
+            else:
+                p = par.copy()
+                p[lin] = 0
+                f0 = np.array(ls.fn(ls.x, *p), dtype=float)
+                G = np.empty((nlin, ls.n))
+                for i, j in enumerate(np.where(lin)[0]):
+                    p[j] = 1
+                    G[i] = ls.fn(ls.x, *p) - f0
+                    p[j] = 0
+            return (f0, G)
+        
+        def solve(par_nl):
+            """Solve for the linear parameters, return all and the chisquared"""
+            
+            par = values.copy()
+            par[nonlin] = par_nl
+            f0, G = basis(par)
+            
+            A = np.transpose(G)*sqrtw[:, None]
+            b = (ls.y-f0)*sqrtw
+            par[lin] = np.linalg.lstsq(A, b, rcond=None)[0]
+            
+            res = b - np.dot(A, par[lin])
+            return (par, np.dot(res, res))
+        
+        # minimize over nonlinear parameters
+        name = [n for n, nl in zip(self.parameters, nonlin) if nl]
+        
+        if name:
+            m = Minuit(lambda par_nl: solve(par_nl)[1], values[nonlin], 
+                       name=name, **kwargs)
+            m.errordef = 1
+            m.print_level = 0
+            m.limits = [l for l, nl in zip(self.limits, nonlin) if nl]
+            m.errors = [e for e, nl in zip(self.errors, nonlin) if nl]
+            m.migrad()
+            par_nl = np.array(m.values)
+        else:
+            m = None
+            par_nl = values[nonlin]
+        
+        # set values
+        par = solve(par_nl)[0]
+        limits = np.array([tuple(l) for l in self.limits], dtype=float)
+        par[lin] = np.clip(par[lin], limits[lin, 0], limits[lin, 1])
+        self.values = par
+        
+        return m
+    
     # ====================================================================== #
     def get_merrors(self, attribute):
         """
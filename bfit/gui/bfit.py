@@ -312,6 +312,7 @@ class bfit(object):
     minimizers = {'curve_fit (trf)':'bfit.fitting.fitter_curve_fit',
                   'migrad (hesse)':'bfit.fitting.fitter_migrad_hesse',
                   'migrad (minos)':'bfit.fitting.fitter_migrad_minos',
+                  'levmar (hesse)':'bfit.fitting.fitter_levmar_hesse',
                   }
 
     # define draw componeents in draw_param and labels
@@ -37,7 +37,7 @@ class popup_param(object):
         xy:             (x, asym, dasym) tuple
     """
 
-    # parameter mapping
+    # parameter mapping, names not listed are unchanged (ex: amp0, amp1, ...)
     parmap = {  '1_T1':'lam', 
                 '1_T1b':'lamb', 
                 'amp':'amp', 
@@ -52,10 +52,6 @@ class popup_param(object):
                 'heightB':'amp', 
                 'sigma':'fwhm', 
                 'mean':'peak', 
-                'amp0':'amp0', 
-                'amp1':'amp1', 
-                'amp2':'amp2', 
-                'amp3':'amp3', 
                 'nu_0':'nu_0', 
                 'nu_q':'nu_q', 
                 'efgAsym':'eta', 
@@ -178,12 +174,13 @@ class popup_param(object):
                 element = {}
                 for k in mixed.keys():
                     if 'base' in k:
-                        element[self.parmap[k]] = mixed[k] 
-                    elif str(i) in k:
-                        element[self.parmap['_'.join(k.split('_')[:-1])]] = mixed[k] 
+                        element[self.parmap.get(k, k)] = mixed[k] 
+                    elif k.endswith('_%d' % i):
+                        name = '_'.join(k.split('_')[:-1])
+                        element[self.parmap.get(name, name)] = mixed[k] 
                 split.append(element)
         else:
-            split.append({self.parmap[k]:mixed[k] for k in mixed.keys()})
+            split.append({self.parmap.get(k, k):mixed[k] for k in mixed.keys()})
         
         return split
         
@@ -219,12 +216,9 @@ class popup_param(object):
         elif self.fname == 'Gaussian':
             fn = lambda freq, peak, fwhm, amp : fns.gaussian(freq, peak, fwhm, amp)
         elif self.fname == 'QuadLorentz':
-            fn = lambda freq, nu_0, nu_q, eta, theta, phi, \
-                        amp0, amp1, amp2, amp3, fwhm: \
-                        fns.quadlorentzian(freq, nu_0, nu_q, eta, theta, phi, \
-                        amp0, amp1, amp2, amp3, \
-                        fwhm, fwhm, fwhm, fwhm, 
-                        I = self.fitter.spin[self.fitter.probe_species])
+            fquad = fns.quadlorentzian_fixed_spin(I = self.fitter.spin[self.fitter.probe_species])
+            names = fquad.__code__.co_varnames[1:]  # nu_0, ..., amp0, amp1, ..., fwhm
+            fn = lambda freq, **par : fquad(freq, *[par[n] for n in names])
                 
         elif self.fname in ('Exp', 'Str Exp'):
             
@@ -288,7 +282,7 @@ class popup_param(object):
                 i = int(s[-1])                
                         
             # set p0     
-            val = p0[i][self.parmap[key]]
+            val = p0[i][self.parmap.get(key, key)]
             self.lines[k].set(p0=val)
                     
             # check bounds are ok
@@ -0,0 +1,54 @@
+# Test 31Mg decay chain
+
+from numpy.testing import *
+from bfit.fitting.decay_31mg import *
+import numpy as np
+
+def test_decay_chain():
+    
+    beam_pulse = 4
+    beam_rate = 1e6
+    t = np.linspace(0, 10, 101)
+    
+    chain = decay_chain(t, beam_pulse, beam_rate)
+    
+    # compare to single isotope calculations
+    for fn, field in ((n_31Mg, 'n_31Mg'), (n_31Al, 'n_31Al'), (n_31Si, 'n_31Si'), 
+                      (n_31P, 'n_31P'), (n_30Al, 'n_30Al'), (n_30Si, 'n_30Si'), 
+                      (a_31Mg, 'a_31Mg'), (a_31Al, 'a_31Al'), (a_30Al, 'a_30Al')):
+        assert_allclose(chain[field], fn(t, beam_pulse, beam_rate), rtol=1e-12, 
+                        err_msg = "decay chain %s" % field)
+    
+    # conservation of atoms
+    assert_allclose(chain['n_total'], beam_rate*np.minimum(t, beam_pulse), rtol=1e-9, atol=1e-3, 
+                    err_msg = "decay chain total atoms")
+    
+    # fractions
+    assert_allclose(fa_31Mg(t[1:], beam_pulse, beam_rate), 
+                    chain['a_31Mg'][1:]/chain['a_total'][1:], rtol=1e-12, 
+                    err_msg = "decay chain 31Mg fractional activity")
+    
+    # negative times
+    assert_array_equal(decay_chain(np.array([-1.]), beam_pulse)['n_total'], 0, 
+                       err_msg = "decay chain negative time")
+    
+def test_n_31P_beam_off():
+    
+    beam_pulse = 4
+    beam_rate = 1e6
+    t = np.linspace(beam_pulse, 20, 81)
+    
+    # after beam off, 31P is all atoms which are not in the other isotopes
+    others = sum(fn(t, beam_pulse, beam_rate) for fn in (n_31Mg, n_31Al, n_31Si, 
+                                                         n_30Al, n_30Si))
+    assert_allclose(n_31P(t, beam_pulse, beam_rate), beam_rate*beam_pulse-others, 
+                    rtol=1e-9, atol=1e-3, err_msg = "31P population after beam off")
+    assert_allclose(fn_31P(t, beam_pulse, beam_rate), 
+                    1-others/(beam_rate*beam_pulse), atol=1e-9, 
+                    err_msg = "31P fractional population after beam off")
+    
+    # continuous at beam off
+    assert_allclose(n_31P(np.array([beam_pulse-1e-9, beam_pulse+1e-9]), 
+                          beam_pulse, beam_rate), 
+                    s_31P(beam_pulse, beam_rate, 0, 0, 0, 0), rtol=1e-6,
+                    err_msg = "31P population at beam off")
@@ -4,7 +4,10 @@
 
 from numpy.testing import *
 from bfit.fitting.functions import *
+from bfit.fitting.fitter import fitter
+import bfit.fitting.functions_jax as fns_jax
 import numpy as np
+import pickle
 
 def test_lorentzian():
     
@@ -134,6 +137,12 @@ def test_pulsed_exp():
     
     assert_almost_equal((x[:-2])[idx], pulse_len, err_msg = "pulsed exp beam off position")
     
+    # test output buffer reuse
+    out = np.zeros(len(x))
+    y2 = pexp.pulser.exp(x, 1, out=out)
+    assert y2 is out, "pulsed exp out buffer not returned"
+    assert_array_almost_equal(y, out, err_msg = "pulsed exp out buffer values")
+    
 def test_pulsed_strexp():
     
     # settings
@@ -172,3 +181,502 @@ def test_pulsed_strexp():
     idx = ddy == min(ddy)
     
     assert_almost_equal((x[:-2])[idx], pulse_len, err_msg = 'pulsed str exp beam off position')
+    
+def test_pulsed_batch():
+    
+    # settings
+    tau = 1
+    pulse_len = 4
+    
+    x = np.linspace(1e-9, 10, 1000)
+    pulser = pulsed_exp(lifetime = tau, pulse_len = pulse_len).pulser
+    
+    lam = np.array([0.1, 1, 10])
+    beta = np.array([0.3, 0.5, 1])
+    
+    # test exp against single evaluation
+    y = pulser.exp_batch(x, lam)
+    assert_equal(y.shape, (len(lam), len(x)), err_msg = "pulsed exp batch shape")
+    for i, l in enumerate(lam):
+        assert_array_almost_equal(y[i], pulser.exp(x, l), 
+                                  err_msg = "pulsed exp batch values")
+    
+    # test str exp against single evaluation
+    y = pulser.str_exp_batch(x, lam, beta)
+    assert_equal(y.shape, (len(lam), len(x)), err_msg = "pulsed str exp batch shape")
+    for i, (l, b) in enumerate(zip(lam, beta)):
+        assert_array_almost_equal(y[i], pulser.str_exp(x, l, b), 
+                                  err_msg = "pulsed str exp batch values")
+    
+def test_pulsed_strexp_threads():
+    
+    # settings
+    tau = 1
+    pulse_len = 4
+    
+    x = np.linspace(1e-9, 10, 1000)
+    serial = pulsed_strexp(lifetime = tau, pulse_len = pulse_len).pulser
+    parallel = pulsed_strexp(lifetime = tau, pulse_len = pulse_len).pulser
+    parallel.num_threads = 4
+    
+    assert_equal(parallel.num_threads, 4, err_msg = "pulsed str exp set num_threads")
+    assert_array_equal(serial.str_exp(x, 1, 0.5), parallel.str_exp(x, 1, 0.5), 
+                       err_msg = "pulsed str exp parallel evaluation")
+
+def test_pulsed_strexp_table_concurrent():
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    # settings
+    tau = 1
+    pulse_len = 4
+    lam = [0.5, 2]
+    
+    # shared table-mode pulser, each thread forces a table rebuild
+    x = np.linspace(1e-9, 10, 2000)
+    pulser = pulsed_strexp(lifetime = tau, pulse_len = pulse_len).pulser
+    pulser.table_tol = 1e-6
+    pulser.table_cache_size = 1
+    expected = [pulser.str_exp(x, l, 0.5) for l in lam]
+    
+    def run(i):
+        return [pulser.str_exp(x, lam[i], 0.5) for _ in range(40)]
+    
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(run, range(2)))
+    
+    for i in range(2):
+        for y in results[i]:
+            assert_array_equal(y, expected[i], 
+                               err_msg = "pulsed str exp table concurrent threads")
+    
+def test_pulsed_strexp_table_cache():
+    
+    # settings
+    tau = 1
+    pulse_len = 4
+    lam = [0.5, 2, 5]
+    
+    x = np.linspace(1e-9, 10, 500)
+    x_long = np.linspace(1e-9, 20, 500)
+    
+    # reference: new pulser for each parameter set
+    def fresh(t, l):
+        pulser = pulsed_strexp(lifetime = tau, pulse_len = pulse_len).pulser
+        pulser.table_tol = 1e-6
+        return pulser.str_exp(t, l, 0.5)
+    
+    # cache smaller than the number of parameter sets, so tables are both
+    # reused and dropped
+    pulser = pulsed_strexp(lifetime = tau, pulse_len = pulse_len).pulser
+    pulser.table_tol = 1e-6
+    pulser.table_cache_size = 2
+    
+    for _ in range(2):
+        for l in lam:
+            assert_array_equal(pulser.str_exp(x, l, 0.5), fresh(x, l), 
+                               err_msg = "pulsed str exp table cache reuse")
+    
+    # cached table does not cover longer times
+    assert_array_equal(pulser.str_exp(x_long, lam[-1], 0.5), 
+                       fresh(x_long, lam[-1]), 
+                       err_msg = "pulsed str exp table cache extend")
+    
+def test_pulsed_jac():
+    
+    # settings
+    tau = 1
+    pulse_len = 4
+    h = 1e-6
+    
+    x = np.linspace(1e-3, 10, 100)
+    
+    for fn, par in ((pulsed_exp, [1, 0.1]), 
+                    (pulsed_biexp, [1, 10, 0.3, 0.1]), 
+                    (pulsed_strexp, [1, 0.5, 0.1])):
+        
+        f = fn(lifetime = tau, pulse_len = pulse_len)
+        jac = f.jac(x, *par)
+        
+        assert_equal(jac.shape, (len(par), len(x)), 
+                     err_msg = "%s jacobian shape" % fn.__name__)
+        
+        # compare to central difference
+        for i in range(len(par)):
+            p_hi = np.copy(par).astype(float)
+            p_lo = np.copy(par).astype(float)
+            p_hi[i] += h
+            p_lo[i] -= h
+            
+            deriv = (f(x, *p_hi) - f(x, *p_lo)) / (2*h)
+            assert_array_almost_equal(jac[i], deriv, decimal=6, 
+                    err_msg = "%s jacobian parameter %d" % (fn.__name__, i))
+    
+def test_pickle():
+    
+    x = np.linspace(1e-3, 10, 100)
+    
+    # pulsed functions
+    for fn, par in ((pulsed_exp, [1, 0.1]), 
+                    (pulsed_biexp, [1, 10, 0.3, 0.1]), 
+                    (pulsed_strexp, [1, 0.5, 0.1])):
+        
+        f = fn(lifetime = 1, pulse_len = 4)
+        f2 = pickle.loads(pickle.dumps(f))
+        assert_array_equal(f(x, *par), f2(x, *par), 
+                           err_msg = "%s pickle" % fn.__name__)
+    
+    # fitter functions
+    fit = fitter(keyfn = str)
+    for name, par in (('Bi Exp', [1, 10, 0.3, 0.1, 2, 20, 0.4, 0.2]), 
+                      ('Lorentzian', [1, 2, 3, 4, 5, 6, 0.1]), 
+                      ('QuadLorentz', [1e3, 1, 0, 0, 0, 1, 1, 1, 1, 1, 
+                                       1e3, 1, 0, 0, 0, 1, 1, 1, 1, 1, 0])):
+        f = fit.get_fn(name, ncomp = 2, pulse_len = 4, lifetime = 1)
+        f2 = pickle.loads(pickle.dumps(f))
+        assert_array_equal(f(x, *par), f2(x, *par), 
+                           err_msg = "fitter %s pickle" % name)
+    
+def test_quadlorentz_init_par():
+    
+    # data with one dip
+    class data(object):
+        def asym(self, mode):
+            x = np.linspace(4.1e4-200, 4.1e4+200, 100)
+            return (x, 1-0.1*lorentzian(x, 4.1e4, 20, -1), np.full(100, 0.01))
+    
+    # initial parameters for each of the 2I amplitudes
+    fit = fitter(keyfn = str)
+    fit.spin = dict(fit.spin, I3=3)
+    for probe in ('Li8', 'Li9', 'Ac230', 'I3'):
+        fit.probe_species = probe
+        for ncomp in (1, 2):
+            names = fit.gen_param_names('QuadLorentz', ncomp)
+            par = fit.gen_init_par('QuadLorentz', ncomp, data(), 'c')
+            assert_equal(sorted(par.index), sorted(names), 
+                         err_msg = "QuadLorentz initial parameters for %s" % probe)
+    
+def test_pulsed_conv():
+    
+    # settings
+    tau = 1
+    pulse_len = 4
+    
+    x = np.linspace(1e-3, 10, 1000)
+    
+    # compare to analytic pulsed exp
+    pexp = pulsed_exp(lifetime = tau, pulse_len = pulse_len)
+    cexp = pulsed_conv(lambda t, lam, amp: amp*np.exp(-lam*t), 
+                       lifetime = tau, pulse_len = pulse_len)
+    
+    for lam in (0.01, 1, 100):
+        assert_array_almost_equal(pexp(x, lam, 1), cexp(x, lam, 1), decimal=8, 
+                                  err_msg = "pulsed conv exp, lambda = %g" % lam)
+    
+    # compare to numerically integrated pulsed str exp
+    psexp = pulsed_strexp(lifetime = tau, pulse_len = pulse_len)
+    csexp = pulsed_conv(lambda t, lam, beta, amp: amp*np.exp(-(lam*t)**beta), 
+                       lifetime = tau, pulse_len = pulse_len)
+    
+    for lam, beta in ((1, 0.5), (10, 0.3), (0.1, 1.5)):
+        assert_array_almost_equal(psexp(x, lam, beta, 1), csexp(x, lam, beta, 1), 
+                                  decimal=6, 
+                                  err_msg = "pulsed conv str exp, beta = %g" % beta)
+    
+    # parameter introspection
+    assert_equal(csexp.__code__.co_varnames, ('t', 'lam', 'beta', 'amp'), 
+                 err_msg = "pulsed conv parameter names")
+    
+    # no beam delivered yet: t -> 0 limit, f(0), without warnings
+    with np.errstate(all='raise'):
+        assert_array_equal(cexp(np.array([-1, 0]), 1, 2), [2, 2], 
+                           err_msg = "pulsed conv t <= 0")
+        assert_array_almost_equal(cexp(np.array([-1, 0, 1e-3, 1]), 1, 2), 
+                                  [2, 2, cexp(1e-3, 1, 2), cexp(1, 1, 2)], 
+                                  err_msg = "pulsed conv mixed t <= 0")
+    
+def test_integration_tol():
+    
+    x = np.linspace(1e-3, 10, 100)
+    f = pulsed_strexp(lifetime = 1, pulse_len = 4)
+    f2 = pulsed_strexp(lifetime = 1, pulse_len = 4, integration_tol = 1e-3)
+    
+    assert_equal(f2.pulser.integration_tol, 1e-3, err_msg = "set tolerance")
+    assert_array_almost_equal(f(x, 1, 0.5, 1), f2(x, 1, 0.5, 1), decimal=3, 
+                              err_msg = "coarse tolerance")
+    
+    # temporary tolerance through wrappers
+    fn = get_fn_superpos([f, pulsed_exp(lifetime = 1, pulse_len = 4)])
+    with integration_tol([fn], 1e-2):
+        assert_equal(f.pulser.integration_tol, 1e-2, 
+                     err_msg = "temporary tolerance in superposition")
+    assert_equal(f.pulser.integration_tol, 1e-6, err_msg = "restore tolerance")
+    
+    assert_equal(pickle.loads(pickle.dumps(f2.pulser)).integration_tol, 1e-3, 
+                 err_msg = "pickle tolerance")
+    
+def test_pulsed_cache():
+    
+    x = np.linspace(1e-3, 10, 100)
+    f = pulsed_strexp(lifetime = 1, pulse_len = 4, cache_size = 2)
+    f0 = pulsed_strexp(lifetime = 1, pulse_len = 4)
+    
+    y = f(x, 1, 0.5, 1)
+    assert_array_equal(f(x, 1, 0.5, 2), 2*y, err_msg = "cached value")
+    assert_array_equal(f(np.copy(x), 1, 0.5, 1), f0(x, 1, 0.5, 1), 
+                       err_msg = "cached value, copied time array")
+    assert_equal((f.cache_hits, f.cache_misses), (2, 1), err_msg = "cache hits")
+    
+    # new inputs and eviction
+    f(x[1:], 1, 0.5, 1)
+    f(x, 2, 0.5, 1)
+    f(x, 1, 0.5, 1)
+    assert_equal((f.cache_hits, f.cache_misses), (2, 4), err_msg = "cache eviction")
+    assert_equal(len(f._cache), 2, err_msg = "cache size")
+    
+    # no cache by default
+    f0(x, 1, 0.5, 1)
+    assert_equal((f0.cache_hits, f0.cache_misses), (0, 0), err_msg = "no cache")
+    
+    f.cache_clear()
+    assert_equal((len(f._cache), f.cache_hits), (0, 0), err_msg = "clear cache")
+    
+def test_fn_superpos():
+    
+    x = np.linspace(-5, 5, 100)
+    
+    for fns, par in (([lorentzian]*3+[baseline], [0, 1, 1, 1, 2, 0.5, -1, 0.3, 2, 0.1]), 
+                     ([gaussian, gaussian, lorentzian], [0, 1, 1, 2, 1, 1, 0, 1, 1]), 
+                     ([bilorentzian]*2, [0, 1, 1, 2, 1, 1, 1, 1, 2, 1])):
+        
+        f = get_fn_superpos(fns)
+        npars = [0]+list(np.cumsum([len(fn.__code__.co_varnames)-1 for fn in fns]))
+        
+        for xi in (x, 0.5):
+            target = sum(fn(xi, *par[lo:hi]) for fn, lo, hi in zip(fns, npars[:-1], npars[1:]))
+            assert_array_almost_equal(f(xi, *par), target, decimal=12, 
+                            err_msg = "superposition of %s" % [fn.__name__ for fn in fns])
+        
+        assert_equal(f.__code__.co_varnames[:2], ("x", "pars"), 
+                     err_msg = "superposition code")
+    
+    assert_equal(len(get_fn_superpos([lorentzian]*3+[baseline]).groups), 2, 
+                 err_msg = "superposition fused groups")
+    
+def test_constrained_fn():
+    
+    import jax.numpy as jnp
+    import math
+    
+    x = np.linspace(-5, 5, 100)
+    fn = get_fn_superpos([lorentzian]*2+[baseline])
+    
+    pname_orig = ['peak_0', 'fwhm_0', 'amp_0', 'peak_1', 'fwhm_1', 'amp_1', 'b']
+    pname_constr = ['peak_0', 'fwhm_0', 'a', 'c', 'peak_1', 'fwhm_1', 'b']
+    par = np.array([0.1, 1, 0.5, 0.2, 1.5, 0.5, 0.01])
+    target = fn(x, 0.1, 1, 0.5*np.exp(0.2), 1.5, 0.5, 1, 0.01)
+    
+    # jax-traceable and non-traceable constraints
+    for exp in (jnp.exp, math.exp):
+        constr = {'amp_0': (lambda a, c: a*exp(c), ['a', 'c']), 
+                  'amp_1': (lambda a: 2*a, ['a'])}
+        f = get_constrained_fn(fn, pname_orig, pname_constr, constr)
+        assert_array_almost_equal(f(x, *par), target, decimal=12, 
+                                  err_msg = "constrained fn with %s" % exp)
+        assert isinstance(f(x, *par), np.ndarray), "constrained fn output type"
+        
+        # jacobian by chain rule, compare to central differences
+        h = 1e-6
+        num = np.array([(f(x, *(par+h*np.eye(len(par))[i])) - 
+                         f(x, *(par-h*np.eye(len(par))[i])))/(2*h) 
+                        for i in range(len(par))])
+        assert_array_almost_equal(f.jac(x, *par), num, decimal=6, 
+                                  err_msg = "constrained fn jacobian with %s" % exp)
+    
+    # missing parameter
+    assert_raises(RuntimeError, get_constrained_fn, fn, pname_orig, 
+                  pname_constr[:-1], constr)
+    
+def test_decay_corrected_fn():
+    
+    from bfit.fitting.decay_31mg import fa_31Mg
+    
+    x = np.linspace(1e-3, 10, 100)
+    fpol = pulsed_exp(lifetime = 1, pulse_len = 4)
+    f = decay_corrected_fn(fa_31Mg, fpol, beam_pulse = 4)
+    
+    for xi in (x, np.copy(x), x[1:]):
+        assert_array_almost_equal(f(xi, 1, 0.5), 
+                                  fa_31Mg(xi, 4, 1e6)*fpol(xi, 1, 0.5), 
+                                  decimal=12, err_msg = "decay correction")
+    assert_equal(len(f._cache), 2, err_msg = "decay correction cache")
+    
+    # changing inputs invalidates the cached curve
+    f.beam_pulse = 2
+    assert_array_almost_equal(f(x, 1, 0.5), fa_31Mg(x, 2, 1e6)*fpol(x, 1, 0.5), 
+                              decimal=12, err_msg = "decay correction new pulse")
+    
+def test_type1_jac():
+    
+    def numjac(f, x, par, h=1e-6):
+        par = np.asarray(par, dtype=float)
+        out = []
+        for i in range(len(par)):
+            d = np.zeros(len(par))
+            d[i] = h*max(1, abs(par[i]))
+            out.append((f(x, *(par+d))-f(x, *(par-d)))/(2*d[i]))
+        return np.array(out)
+    
+    x = np.linspace(-3, 3, 50)
+    for f, par in ((lorentzian, [0.3, 1.2, 0.7]), 
+                   (bilorentzian, [0.2, 1, 0.5, 2, 0.3]), 
+                   (gaussian, [0.3, 1.2, 0.7]), 
+                   (get_fn_superpos([lorentzian]*2+[baseline]), [0, 1, 1, 1, 2, 0.5, 0.1])):
+        assert_array_almost_equal(f.jac(x, *par), numjac(f, x, par), decimal=7, 
+                                  err_msg = "jacobian of %s" % f)
+    
+    # quadrupole splitting: compare relative to scale
+    x = np.linspace(4.1e4-200, 4.1e4+200, 80)
+    f = quadlorentzian_fixed_spin(2)
+    par = [4.1e4, 30, 0.3, 0.7, 0.4, 1, 2, 3, 4, 15]
+    jac = f.jac(x, *par)
+    num = numjac(f, x, par, h=1e-7)
+    assert_array_almost_equal(jac/np.max(abs(num), axis=1, keepdims=True), 
+                              num/np.max(abs(num), axis=1, keepdims=True), 
+                              decimal=5, err_msg = "jacobian of quadlorentzian")
+    
+def test_quadlorentzian_spin():
+    
+    x = np.linspace(4.1e4-200, 4.1e4+200, 100)
+    par = [4.1e4, 30, 0.3, 0.7, 0.4]
+    
+    for I, amps in ((2, [1, 2, 3, 4]), (1.5, [1, 2, 3]), (1, [1, 2]), (0.5, [1])):
+        
+        f = quadlorentzian_fixed_spin(I)
+        
+        # sum of individual lorentzians
+        target = 0
+        for m, amp in zip(np.arange(-(I-1), I+1), amps):
+            target += lorentzian(x, qp_nu(*par, I, m), 15, amp)
+        
+        assert_array_almost_equal(f(x, *par, *amps, 15), target, decimal=12, 
+                                  err_msg = "quadlorentzian I = %g" % I)
+        assert_equal(len(f.__code__.co_varnames), 7+len(amps), 
+                     err_msg = "quadlorentzian I = %g parameter names" % I)
+    
+    # fixed spin matches general function
+    assert_array_almost_equal(quadlorentzian(x, *par, 1, 2, 3, 4, 15, 15, 15, 15, 2), 
+                              quadlorentzian_fixed_spin(2)(x, *par, 1, 2, 3, 4, 15), 
+                              decimal=12, err_msg = "quadlorentzian fixed spin")
+    
+    # wrong number of amplitudes
+    assert_raises(RuntimeError, quadlorentzian, x, *par, 1, 2, 3, 4, 
+                  15, 15, 15, 15, 1.5)
+
+def test_functions_jax():
+    
+    # line shapes
+    x = np.linspace(-5, 5, 50)
+    for name, par in (('lorentzian', (0.3, 1.2, 0.5)), 
+                      ('bilorentzian', (0.3, 1.2, 0.5, 3, 0.1)), 
+                      ('gaussian', (0.3, 1.2, 0.5)), 
+                      ('baseline', (0.2, ))):
+        f = globals()[name]
+        fj = getattr(fns_jax, name)
+        assert_array_almost_equal(fj(x, *par), f(x, *par), decimal=12, 
+                                  err_msg = "jax %s" % name)
+        assert_array_almost_equal(fj.jac(x, *par), f.jac(x, *par), decimal=12, 
+                                  err_msg = "jax %s jacobian" % name)
+    
+    # quadrupole split lorentzian
+    x = np.linspace(4.1e4-200, 4.1e4+200, 100)
+    for I in (2, 1.5):
+        f = quadlorentzian_fixed_spin(I)
+        fj = fns_jax.quadlorentzian_fixed_spin(I)
+        par = [4.1e4, 30, 0.3, 0.7, 0.4] + list(range(1, int(2*I)+1)) + [15]
+        assert_array_almost_equal(fj(x, *par), f(x, *par), decimal=12, 
+                                  err_msg = "jax quadlorentzian I = %g" % I)
+        assert_array_almost_equal(fj.jac(x, *par), f.jac(x, *par), decimal=10, 
+                                  err_msg = "jax quadlorentzian I = %g jacobian" % I)
+        assert_equal(fj.__code__.co_varnames, f.__code__.co_varnames, 
+                     err_msg = "jax quadlorentzian I = %g parameter names" % I)
+        assert_almost_equal(fj(x[50], *par), f(x[50], *par), decimal=12, 
+                            err_msg = "jax quadlorentzian I = %g scalar" % I)
+    
+    # pulsed functions, compare to analytic jacobian of the exp
+    t = np.linspace(0.01, 10, 200)
+    f = pulsed_exp(1.2096, 4)
+    fj = fns_jax.pulsed_exp(1.2096, 4)
+    assert_array_almost_equal(fj(t, 0.5, 0.1), f(t, 0.5, 0.1), decimal=12, 
+                              err_msg = "jax pulsed_exp")
+    assert_array_almost_equal(fj.jac(t, 0.5, 0.1), f.jac(t, 0.5, 0.1), decimal=12, 
+                              err_msg = "jax pulsed_exp jacobian")
+    
+    f = pulsed_biexp(1.2096, 4)
+    fj = fns_jax.pulsed_biexp(1.2096, 4)
+    assert_array_almost_equal(fj(t, 0.5, 2, 0.3, 0.1), f(t, 0.5, 2, 0.3, 0.1), 
+                              decimal=12, err_msg = "jax pulsed_biexp")
+    
+    # same values as numpy for t <= 0, finite jacobian elsewhere
+    t = np.array([-1, 0, 1e-12, 4, 5])
+    assert_array_almost_equal(fj(t, 0.5, 2, 0.3, 0.1), f(t, 0.5, 2, 0.3, 0.1), 
+                              decimal=12, err_msg = "jax pulsed_biexp at t <= 0")
+    f = pulsed_exp(1.2096, 4)
+    fj = fns_jax.pulsed_exp(1.2096, 4)
+    assert_array_almost_equal(fj(t, 0.5, 0.1), f(t, 0.5, 0.1), decimal=12, 
+                              err_msg = "jax pulsed_exp at t <= 0")
+    assert np.all(np.isfinite(fj.jac(t, 0.5, 0.1)[:, t != 0])), \
+        "jax pulsed_exp jacobian not finite for t != 0"
+    
+    # superposition and constraints
+    x = np.linspace(-5, 5, 50)
+    fnlist = [fns_jax.lorentzian, fns_jax.lorentzian, fns_jax.baseline]
+    fj = fns_jax.get_fn_superpos(fnlist)
+    par = (0.3, 1.2, 0.5, -0.2, 1, 0.3, 0.1)
+    assert_array_almost_equal(fj(x, *par), get_fn_superpos([lorentzian, lorentzian, baseline])(x, *par), 
+                              decimal=12, err_msg = "jax superposition")
+    
+    pnames = list(fj.__code__.co_varnames[1:])
+    constr = {'fwhm_1': [lambda a: 2*a, ['fwhm_0']]}
+    pconstr = [p for p in pnames if p != 'fwhm_1']
+    fc = fns_jax.get_constrained_fn(fj, pnames, pconstr, constr)
+    
+    assert isinstance(fc, fns_jax.jax_fn), "jax constrained function not compiled"
+    par = (0.3, 1.2, 0.5, -0.2, 0.3, 0.1)
+    assert_array_almost_equal(fc(x, *par), fj(x, 0.3, 1.2, 0.5, -0.2, 2.4, 0.3, 0.1), 
+                              decimal=12, err_msg = "jax constrained function")
+    jac = fj.jac(x, 0.3, 1.2, 0.5, -0.2, 2.4, 0.3, 0.1)
+    assert_array_almost_equal(fc.jac(x, *par)[1], jac[1]+2*jac[4], decimal=12, 
+                              err_msg = "jax constrained function jacobian")
+    
+    # mixed numpy and jax falls back to numpy superposition
+    f = fns_jax.get_fn_superpos([pulsed_strexp(1.2096, 4), fns_jax.pulsed_exp(1.2096, 4)])
+    assert not isinstance(f, fns_jax.jax_fn), "jax superposition fallback"
+    
+    # pickling
+    fj = pickle.loads(pickle.dumps(fns_jax.pulsed_exp(1.2096, 4)))
+    assert_array_almost_equal(fj(t, 0.5, 0.1), pulsed_exp(1.2096, 4)(t, 0.5, 0.1), 
+                              decimal=12, err_msg = "jax pickle")
+    
+    # fitter backend
+    fit = fitter(None, 'Li8')
+    fit.backend = 'jax'
+    fn = fit.get_fn('Lorentzian', ncomp=2)
+    assert isinstance(fn, fns_jax.jax_fn), "fitter jax backend"
+    fn = fit.get_fn('Str Exp', ncomp=1, pulse_len=4, lifetime=1.2096)
+    assert_array_almost_equal(fn(t, 0.5, 0.5, 0.1), pulsed_strexp(1.2096, 4)(t, 0.5, 0.5, 0.1), 
+                              decimal=12, err_msg = "fitter jax backend Str Exp")
+    
+def test_functions_jax_prime():
+    
+    x = np.linspace(-5, 5, 50)
+    par = (0.3, 1.2, 0.5)
+    num = (lorentzian(x+1e-6, *par)-lorentzian(x-1e-6, *par))/2e-6
+    assert_array_almost_equal(fns_jax.lorentzian.prime(x, *par), num, decimal=8, 
+                              err_msg = "jax lorentzian derivative in x")
+    
+    t = np.linspace(0.01, 10, 200)
+    f = fns_jax.pulsed_exp(1.2096, 4)
+    num = (f(t+1e-6, 0.5, 0.1)-f(t-1e-6, 0.5, 0.1))/2e-6
+    assert_array_almost_equal(f.prime(t, 0.5, 0.1), num, decimal=6, 
+                              err_msg = "jax pulsed_exp derivative in x")
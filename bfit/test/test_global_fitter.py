@@ -68,6 +68,46 @@ def test_fitting_minos():
     
     assert_equal(len(gf.par), 3, "global fitter internal flattened parameter array length")
     
+def test_fitting_lm():
+    
+    gf = global_fitter(fn, x, y, dy, shared=shared)
+    gf.fit(minimizer='lm')
+    par, std_l, std_h, cov = gf.get_par()
+    
+    assert_almost_equal(abs(par[0, 0] - par[1, 0]), 0, err_msg = "global fitter lm shared parameter equal")
+    assert_almost_equal(abs(par[0, 0] - 5), 0, err_msg = "global fitter lm parameter 0 result")
+    assert_almost_equal(abs(par[0, 1] - 1), 0, err_msg = "global fitter lm parameter 1 result")
+    assert_almost_equal(abs(par[1, 1] - 8), 0, err_msg = "global fitter lm parameter 2 result")
+    assert gf.minuit.fmin.is_valid, "global fitter lm valid minimum"
+    
+    # errors match migrad
+    gf2 = global_fitter(fn, x, y, dy, shared=shared)
+    gf2.fit(minimizer='migrad')
+    assert_array_almost_equal(gf.std_l, gf2.std_l, err_msg = "global fitter lm errors")
+    
+def test_fitting_linear():
+    
+    # slope shared, intercept linear too: nothing left to minimize
+    gf = global_fitter(fn, x, y, dy, shared=shared)
+    gf.fit(minimizer='migrad', linear=[True, True], p0=[1, 1])
+    par, std_l, std_h, cov = gf.get_par()
+    
+    assert_almost_equal(par[0, 0], 5, err_msg = "global fitter linear parameter 0 result")
+    assert_almost_equal(par[0, 1], 1, err_msg = "global fitter linear parameter 1 result")
+    assert_almost_equal(par[1, 1], 8, err_msg = "global fitter linear parameter 2 result")
+    assert_equal(np.array(gf.cov).shape, (3, 3), "global fitter linear covariance")
+    
+    # nonlinear shared rate, linear amplitudes
+    f = lambda x, a, b: a*np.exp(-b*x)
+    xx = [np.linspace(0, 3, 30)]*2
+    yy = [2*np.exp(-1.5*xx[0]), 0.5*np.exp(-1.5*xx[1])]
+    dyy = [np.full(30, 0.01)]*2
+    gf = global_fitter(f, xx, yy, dyy, shared=[False, True])
+    gf.fit(minimizer='migrad', linear=[True, False], p0=[1, 1], print_level=0)
+    
+    assert_array_almost_equal(gf.par_runwise, [[2, 1.5], [0.5, 1.5]], decimal=4, 
+                              err_msg = "global fitter linear nonlinear results")
+
 def test_fitting_fixed_trf():
     
     gf = global_fitter(fn, x, y, dy, shared=shared, fixed=[False, True])
@@ -139,3 +179,156 @@ def test_chi2():
     assert(gchi > 0), 'Failed: global fitter chisquared calculation error'
     assert(all(chi > 0)), 'Failed: global fitter chisquared calculation error'
     
+
+def test_master_jac():
+    
+    from bfit.fitting.functions import lorentzian
+    
+    xl = [np.linspace(-2, 2, 50), np.linspace(-3, 3, 40)]
+    yl = [lorentzian(xl[0], 0.1, 1, 0.5), lorentzian(xl[1], 0.1, 0.8, 0.2)]
+    dyl = [np.full(50, 0.01), np.full(40, 0.01)]
+    
+    gf = global_fitter(lorentzian, xl, yl, dyl, shared=[True, False, False], 
+                       fixed=[[False, False, False], [False, True, False]])
+    gf.fit(minimizer='migrad', p0=[0, 0.8, 0.4])
+    
+    # compare to numerical derivative of the master function
+    par = np.array([0.05, 0.9, 0.4, 0.3])
+    h = 1e-6
+    num = []
+    for i in range(len(par)):
+        d = np.zeros(len(par))
+        d[i] = h
+        num.append((np.copy(gf.master_fn(None, *(par+d)))-gf.master_fn(None, *(par-d)))/(2*h))
+    
+    assert_array_almost_equal(gf.master_jac(None, *par), num, decimal=6, 
+                              err_msg = "global fitter master jacobian")
+    
+    # fit results
+    assert_array_almost_equal(gf.par_runwise[0], [0.1, 1, 0.5], decimal=5, 
+                              err_msg = "global fitter jacobian fit set 0")
+    assert_array_almost_equal(gf.par_runwise[1], [0.1, 0.8, 0.2], decimal=5, 
+                              err_msg = "global fitter jacobian fit set 1")
+    
+def test_master_function():
+    
+    gf = global_fitter(fn, x, y, dy, shared=shared, fixed=[[False, False], [False, True]])
+    gf.fit(minimizer='migrad', p0=[1, 2])
+    
+    # reference: shared slope, free intercept of set 0, fixed intercept of set 1
+    target = np.concatenate((3*x[0]+4, 3*x[1]+2))
+    out = gf.master_fn(None, 3, 4)
+    assert_array_almost_equal(out, target, err_msg = "global fitter master function")
+    
+    # output buffer is reused
+    assert gf.master_fn(None, 1, 1) is out, "global fitter master function buffer"
+    
+    f, fprime = gf.master_fn_and_prime(None, 3, 4)
+    assert_array_almost_equal(f, target, err_msg = "global fitter master function and prime")
+    assert_array_almost_equal(fprime, np.full(20, 3), decimal=6, 
+                              err_msg = "global fitter master function derivative")
+    
+def test_master_jac_numeric():
+    
+    # count calls of each data set
+    ncalls = [0, 0]
+    def f0(x, a, b):
+        ncalls[0] += 1
+        return a*np.exp(-b*x)
+    def f1(x, a, b):
+        ncalls[1] += 1
+        return a*np.exp(-b*x)
+    
+    xx = [np.linspace(0, 2, 10), np.linspace(0, 3, 15)]
+    yy = [f0(xx[0], 1, 2), f1(xx[1], 1, 0.5)]
+    
+    gf = global_fitter([f0, f1], xx, yy, [np.full(10, 0.01), np.full(15, 0.01)], 
+                       shared=[True, False], fixed=[[False, False], [False, True]])
+    gf.fit(minimizer='migrad', p0=[[0.9, 1.9], [0.9, 0.5]])
+    assert gf.master_jac is None, "global fitter numerical jacobian not opt-in"
+    
+    gf = global_fitter([f0, f1], xx, yy, [np.full(10, 0.01), np.full(15, 0.01)], 
+                       shared=[True, False], fixed=[[False, False], [False, True]], 
+                       numeric_jac=True)
+    gf.fit(minimizer='migrad', p0=[[0.9, 1.9], [0.9, 0.5]])
+    assert_array_almost_equal(gf.par_runwise[0], [1, 2], decimal=3, 
+                              err_msg = "global fitter numerical jacobian fit")
+    
+    # one evaluation per free parameter of each data set and side
+    ncalls[0] = ncalls[1] = 0
+    jac = gf.master_jac(None, 1, 2)
+    assert_equal(ncalls, [4, 2], err_msg = "global fitter numerical jacobian calls")
+    
+    # shared row is the sum of contributions, local rows are block-sparse
+    target = np.zeros((2, 25))
+    target[0, :10] = np.exp(-2*xx[0])
+    target[0, 10:] = np.exp(-0.5*xx[1])
+    target[1, :10] = -xx[0]*np.exp(-2*xx[0])
+    assert_array_almost_equal(jac, target, decimal=6, 
+                              err_msg = "global fitter numerical jacobian")
+    
+def test_nthreads():
+    
+    xx = [np.linspace(0, 2, 10+i) for i in range(6)]
+    yy = [2*np.exp(-(1+0.1*i)*xi) for i, xi in enumerate(xx)]
+    dyy = [np.full(len(xi), 0.01) for xi in xx]
+    f = lambda x, a, b: a*np.exp(-b*x)
+    
+    out = []
+    for nthreads in (1, 3):
+        gf = global_fitter(f, xx, yy, dyy, shared=[True, False], nthreads=nthreads, 
+                           numeric_jac=True)
+        gf.fit(minimizer='migrad', p0=[1, 1], print_level=0)
+        out.append((gf.par, gf.master_fn(None, *gf.par).copy(), 
+                    gf.master_jac(None, *gf.par).copy()))
+    
+    for a, b, name in zip(*out, ('parameters', 'function', 'jacobian')):
+        assert_array_equal(a, b, err_msg = "global fitter threaded %s" % name)
+    
+    # thread pool is shut down after fitting
+    assert gf.master_fn._pool is None, "global fitter thread pool not closed"
+    
+    # functions which can't be copied are evaluated serially, with a warning
+    class nocopy(object):
+        def __call__(self, x, a, b):    return a*np.exp(-b*x)
+        def __deepcopy__(self, memo):   raise TypeError('no copy')
+    
+    with assert_warns(UserWarning):
+        gf = global_fitter(nocopy(), xx, yy, dyy, shared=[True, False], nthreads=3, 
+                           numeric_jac=True)
+        gf.fit(minimizer='migrad', p0=[1, 1], print_level=0)
+    
+    assert_array_equal(gf.par, out[0][0], 
+                       err_msg = "global fitter threaded with uncopyable function")
+    
+    # jax functions are stateless: shared without recompiling
+    from bfit.fitting.functions_jax import jax_fn
+    import jax.numpy as jnp
+    fj = jax_fn(lambda x, a, b: a*jnp.exp(-b*x), ('x', 'a', 'b'))
+    gf = global_fitter(fj, xx, yy, dyy, shared=[True, False], nthreads=3, 
+                       numeric_jac=True)
+    gf.fit(minimizer='migrad', p0=[1, 1], print_level=0)
+    
+    assert all(f is fj for f in gf.master_fn.fn), "global fitter jax function copied"
+    assert_array_almost_equal(gf.par, out[0][0], decimal=5, 
+                              err_msg = "global fitter threaded jax function")
+    
+def test_covariance_runwise():
+    
+    f = lambda x, a, b, c: a*x**2 + b*x + c
+    xx = [np.linspace(0, 2, 10)]*3
+    yy = [xi**2 + (i+1)*xi + 1 for i, xi in enumerate(xx)]
+    dyy = [np.full(10, 0.1)]*3
+    
+    gf = global_fitter(f, xx, yy, dyy, shared=[True, False, False], 
+                       fixed=[[False, False, False], [False, False, True], [False, False, False]])
+    gf.fit(minimizer='migrad', p0=[1, 1, 1], print_level=0)
+    
+    for cov, lnk in zip(gf.cov_runwise, gf.sharing_links):
+        for i in range(3):
+            for j in range(3):
+                if lnk[i] < 0 or lnk[j] < 0:
+                    assert np.isnan(cov[i, j]), "global fitter runwise covariance fixed"
+                else:
+                    assert_equal(cov[i, j], gf.cov[lnk[i], lnk[j]], 
+                                 err_msg = "global fitter runwise covariance")
@@ -62,3 +62,90 @@ def test_dxa_dya():
     assert_almost_equal(0, ls(1,1), err_msg = "least squares dx asymmetric and dy asymmetric good parameters")
     assert_almost_equal(4/(100+36), ls(-1,1), err_msg = "least squares dx asymmetric and dy asymmetric low parameters")
     assert_almost_equal(1/(4+144), ls(2,1), err_msg = "least squares dx asymmetric and dy asymmetric high parameters")
+
+def test_grad():
+    jac = lambda x, a, b : np.array([x, np.ones(len(x))])
+    
+    ls = LeastSquares(fn, x, y, fn_jac=jac)
+    assert_array_almost_equal([2, 4], ls.grad(1, 2), err_msg = "least squares gradient no errors")
+    
+    ls = LeastSquares(fn, x, y, dy, fn_jac=jac)
+    assert_array_almost_equal([1/2, 5/2], ls.grad(1, 2), err_msg = "least squares gradient dy")
+    
+    ls = LeastSquares(fn, x, y, dy, dx=dx, fn_jac=jac)
+    assert ls.grad is None, "least squares gradient with dx"
+    
+def test_fn_and_prime():
+    
+    # count function calls
+    ncalls = [0]
+    def f(x, a, b):
+        ncalls[0] += 1
+        return a*np.square(x)+b
+    
+    xx = np.linspace(0, 2, 10)
+    yy = f(xx, 1, 1)
+    
+    # numerical derivative: one call per evaluation
+    ls = LeastSquares(f, xx, yy, dy=np.ones(10), dx=np.ones(10))
+    ncalls[0] = 0
+    val = ls(2, 1)
+    assert_equal(ncalls[0], 1, err_msg = "least squares dx number of calls")
+    
+    fval, fprime = ls.fn_and_prime(xx, 2, 1)
+    assert_array_almost_equal(fval, 2*np.square(xx)+1, err_msg = "least squares central value")
+    assert_array_almost_equal(fprime, 4*xx, decimal=6, err_msg = "least squares derivative")
+    
+    # other x: stencil is not the precomputed one
+    xo = np.linspace(3, 5, 4)
+    fval, fprime = ls.fn_and_prime(xo, 2, 1)
+    assert_array_almost_equal(fval, 2*np.square(xo)+1, err_msg = "least squares central value other x")
+    assert_array_almost_equal(fprime, 4*xo, decimal=5, err_msg = "least squares derivative other x")
+    
+    # analytic derivative
+    ls2 = LeastSquares(f, xx, yy, dy=np.ones(10), dx=np.ones(10), 
+                       fn_prime=lambda x, a, b: 2*a*x)
+    assert_almost_equal(ls2(2, 1), val, decimal=6, err_msg = "least squares analytic derivative")
+    
+    # analytic derivative as attribute
+    f.prime = lambda x, a, b: 2*a*x
+    ls3 = LeastSquares(f, xx, yy, dy=np.ones(10), dx=np.ones(10))
+    assert_almost_equal(ls3(2, 1), ls2(2, 1), decimal=12, err_msg = "least squares fn.prime")
+    
+def test_asym_single_call():
+    
+    # count function calls
+    ncalls = [0]
+    def f(x, a, b):
+        ncalls[0] += 1
+        return a*x+b
+    
+    for kwargs in ({'dy':dy, 'dy_low':dyl}, 
+                   {'dy':dy, 'dy_low':dyl, 'dx':dx}, 
+                   {'dy':dy, 'dy_low':dyl, 'dx':dx, 'dx_low':dxl}):
+        ls = LeastSquares(f, x, y, **kwargs)
+        
+        # repeated calls reuse buffers
+        for _ in range(2):
+            ncalls[0] = 0
+            ls(-1, 1)
+            assert_equal(ncalls[0], 1, err_msg = "least squares single call %s" % list(kwargs.keys()))
+    
+        assert_almost_equal(ls(-1, 1), LeastSquares(fn, x, y, **kwargs)(-1, 1), 
+                            err_msg = "least squares buffer reuse %s" % list(kwargs.keys()))
+    
+def test_residuals():
+    jac = lambda x, a, b : np.array([x, np.ones(len(x))])
+    
+    for kwargs in ({}, {'dy':dy}, {'dy':dy, 'dy_low':dyl}, {'dy':dy, 'dx':dx}, 
+                   {'dy':dy, 'dy_low':dyl, 'dx':dx, 'dx_low':dxl}):
+        ls = LeastSquares(fn, x, y, fn_jac=jac, **kwargs)
+        assert_almost_equal(np.sum(np.square(ls.residuals(-1, 2))), ls(-1, 2), 
+                            err_msg = "least squares residuals %s" % list(kwargs.keys()))
+    
+    ls = LeastSquares(fn, x, y, dy=dy, dy_low=dyl, fn_jac=jac)
+    assert_array_almost_equal(ls.residuals_jac(-1, 2), [[0, -1/10], [-1, -1/10]], 
+                              err_msg = "least squares residuals jacobian")
+    
+    ls = LeastSquares(fn, x, y, dy=dy, dx=dx, fn_jac=jac)
+    assert ls.residuals_jac is None, "least squares residuals jacobian with dx"
@@ -103,3 +103,52 @@ def test_fix_named_and_list_assign():
     
     others = [m.fixed[k] for k in 'abcd']
     assert_equal(all(others), True, 'minuit fixed list and named assignment')
+    
+def test_grad():
+    
+    # quadratic: exact gradient of the chisquared is passed to Minuit
+    f = lambda x, a, b: a*x**2+b
+    f.jac = lambda x, a, b: np.array([x**2, np.ones(len(x))])
+    
+    m = minuit(f, x, y+1, dy=np.ones(len(x)), start=[2, 0])
+    assert m.ls.grad is not None, 'minuit gradient from fn.jac'
+    
+    m.migrad()
+    assert_almost_equal(m.values, [1, 1], decimal=6, err_msg='minuit fit with gradient')
+    
+def test_project():
+    
+    # two exponentials and a baseline: amplitudes and baseline are linear
+    f = lambda x, a, b, c, d, e: a*np.exp(-b*x) + c*np.exp(-d*x) + e
+    xx = np.linspace(0, 5, 100)
+    yy = f(xx, 2, 3, 1, 0.5, 0.1)
+    dyy = np.full(100, 0.01)
+    linear = [True, False, True, False, True]
+    
+    # without jacobian
+    m = minuit(f, xx, yy, dyy, start=[1, 2, 1, 0.3, 0], 
+               limit=[[0, 10], [2, 10], [0, 10], [0, 2], [-1, 1]])
+    mnl = m.project(linear)
+    assert_equal(mnl.parameters, ('b', 'd'), err_msg = 'minuit projection nonlinear parameters')
+    assert_array_almost_equal(m.values, [2, 3, 1, 0.5, 0.1], decimal=4, 
+                              err_msg = 'minuit projection result')
+    
+    # with jacobian and fixed parameters
+    f.jac = lambda x, a, b, c, d, e: np.array([np.exp(-b*x), -a*x*np.exp(-b*x), 
+                                               np.exp(-d*x), -c*x*np.exp(-d*x), 
+                                               np.ones(len(x))])
+    m = minuit(f, xx, yy, dyy, start=[1, 2, 1, 0.5, 0.1], 
+               limit=[[0, 10], [2, 10], [0, 10], [0, 2], [-1, 1]], fix=[False]*4+[True])
+    m.project(linear)
+    assert_array_almost_equal(m.values, [2, 3, 1, 0.5, 0.1], decimal=4, 
+                              err_msg = 'minuit projection result with jacobian')
+    
+    # full errors after polishing
+    m.migrad()
+    m.hesse()
+    assert m.fmin.is_valid, 'minuit projection valid minimum'
+    assert_equal(np.array(m.covariance).shape, (5, 5), 'minuit projection covariance')
+    
+    # asymmetric errors not supported
+    m = minuit(f, xx, yy, dyy, dy_low=dyy, start=[1, 2, 1, 0.3, 0])
+    assert_raises(RuntimeError, m.project, linear)
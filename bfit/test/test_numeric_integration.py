@@ -117,3 +117,59 @@ def test_numeric_integration(tolerance=1e-5, n_samples=50, print_summary=False):
                 + "\tamplitude = %.4e\n" % df["Amplitude"][i]
                 + "\trate      = %.4e 1/s" % df["Rate (1/s)"][i]
             )
+
+
+
+# Test of the tabulated (interpolated) pulsed stretched exponential against the
+# exact numeric integration for random stretching exponents, and against the
+# analytic solution when beta = 1.
+def test_tabulated_integration(tolerance=1e-5, n_samples=50, seed=20230101):
+
+    # constants appropriate for most β-NMR data taken at TRIUMF
+    nuclear_lifetime = bd.life["Li8"]
+    pulse_duration = 3.0 * nuclear_lifetime
+
+    # create the SLR functions
+    fcn_exp = pulsed_exp(nuclear_lifetime, pulse_duration)
+    fcn_exact = pulsed_strexp(nuclear_lifetime, pulse_duration)
+    fcn_table = pulsed_strexp(nuclear_lifetime, pulse_duration, table_tol=1e-6)
+
+    # random parameters, uniformly distributed between typical bounds
+    # fixed seed so that the test is reproducible
+    rng = np.random.default_rng(seed)
+    # the exact integration is only converged to the tolerance for slower rates
+    relaxation_rates = rng.uniform(
+        1e-2 * nuclear_lifetime, 1e1 * nuclear_lifetime, n_samples
+    )
+    betas = rng.uniform(0.2, 1.0, n_samples)
+
+    for rate, beta in zip(relaxation_rates, betas):
+
+        time = rng.uniform(0.0, pulse_duration + 10 * nuclear_lifetime, n_samples)
+
+        difference = fcn_exact(time, rate, beta, 1) - fcn_table(time, rate, beta, 1)
+
+        assert_array_less(
+            np.abs(difference),
+            tolerance,
+            err_msg="Tabulated str exp differs from exact integration "
+            + "(rate = %.4e 1/s, beta = %.4f)" % (rate, beta),
+        )
+
+    # compare to analytic solution
+    relaxation_rates = rng.uniform(
+        1e-2 * nuclear_lifetime, 1e2 * nuclear_lifetime, n_samples
+    )
+
+    for rate in relaxation_rates:
+
+        time = rng.uniform(0.0, pulse_duration + 10 * nuclear_lifetime, n_samples)
+
+        difference = fcn_exp(time, rate, 1) - fcn_table(time, rate, 1, 1)
+
+        assert_array_less(
+            np.abs(difference),
+            tolerance,
+            err_msg="Tabulated str exp differs from analytic solution "
+            + "(rate = %.4e 1/s, beta = 1)" % rate,
+        )